@@ -349,28 +349,41 @@ document.addEventListener('DOMContentLoaded', function() {
         try {
             // 尝试从缓存获取数据
             const cachedData = localStorage.getItem(CACHE_KEY);
+            let cached = null;
             if (cachedData) {
-                const { data, timestamp } = JSON.parse(cachedData);
+                cached = JSON.parse(cachedData);
                 // 检查缓存是否过期
-                if (Date.now() - timestamp < CACHE_DURATION) {
+                if (Date.now() - cached.timestamp < CACHE_DURATION) {
                     console.log('使用缓存的模型列表数据');
-                    updateModelSelect(data);
+                    updateModelSelect(cached.data);
                     return;
                 }
             }
 
-            // 缓存不存在或已过期，发起新请求
-            const response = await fetchApi(endpoints.models);
+            // 缓存不存在或已过期，带上 ETag 重新验证，列表未变化时服务端返回 304
+            const headers = {
+                'Content-Type': 'application/json',
+                'X-Request-Source': 'webapp'
+            };
+            if (cached && cached.etag) {
+                headers['If-None-Match'] = cached.etag;
+            }
+            const response = await fetchApi(endpoints.models, { headers, cache: 'no-store' });
             
-            if (!response.ok) {
+            let data;
+            if (response.status === 304 && cached) {
+                console.log('模型列表未变化，继续使用缓存');
+                data = cached.data;
+            } else if (response.ok) {
+                data = await response.json();
+            } else {
                 throw new Error(`获取模型列表失败: ${response.status}`);
             }
             
-            const data = await response.json();
-            
             // 更新缓存
             localStorage.setItem(CACHE_KEY, JSON.stringify({
                 data: data,
+                etag: response.headers.get('ETag') || (cached && cached.etag) || null,
                 timestamp: Date.now()
             }));
 
@@ -971,14 +984,17 @@ document.addEventListener('DOMContentLoaded', function() {
             aiMessageDiv.innerHTML = '';
             
             let inCodeBlock = false;
+            // 一个SSE事件可能跨多次读取，未结束的行留到下一次读取时拼接
+            let buffer = '';
             
             // 处理流式响应
             while (true) {
                 const { value, done } = await reader.read();
                 if (done) break;
                 
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n');
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
                 
                 for (const line of lines) {
                     if (!line.trim() || !line.startsWith('data:')) continue;
@@ -994,7 +1010,9 @@ document.addEventListener('DOMContentLoaded', function() {
                             currentResponseText += parsed.reply;
                             
                             // 检测是否在代码块内
-                            if (parsed.reply.includes('```')) {
+                            // 服务端会合并多个片段，一次回复中可能包含多个代码块标记
+                            const fenceCount = (parsed.reply.match(/```/g) || []).length;
+                            if (fenceCount % 2 === 1) {
                                 inCodeBlock = !inCodeBlock;
                             }
                             
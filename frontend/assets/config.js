@@ -61,8 +61,8 @@
             const response = await fetch(url, finalOptions);
             clearTimeout(timeoutId); // 清除超时
             
-            // 检查响应状态
-            if (!response.ok) {
+            // 检查响应状态（304 表示客户端缓存仍然有效，由调用方处理）
+            if (!response.ok && response.status !== 304) {
                 console.error('API响应错误:', response.status, response.statusText);
                 const errorText = await response.text().catch(() => '无法读取错误详情');
                 console.error('错误详情:', errorText);
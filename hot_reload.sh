@@ -4,7 +4,15 @@
 # 增强版：修复监控和重启逻辑
 
 # 设置变量
-APP_MODULE="src.app:app"
+# 服务模式: wsgi(默认，同步worker) 或 asgi(事件循环worker，单个worker可同时保持大量聊天流)
+SERVER_MODE="${SERVER_MODE:-wsgi}"
+if [ "$SERVER_MODE" = "asgi" ]; then
+    APP_MODULE="src.asgi:app"
+    GUNICORN_WORKER_CLASS="uvicorn.workers.UvicornWorker"
+else
+    APP_MODULE="src.app:app"
+    GUNICORN_WORKER_CLASS="sync"
+fi
 GUNICORN_WORKERS=4
 GUNICORN_BIND="0.0.0.0:5000"
 GUNICORN_TIMEOUT=300
@@ -33,9 +41,11 @@ start_gunicorn() {
     # 杀掉可能已存在的Gunicorn进程
     pkill -f "gunicorn" 2>/dev/null
     rm -f $PID_FILE
+    # 清空上一次运行的指标文件，/metrics 只汇总本次启动的worker
+    rm -rf "${METRICS_DIR:-${STATE_DIR:-/tmp/aiapp}/metrics}"
     
     # 使用更可靠的方式启动Gunicorn并写入PID文件
-    gunicorn -w $GUNICORN_WORKERS -b $GUNICORN_BIND --timeout $GUNICORN_TIMEOUT \
+    gunicorn -w $GUNICORN_WORKERS -k $GUNICORN_WORKER_CLASS -b $GUNICORN_BIND --timeout $GUNICORN_TIMEOUT \
         --pid=$PID_FILE --log-level=info \
         --access-logfile=$LOG_DIR/gunicorn_access.log \
         --error-logfile=$LOG_DIR/gunicorn_error.log \
@@ -1,27 +1,145 @@
 import os
 import requests
+import httpx
 from typing import Optional, Dict
 import logging
 import json
 import time
 import uuid
 from functools import wraps
+from .transport import get_session, TRANSPORT_CONFIG
+from .context_window import build_context
+from .sse import SSE_CONFIG, SSEParser, parse_chat_event
+from .log_pipeline import log_payload
+from .upstream_governor import THROTTLE_STATUS, GOVERNOR_CONFIG, GovernorTimeout, governor, parse_retry_after
+from .resilience import CircuitOpenError, resilience
+from .metrics import UpstreamTimer
+from .tracing import amark_first, current_trace, mark_first
 
 logger = logging.getLogger(__name__)
 
 def log_api_call(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        logger.info(f"调用 API: {func.__name__}")
+        logger.info("调用 API: %s", func.__name__)
         try:
             result = func(*args, **kwargs)
-            logger.info(f"API 调用成功: {func.__name__}")
+            logger.info("API 调用成功: %s", func.__name__)
             return result
         except Exception as e:
-            logger.error(f"API 调用失败: {func.__name__}, 错误: {str(e)}")
+            logger.error("API 调用失败: %s, 错误: %s", func.__name__, e)
             raise
     return wrapper
 
+def format_image_payload(payload):
+    """将图像生成参数整理为上游接口需要的格式"""
+    return {
+        "model": payload.get("model", "black-forest-labs/FLUX.1-schnell"),
+        "prompt": payload.get("prompt", ""),
+        "width": payload.get("width", 1024),
+        "height": payload.get("height", 1024),
+        "batch_size": payload.get("batch_size", 1),
+        "num_inference_steps": payload.get("num_inference_steps", 20),
+        "guidance_scale": payload.get("guidance_scale", 7.5),
+        "use_fast_sampler": payload.get("use_fast_sampler", True),
+        "variation_seed": payload.get("variation_seed", 0),
+        "variation_strength": payload.get("variation_strength", 0.0),
+    }
+
+def format_chat_payload(payload):
+    """将聊天参数整理为上游接口需要的格式（强制流式输出）"""
+    return {
+        "model": payload["model"],
+        "messages": payload["messages"],
+        "temperature": max(0.0, min(2.0, float(payload.get("temperature", 0.7)))),
+        "max_tokens": int(payload.get("max_tokens", 1024)),
+        "stream": True  # 强制使用流式输出
+    }
+
+def parse_image_response(status_code, text, load_json):
+    """解析图像生成接口的响应，返回图像URL列表或错误信息"""
+    # 检查HTTP状态码
+    if status_code != 200:
+        logger.error("API请求失败，状态码: %s, 响应: %s", status_code, text[:500])
+        return {"error": f"API请求失败 (HTTP {status_code}): {text[:100]}", "images": []}
+
+    # 解析响应
+    try:
+        data = load_json()
+        logger.debug("API响应成功，数据大小: %d 字节", len(str(data)))
+
+        # 验证响应中是否有图像
+        if not data.get("data") or len(data["data"]) == 0:
+            logger.warning("API响应中没有图像数据")
+            return {"error": "API响应中没有图像数据", "images": []}
+
+        logger.info("成功生成 %d 张图像", len(data.get('data', [])))
+        return {
+            "images": [{"url": img["url"]} for img in data.get('data', [])],
+            "credits_used": data.get('credits_used', 0)
+        }
+    except ValueError as e:
+        logger.error("无法解析API响应为JSON: %s", e, exc_info=True)
+        logger.error("原始响应: %s", text[:500])
+        return {"error": "无法解析API响应", "images": []}
+
+def throttled_result(status_code, retry_after, result):
+    """上游限流(429/503)时在结果中附带上游状态码和建议的重试等待秒数"""
+    if status_code in THROTTLE_STATUS:
+        delay = parse_retry_after(retry_after)
+        result["retry_after"] = GOVERNOR_CONFIG['default_retry_after'] if delay is None else delay
+        result["status"] = status_code
+    return result
+
+def _decode_chat_events(payloads, debug):
+    """解析一批上游事件，返回 (数据块列表, 是否读到 [DONE])"""
+    chunks = []
+    for payload in payloads:
+        try:
+            chunk = parse_chat_event(payload)
+        except ValueError as e:
+            logger.warning("解析响应数据失败: %s, 原始数据: %r", e, payload[:200])
+            continue
+        if chunk is None:
+            logger.info("聊天完成")
+            return chunks, True
+        if debug:
+            log_payload(logger, logging.DEBUG, "收到数据", chunk)
+        chunks.append(chunk)
+    return chunks, False
+
+def iter_chat_chunks(blocks):
+    """从上游流式响应的原始字节块中逐条产出聊天数据块，读到 [DONE] 时结束"""
+    parser = SSEParser()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for block in blocks:
+        chunks, done = _decode_chat_events(parser.feed(block), debug)
+        yield from chunks
+        if done:
+            return
+    chunks, _ = _decode_chat_events(parser.close(), debug)
+    yield from chunks
+
+async def aiter_chat_chunks(blocks):
+    """iter_chat_chunks 的异步版本"""
+    parser = SSEParser()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    async for block in blocks:
+        chunks, done = _decode_chat_events(parser.feed(block), debug)
+        for chunk in chunks:
+            yield chunk
+        if done:
+            return
+    chunks, _ = _decode_chat_events(parser.close(), debug)
+    for chunk in chunks:
+        yield chunk
+
+class DeadlineExceeded(Exception):
+    """调用方给出的时限在上游调用完成之前到期"""
+
+    def __init__(self, message="图像生成超过截止时间"):
+        super().__init__(message)
+
 class SiliconFlowClient:
     def __init__(self, base_url="https://api.siliconflow.com/v1", api_key=None):
         self.base_url = base_url
@@ -60,7 +178,7 @@ class SiliconFlowClient:
             
             # 记录请求信息
             api_url = f"{self.base_url}/images/generations"
-            logger.debug(f"图像生成API请求URL: {api_url}")
+            logger.debug("图像生成API请求URL: %s", api_url)
             
             # 构造请求负载
             formatted_payload = {
@@ -77,10 +195,10 @@ class SiliconFlowClient:
             }
             
             # 记录请求参数
-            logger.debug(f"图像生成请求参数: {json.dumps(formatted_payload, ensure_ascii=False)}")
+            log_payload(logger, logging.DEBUG, "图像生成请求参数", formatted_payload)
             
             # 发起POST请求
-            logger.info(f"正在调用图像生成API，模型: {formatted_payload['model']}, 提示词: '{formatted_payload['prompt'][:50]}...'")
+            logger.info("正在调用图像生成API，模型: %s, 提示词: '%s...'", formatted_payload['model'], formatted_payload['prompt'][:50])
             response = requests.post(
                 api_url,
                 headers=headers,
@@ -90,40 +208,40 @@ class SiliconFlowClient:
             
             # 检查HTTP状态码
             if response.status_code != 200:
-                logger.error(f"API请求失败，状态码: {response.status_code}, 响应: {response.text[:500]}")
+                logger.error("API请求失败，状态码: %s, 响应: %s", response.status_code, response.text[:500])
                 return {"error": f"API请求失败 (HTTP {response.status_code}): {response.text[:100]}", "images": []}
             
             # 解析响应
             try:
                 data = response.json()
-                logger.debug(f"API响应成功，数据大小: {len(str(data))} 字节")
+                logger.debug("API响应成功，数据大小: %d 字节", len(str(data)))
                 
                 # 验证响应中是否有图像
                 if not data.get("data") or len(data["data"]) == 0:
                     logger.warning("API响应中没有图像数据")
                     return {"error": "API响应中没有图像数据", "images": []}
                     
-                logger.info(f"成功生成 {len(data.get('data', []))} 张图像")
+                logger.info("成功生成 %d 张图像", len(data.get('data', [])))
                 return {
                     "images": [{"url": img["url"]} for img in data.get('data', [])],
                     "credits_used": data.get('credits_used', 0)
                 }
             except ValueError as e:
-                logger.error(f"无法解析API响应为JSON: {str(e)}", exc_info=True)
-                logger.error(f"原始响应: {response.text[:500]}")
+                logger.error("无法解析API响应为JSON: %s", e, exc_info=True)
+                logger.error("原始响应: %s", response.text[:500])
                 return {"error": "无法解析API响应", "images": []}
                 
         except requests.exceptions.ConnectTimeout as e:
-            logger.error(f"连接API超时: {str(e)}", exc_info=True)
+            logger.error("连接API超时: %s", e, exc_info=True)
             return {"error": "连接API服务器超时，请检查网络连接和API服务器状态", "images": []}
         except requests.exceptions.ReadTimeout as e:
-            logger.error(f"读取API响应超时: {str(e)}", exc_info=True)
+            logger.error("读取API响应超时: %s", e, exc_info=True)
             return {"error": "等待API响应超时，可能是由于图像生成耗时过长或服务器繁忙", "images": []}
         except requests.exceptions.ConnectionError as e:
-            logger.error(f"连接API服务器错误: {str(e)}", exc_info=True)
+            logger.error("连接API服务器错误: %s", e, exc_info=True)
             return {"error": "无法连接到API服务器，请检查网络连接和API服务器地址", "images": []}
         except Exception as e:
-            logger.error(f"图像生成过程中发生未预期的错误: {str(e)}", exc_info=True)
+            logger.error("图像生成过程中发生未预期的错误: %s", e, exc_info=True)
             return {"error": f"图像生成失败: {str(e)}", "images": []}
 
     def _check_model_access(self):
@@ -156,8 +274,8 @@ class SiliconFlowClient:
                 "stream": True  # 强制使用流式输出
             }
 
-            logger.info(f"发送聊天请求，模型: {formatted_payload['model']}")
-            logger.info(f"消息历史: {json.dumps(formatted_payload['messages'], ensure_ascii=False)}")
+            logger.info("发送聊天请求，模型: %s，消息数: %d", formatted_payload['model'], len(formatted_payload['messages']))
+            log_payload(logger, logging.INFO, "消息历史", formatted_payload['messages'])
 
             # 发送请求
             response = requests.post(
@@ -170,28 +288,7 @@ class SiliconFlowClient:
             response.raise_for_status()
 
             # 处理流式响应
-            def generate():
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    try:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            line = line[6:]  # 移除 "data: " 前缀
-                            if line == '[DONE]':
-                                logger.info("聊天完成")
-                                break
-                            data = json.loads(line)
-                            logger.debug(f"收到数据: {json.dumps(data, ensure_ascii=False)}")
-                            yield data
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"解析响应数据失败: {e}, 原始数据: {line}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"处理响应数据时出错: {e}")
-                        raise
-
-            return generate()
+            return iter_chat_chunks(response.iter_content(chunk_size=SSE_CONFIG['read_size']))
 
         except requests.exceptions.RequestException as e:
             error_msg = f"API请求失败: {str(e)}"
@@ -222,13 +319,13 @@ class LoggingClient:
 
     def _log_request(self, method_name, payload):
         request_id = uuid.uuid4().hex[:8]
-        logger.info(f"[Remote Request] ID:{request_id} Calling {method_name}")
-        logger.info(f"请求参数: {payload}")
+        logger.info("[Remote Request] ID:%s Calling %s", request_id, method_name)
+        log_payload(logger, logging.INFO, "请求参数", payload)
         start_time = time.perf_counter()
         return request_id, start_time
 
     def _log_response(self, request_id, method_name, duration, response):
-        logger.info(f"[Remote Response] ID:{request_id} {method_name} completed in {duration:.2f}s")
+        logger.info("[Remote Response] ID:%s %s completed in %.2fs", request_id, method_name, duration)
         return response
 
     def __getattr__(self, method_name):
@@ -242,20 +339,19 @@ class LoggingClient:
                 duration = time.perf_counter() - start_time
                 return self._log_response(request_id, method_name, duration, response)
             except Exception as e:
-                logger.error(f"[Remote Error] ID:{request_id} {str(e)}")
+                logger.error("[Remote Error] ID:%s %s", request_id, e)
                 raise
 
         return wrapper
 
 class LoggingSiliconFlowClient:
     _instance = None
-    _session = None
 
     def __init__(self):
         if not LoggingSiliconFlowClient._instance:
             # 验证环境变量
             api_key = os.getenv('SILICONFLOW_API_KEY')
-            logger.info(f"初始化SiliconFlow客户端，API密钥状态: {'已设置' if api_key else '未设置'}")
+            logger.info("初始化SiliconFlow客户端，API密钥状态: %s", '已设置' if api_key else '未设置')
             
             if not api_key:
                 logger.warning("未设置 SILICONFLOW_API_KEY 环境变量，API功能将无法使用")
@@ -271,13 +367,16 @@ class LoggingSiliconFlowClient:
             self.timeout = 30
             
             LoggingSiliconFlowClient._instance = self
-            LoggingSiliconFlowClient._session = requests.Session()
-            logger.info(f"SiliconFlow客户端初始化完成")
+            logger.info("SiliconFlow客户端初始化完成")
         else:
             self.base_url = LoggingSiliconFlowClient._instance.base_url
             self.headers = LoggingSiliconFlowClient._instance.headers
             self.timeout = LoggingSiliconFlowClient._instance.timeout
 
+    @property
+    def session(self):
+        """当前进程共享的上游连接池会话"""
+        return get_session()
    
     def generate_response(self, data, stop_event):
         """处理流式响应生成，支持中途停止"""
@@ -288,45 +387,40 @@ class LoggingSiliconFlowClient:
             if not user_input:
                 raise ValueError("缺少必要参数")
 
-            # 构造请求参数
+            # 构造请求参数，历史消息按模型的token预算裁剪
+            model = "deepseek-ai/DeepSeek-V2.5"
+            max_tokens = 150
             payload = {
-                "model": "deepseek-ai/DeepSeek-V2.5",
-                "messages": [
-                    *messages[-10:],  # 保留最近10条消息
-                    {"role": "user", "content": user_input}
-                ],
+                "model": model,
+                "messages": build_context([*messages, {"role": "user", "content": user_input}], model, max_tokens),
                 "temperature": 0.7,
-                "max_tokens": 150,
+                "max_tokens": max_tokens,
                 "stream": True
             }
 
             # 发起请求
-            self._current_request = self._session.post(
+            self._current_request = self.session.post(
                 f"{self.base_url}/v1/chat/completions",
                 json=payload,
                 headers=self.headers,
                 stream=True
             )
 
-            for chunk in self._current_request.iter_lines():
+            chunks = iter_chat_chunks(self._current_request.iter_content(chunk_size=SSE_CONFIG['read_size']))
+            for chunk_data in chunks:
                 # 检查是否需要停止
                 if stop_event.is_set():
                     if self._current_request:
                         self._current_request.close()
                     break
 
-                if chunk:
-                    try:
-                        chunk_data = json.loads(chunk.decode('utf-8').replace('data: ', ''))
-                        if 'choices' in chunk_data and chunk_data['choices']:
-                            content = chunk_data['choices'][0].get('delta', {}).get('content', '')
-                            if content:
-                                yield content
-                    except json.JSONDecodeError:
-                        continue
+                if 'choices' in chunk_data and chunk_data['choices']:
+                    content = chunk_data['choices'][0].get('delta', {}).get('content', '')
+                    if content:
+                        yield content
 
         except Exception as e:
-            logger.error(f"生成响应时出错: {str(e)}")
+            logger.error("生成响应时出错: %s", e)
             raise
         finally:
             self._current_request = None
@@ -340,7 +434,7 @@ class LoggingSiliconFlowClient:
                 pass
             self._current_request = None
 
-    def generate_image(self, payload, custom_headers=None):
+    def generate_image(self, payload, custom_headers=None, timeout=None):
         """调用SiliconFlow API生成图像。
 
         Args:
@@ -351,6 +445,7 @@ class LoggingSiliconFlowClient:
                 batch_size: 要生成的图像数量
                 其他可选参数
             custom_headers: 可选的自定义HTTP头信息
+            timeout: 可选的总时限（秒），包括排队等待发送名额、重试和等待上游响应的时间
 
         Returns:
             dict: 包含图像URL的响应数据或错误信息
@@ -368,70 +463,75 @@ class LoggingSiliconFlowClient:
             
             # 记录请求信息
             api_url = f"{self.base_url}/images/generations"
-            logger.debug(f"图像生成API请求URL: {api_url}")
+            logger.debug("图像生成API请求URL: %s", api_url)
             
             # 构造请求负载
-            formatted_payload = {
-                "model": payload.get("model", "black-forest-labs/FLUX.1-schnell"),
-                "prompt": payload.get("prompt", ""),
-                "width": payload.get("width", 1024),
-                "height": payload.get("height", 1024),
-                "batch_size": payload.get("batch_size", 1),
-                "num_inference_steps": payload.get("num_inference_steps", 20),
-                "guidance_scale": payload.get("guidance_scale", 7.5),
-                "use_fast_sampler": payload.get("use_fast_sampler", True),
-                "variation_seed": payload.get("variation_seed", 0),
-                "variation_strength": payload.get("variation_strength", 0.0),
-            }
+            formatted_payload = format_image_payload(payload)
             
             # 记录请求参数
-            logger.debug(f"图像生成请求参数: {json.dumps(formatted_payload, ensure_ascii=False)}")
+            log_payload(logger, logging.DEBUG, "图像生成请求参数", formatted_payload)
             
             # 发起POST请求
-            logger.info(f"正在调用图像生成API，模型: {formatted_payload['model']}, 提示词: '{formatted_payload['prompt'][:50]}...'")
-            response = requests.post(
-                api_url,
-                headers=headers,
-                json=formatted_payload,
-                timeout=60  # 增加超时时间到60秒
-            )
-            
-            # 检查HTTP状态码
-            if response.status_code != 200:
-                logger.error(f"API请求失败，状态码: {response.status_code}, 响应: {response.text[:500]}")
-                return {"error": f"API请求失败 (HTTP {response.status_code}): {response.text[:100]}", "images": []}
-            
-            # 解析响应
-            try:
-                data = response.json()
-                logger.debug(f"API响应成功，数据大小: {len(str(data))} 字节")
-                
-                # 验证响应中是否有图像
-                if not data.get("data") or len(data["data"]) == 0:
-                    logger.warning("API响应中没有图像数据")
-                    return {"error": "API响应中没有图像数据", "images": []}
-                    
-                logger.info(f"成功生成 {len(data.get('data', []))} 张图像")
-                return {
-                    "images": [{"url": img["url"]} for img in data.get('data', [])],
-                    "credits_used": data.get('credits_used', 0)
-                }
-            except ValueError as e:
-                logger.error(f"无法解析API响应为JSON: {str(e)}", exc_info=True)
-                logger.error(f"原始响应: {response.text[:500]}")
-                return {"error": "无法解析API响应", "images": []}
-                
+            logger.info("正在调用图像生成API，模型: %s, 提示词: '%s...'", formatted_payload['model'], formatted_payload['prompt'][:50])
+            deadline = None if timeout is None else time.monotonic() + timeout
+
+            def send():
+                queue_timeout = request_timeout = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DeadlineExceeded()
+                    queue_timeout = min(governor.queue_timeout, remaining)
+                with governor.acquire(headers["Authorization"], formatted_payload['model'], queue_timeout) as permit:
+                    if deadline is not None:
+                        request_timeout = deadline - time.monotonic()
+                        if request_timeout <= 0:
+                            raise DeadlineExceeded()
+                    try:
+                        response = self.session.post(
+                            api_url,
+                            headers=headers,
+                            json=formatted_payload,
+                            timeout=60 if request_timeout is None else min(60, request_timeout)  # 增加超时时间到60秒
+                        )
+                    except requests.exceptions.Timeout:
+                        # 调用方的时限先到，不是上游故障，不计入熔断
+                        if request_timeout is not None and request_timeout < 60:
+                            raise DeadlineExceeded() from None
+                        raise
+                    permit.observe(response.status_code, response.headers.get('Retry-After'))
+                return response
+
+            # 连接错误和 5xx 在重试预算内重试，连续失败时熔断
+            with UpstreamTimer('generate_image') as timer:
+                response = resilience.call(
+                    'images', send,
+                    retryable_errors=(requests.exceptions.ConnectionError,),
+                    failure_errors=(requests.exceptions.RequestException,),
+                )
+                timer.status = response.status_code
+            return throttled_result(response.status_code, response.headers.get('Retry-After'),
+                                    parse_image_response(response.status_code, response.text, response.json))
+
+        except GovernorTimeout as e:
+            return {"error": str(e), "images": [], "retry_after": e.retry_after, "status": 429}
+        except CircuitOpenError as e:
+            logger.error(str(e))
+            return {"error": str(e), "images": [], "retry_after": e.retry_after, "status": 503}
+        except DeadlineExceeded as e:
+            logger.warning("图像生成超过调用方时限 %.1f秒", timeout)
+            return {"error": str(e), "images": []}
         except requests.exceptions.ConnectTimeout as e:
-            logger.error(f"连接API超时: {str(e)}", exc_info=True)
+            logger.error("连接API超时: %s", e, exc_info=True)
             return {"error": "连接API服务器超时，请检查网络连接和API服务器状态", "images": []}
         except requests.exceptions.ReadTimeout as e:
-            logger.error(f"读取API响应超时: {str(e)}", exc_info=True)
+            logger.error("读取API响应超时: %s", e, exc_info=True)
             return {"error": "等待API响应超时，可能是由于图像生成耗时过长或服务器繁忙", "images": []}
         except requests.exceptions.ConnectionError as e:
-            logger.error(f"连接API服务器错误: {str(e)}", exc_info=True)
+            logger.error("连接API服务器错误: %s", e, exc_info=True)
             return {"error": "无法连接到API服务器，请检查网络连接和API服务器地址", "images": []}
         except Exception as e:
-            logger.error(f"图像生成过程中发生未预期的错误: {str(e)}", exc_info=True)
+            logger.error("图像生成过程中发生未预期的错误: %s", e, exc_info=True)
             return {"error": f"图像生成失败: {str(e)}", "images": []}
 
     @log_api_call
@@ -449,48 +549,60 @@ class LoggingSiliconFlowClient:
                 raise RuntimeError(error_msg)
                 
             # 格式化请求参数
-            formatted_payload = {
-                "model": payload["model"],
-                "messages": payload["messages"],
-                "temperature": max(0.0, min(2.0, float(payload.get("temperature", 0.7)))),
-                "max_tokens": int(payload.get("max_tokens", 1024)),
-                "stream": True  # 强制使用流式输出
-            }
-
-            logger.info(f"发送聊天请求，模型: {formatted_payload['model']}")
-            logger.info(f"消息历史: {json.dumps(formatted_payload['messages'], ensure_ascii=False)}")
+            formatted_payload = format_chat_payload(payload)
+            trace = current_trace()
+
+            logger.info("发送聊天请求，模型: %s，消息数: %d", formatted_payload['model'], len(formatted_payload['messages']))
+            log_payload(logger, logging.INFO, "消息历史", formatted_payload['messages'])
+
+            # 发送请求；并发名额只占用到收到响应头为止，流式输出可能持续很久，不应限制同时输出的流数
+            def send():
+                with governor.acquire(self.headers["Authorization"], formatted_payload['model']) as permit:
+                    response = self.session.post(
+                        f"{self.base_url}/chat/completions",
+                        headers=self.headers,
+                        json=formatted_payload,
+                        timeout=self.timeout,
+                        stream=True  # 强制使用流式响应
+                    )
+                    permit.observe(response.status_code, response.headers.get('Retry-After'))
+                return response
+
+            def discard(response):
+                response.close()
+
+            # 在读取任何输出之前失败（连接错误、5xx）时在重试预算内重试，连续失败时熔断
+            try:
+                # 包括等待发送名额、建立或复用连接和重试，到收到响应头为止
+                with trace.span('upstream_connect') as span, UpstreamTimer('chat_completion') as timer:
+                    response = resilience.call(
+                        'chat', send,
+                        retryable_errors=(requests.exceptions.ConnectionError,),
+                        failure_errors=(requests.exceptions.RequestException,),
+                        discard=discard,
+                    )
+                    timer.status = response.status_code
+                    span.set(status=response.status_code)
+            except (GovernorTimeout, CircuitOpenError) as e:
+                logger.error("API请求失败: %s", e)
+                raise RuntimeError(f"API请求失败: {str(e)}") from e
+            try:
+                response.raise_for_status()
+            except BaseException:
+                response.close()
+                raise
 
-            # 发送请求
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=formatted_payload,
-                timeout=self.timeout,
-                stream=True  # 强制使用流式响应
-            )
-            response.raise_for_status()
+            headers_received = time.perf_counter()
 
             # 处理流式响应
             def generate():
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    try:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            line = line[6:]  # 移除 "data: " 前缀
-                            if line == '[DONE]':
-                                logger.info("聊天完成")
-                                break
-                            data = json.loads(line)
-                            logger.debug(f"收到数据: {json.dumps(data, ensure_ascii=False)}")
-                            yield data
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"解析响应数据失败: {e}, 原始数据: {line}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"处理响应数据时出错: {e}")
-                        raise
+                completed = False
+                try:
+                    blocks = response.iter_content(chunk_size=SSE_CONFIG['read_size'])
+                    yield from iter_chat_chunks(mark_first(trace, 'first_upstream_byte', blocks, headers_received))
+                    completed = True
+                finally:
+                    self._release_stream(response, completed)
 
             return generate()
 
@@ -507,6 +619,22 @@ class LoggingSiliconFlowClient:
             logger.error(error_msg)
             raise RuntimeError(error_msg) from e
 
+    @staticmethod
+    def _release_stream(response, completed):
+        """流式响应结束后归还连接
+
+        正常结束时读完剩余的少量字节，让连接回到连接池被复用；
+        中途停止时直接关闭连接，避免继续接收上游数据。
+        """
+        try:
+            if completed:
+                for _ in response.iter_content(chunk_size=1024):
+                    pass
+        except Exception:
+            pass
+        finally:
+            response.close()
+
     def _safe_headers(self, headers):
         """处理敏感头信息"""
         safe_headers = headers.copy()
@@ -518,30 +646,29 @@ class LoggingSiliconFlowClient:
         return uuid.uuid4().hex[:8]
 
     @log_api_call
-    def get_models(self):
-        """获取可用的模型列表"""
+    def get_models(self, model_type=None, sub_type=None):
+        """获取可用的模型列表，可按类型（如 text/chat）过滤"""
         try:
-            logger.info("正在请求模型列表，URL: %s/models", self.base_url)
-            logger.info("请求头: %s", self._safe_headers(self.headers))
-            
-            response = requests.get(
-                f"{self.base_url}/models",
-                headers=self.headers,
-                timeout=self.timeout
-            )
+            params = {key: value for key, value in (('type', model_type), ('sub_type', sub_type)) if value}
+            logger.info("正在请求模型列表，URL: %s/models，参数: %s", self.base_url, params)
+            logger.debug("请求头: %s", self._safe_headers(self.headers))
             
-            logger.info(f"模型列表响应状态码: {response.status_code}")
-            
-            # 记录响应内容
-            try:
-                response_data = response.json()
-                logger.info(f"API响应内容: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
-            except json.JSONDecodeError:
-                logger.warning(f"API响应内容(非JSON): {response.text[:200]}")
+            with UpstreamTimer('get_models') as timer:
+                response = self.session.get(
+                    f"{self.base_url}/models",
+                    headers=self.headers,
+                    params=params or None,
+                    timeout=self.timeout
+                )
+                timer.status = response.status_code
             
+            logger.info("模型列表响应状态码: %s", response.status_code)
             response.raise_for_status()  # 确保请求成功
             
-            return response.json()
+            response_data = response.json()
+            logger.info("获取到 %d 个模型", len(response_data.get('data', [])))
+            log_payload(logger, logging.DEBUG, "API响应内容", response_data)
+            return response_data
             
         except requests.exceptions.RequestException as e:
             error_msg = f"获取模型列表失败: {str(e)}"
@@ -553,3 +680,159 @@ class LoggingSiliconFlowClient:
                     error_msg += f"\n响应内容: {e.response.text[:200]}"
             logger.error(error_msg)
             raise RuntimeError(error_msg) from e
+
+
+class AsyncSiliconFlowClient:
+    """基于 httpx 的异步客户端
+
+    与 LoggingSiliconFlowClient 参数和返回格式保持一致，供 ASGI 模式使用。
+    单个事件循环即可同时保持大量等待上游输出的流式连接。
+    """
+
+    def __init__(self, base_url="https://api.siliconflow.com/v1", api_key=None):
+        api_key = api_key or os.getenv('SILICONFLOW_API_KEY')
+        if not api_key:
+            logger.warning("未设置 SILICONFLOW_API_KEY 环境变量，API功能将无法使用")
+
+        self.base_url = base_url
+        self.headers = {
+            "Authorization": f"Bearer {api_key}" if api_key else "",
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        self.timeout = 30
+        self._client = None
+
+    @property
+    def client(self):
+        """延迟创建 httpx.AsyncClient，保证它绑定在实际运行的事件循环上"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=TRANSPORT_CONFIG['async_max_connections'],
+                    max_keepalive_connections=TRANSPORT_CONFIG['pool_maxsize'],
+                    keepalive_expiry=TRANSPORT_CONFIG['keepalive_idle'],
+                ),
+            )
+            logger.info("异步SiliconFlow客户端初始化完成")
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def generate_image(self, payload, custom_headers=None):
+        """异步调用图像生成接口，返回格式与 LoggingSiliconFlowClient.generate_image 相同"""
+        if not self.headers.get("Authorization"):
+            logger.error("缺少API密钥，无法进行图像生成")
+            return {"error": "缺少API密钥", "images": []}
+
+        formatted_payload = format_image_payload(payload)
+        logger.info("正在调用图像生成API(异步)，模型: %s, 提示词: '%s...'", formatted_payload['model'], formatted_payload['prompt'][:50])
+        async def send():
+            with await governor.aacquire(self.headers["Authorization"], formatted_payload['model']) as permit:
+                response = await self.client.post(
+                    f"{self.base_url}/images/generations",
+                    headers={**self.headers, **(custom_headers or {})},
+                    json=formatted_payload,
+                    timeout=60
+                )
+                permit.observe(response.status_code, response.headers.get('Retry-After'))
+            return response
+
+        try:
+            with UpstreamTimer('generate_image') as timer:
+                response = await resilience.acall(
+                    'images', send,
+                    retryable_errors=(httpx.ConnectError, httpx.ConnectTimeout),
+                    failure_errors=(httpx.TransportError,),
+                )
+                timer.status = response.status_code
+            return throttled_result(response.status_code, response.headers.get('Retry-After'),
+                                    parse_image_response(response.status_code, response.text, response.json))
+        except GovernorTimeout as e:
+            return {"error": str(e), "images": [], "retry_after": e.retry_after, "status": 429}
+        except CircuitOpenError as e:
+            logger.error(str(e))
+            return {"error": str(e), "images": [], "retry_after": e.retry_after, "status": 503}
+        except httpx.ConnectTimeout as e:
+            logger.error("连接API超时: %s", e, exc_info=True)
+            return {"error": "连接API服务器超时，请检查网络连接和API服务器状态", "images": []}
+        except httpx.ReadTimeout as e:
+            logger.error("读取API响应超时: %s", e, exc_info=True)
+            return {"error": "等待API响应超时，可能是由于图像生成耗时过长或服务器繁忙", "images": []}
+        except httpx.TransportError as e:
+            logger.error("连接API服务器错误: %s", e, exc_info=True)
+            return {"error": "无法连接到API服务器，请检查网络连接和API服务器地址", "images": []}
+        except Exception as e:
+            logger.error("图像生成过程中发生未预期的错误: %s", e, exc_info=True)
+            return {"error": f"图像生成失败: {str(e)}", "images": []}
+
+    async def chat_completion(self, payload):
+        """异步调用聊天接口
+
+        建立连接并确认状态码后返回一个异步生成器，逐条产出上游的数据块；
+        出错时与同步客户端一样抛出 RuntimeError。
+        """
+        if not self.headers.get("Authorization"):
+            error_msg = "缺少API密钥，请设置SILICONFLOW_API_KEY环境变量"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg)
+
+        formatted_payload = format_chat_payload(payload)
+        trace = current_trace()
+        logger.info("发送聊天请求(异步)，模型: %s", formatted_payload['model'])
+
+        # 并发名额只占用到收到响应头为止，一个worker可以同时输出的流数不受 model_concurrency 限制
+        async def send():
+            with await governor.aacquire(self.headers["Authorization"], formatted_payload['model']) as permit:
+                request = self.client.build_request(
+                    "POST",
+                    f"{self.base_url}/chat/completions",
+                    headers=self.headers,
+                    json=formatted_payload,
+                )
+                response = await self.client.send(request, stream=True)
+                permit.observe(response.status_code, response.headers.get('Retry-After'))
+            return response
+
+        async def discard(response):
+            await response.aclose()
+
+        try:
+            with trace.span('upstream_connect') as span, UpstreamTimer('chat_completion') as timer:
+                response = await resilience.acall(
+                    'chat', send,
+                    retryable_errors=(httpx.ConnectError, httpx.ConnectTimeout),
+                    failure_errors=(httpx.TransportError,),
+                    discard=discard,
+                )
+                timer.status = response.status_code
+                span.set(status=response.status_code)
+        except (httpx.HTTPError, GovernorTimeout, CircuitOpenError) as e:
+            error_msg = f"API请求失败: {str(e)}"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg) from e
+
+        if response.status_code >= 400:
+            try:
+                body = (await response.aread()).decode('utf-8', errors='replace')
+            finally:
+                await response.aclose()
+            error_msg = f"API请求失败: HTTP {response.status_code} [响应内容: {body[:200]}...]"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg)
+
+        headers_received = time.perf_counter()
+
+        async def generate():
+            try:
+                blocks = amark_first(trace, 'first_upstream_byte', response.aiter_bytes(), headers_received)
+                async for chunk in aiter_chat_chunks(blocks):
+                    yield chunk
+            finally:
+                await response.aclose()
+
+        return generate()
@@ -3,18 +3,39 @@ from flask import Flask, jsonify, request, Response, send_from_directory, stream
 from dotenv import load_dotenv
 from flask_cors import CORS
 from .api_client import LoggingSiliconFlowClient
+from .chat_stream import ReplyFormatter
+from .sse import SSEWriter
+from .session_store import create_session_store, SessionSweeper
+from .context_window import build_context
+from .model_catalog import ModelCatalog
+from .log_pipeline import install_queue_logging, log_payload, log_time, reset_log_time
+from .instrumentation import format_ms, instrument_response
+from .image_cache import IMAGE_CACHE_CONFIG, SEED_RANGE, ImageResultCache, deterministic_seed
+from .download_cache import DOWNLOAD_CACHE_CONFIG, DownloadCache
+from .upstream_governor import governor, queue_time, reset_queue_time
+from .resilience import resilience
+from .image_batch import IMAGE_BATCH_CONFIG, BatchRunner
+from .micro_batch import MicroBatcher
+from .image_jobs import IMAGE_JOB_CONFIG, FINISHED_STATES, ImageJobExecutor, ImageJobStore, JobQueueFull
+from .middleware.rate_limit import RateLimiter, init_rate_limiter
+from .log_reader import LOG_TYPES, LogReader
+from .log_query import LogQuery, LogSearcher
+from .log_rotation import CompressingRotatingFileHandler, file_chunks, gzip_stream, tar_stream
+from .log_tail import LOG_TAIL_CONFIG, LogFollower, TailSlots, parse_position, tail_events
+from .tracing import REQUEST_ID_HEADER, TRACING_CONFIG, NullTrace, Tracer, request_id_from
+from .metrics import CACHE_REQUESTS, CONTENT_TYPE, HTTP_REQUEST_DURATION, ChatStreamMetrics, cache_hit_ratio, registry as metrics_registry
 import os
 from pathlib import Path
 from datetime import datetime, timedelta
 import requests
 import random
+import math
 from werkzeug.exceptions import BadRequest
 from urllib.parse import urlparse
 from logging.config import dictConfig
 import time
 import logging
 import json
-from threading import Event
 import uuid
 import sys
 
@@ -50,7 +71,7 @@ logging_config = {
             'stream': 'ext://sys.stdout'
         },
         'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            '()': CompressingRotatingFileHandler,
             'level': 'DEBUG',
             'formatter': 'detailed',
             'filename': '/app/logs/app.log',
@@ -59,7 +80,7 @@ logging_config = {
             'encoding': 'utf8'
         },
         'error_file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            '()': CompressingRotatingFileHandler,
             'level': 'ERROR',
             'formatter': 'detailed',
             'filename': '/app/logs/error.log',
@@ -68,7 +89,7 @@ logging_config = {
             'encoding': 'utf8'
         },
         'api_file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            '()': CompressingRotatingFileHandler,
             'level': 'DEBUG',
             'formatter': 'detailed',
             'filename': '/app/logs/api.log',
@@ -77,7 +98,7 @@ logging_config = {
             'encoding': 'utf8'
         },
         'chat_file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            '()': CompressingRotatingFileHandler,
             'level': 'DEBUG',
             'formatter': 'detailed',
             'filename': '/app/logs/chat.log',
@@ -109,8 +130,9 @@ logging_config = {
     }
 }
 
-# 应用日志配置
+# 应用日志配置，文件和控制台处理器在后台线程中执行，请求线程只负责入队
 logging.config.dictConfig(logging_config)
+install_queue_logging(['', 'api', 'chat'])
 logger.info("应用启动中...")
 
 # 创建 Flask 应用
@@ -121,82 +143,298 @@ app.secret_key = os.getenv('SESSION_SECRET_KEY', 'default_session_secret_key')
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=31)  # 会话保持31天
 
-# 存储每个会话的停止事件
-session_stop_events = {}
-
-# 添加会话历史记录存储
-chat_histories = {}
-
 # 会话配置
 CHAT_CONFIG = {
     'max_history_length': 20,  # 每个会话最多保存多少条消息
     'session_timeout': 3600,   # 会话超时时间（秒）
-    'max_sessions': 1000       # 最大会话数
+    'max_sessions': 1000,      # 最大会话数
+    'max_history_bytes': int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024)),  # 所有会话历史的总字节上限
+    'sweep_interval': int(os.getenv('SESSION_SWEEP_INTERVAL', 60)),  # 后台清理过期会话的间隔（秒）
+    # 会话存储: sqlite 在同一主机的所有worker之间共享历史和停止信号，memory 仅当前进程可见
+    'session_store': os.getenv('SESSION_STORE', 'sqlite'),
+    'stop_poll_interval': float(os.getenv('SESSION_STOP_POLL_INTERVAL', 0.2)),  # 跨进程停止信号的轮询间隔（秒）
 }
 
-# 会话最后活动时间
-session_last_active = {}
+# 多个worker共享的运行时状态目录
+STATE_DIR = Path(os.getenv('STATE_DIR', '/tmp/aiapp'))
+
+# 会话历史、活动时间和停止信号的存储
+session_store = create_session_store(
+    CHAT_CONFIG['session_store'],
+    path=STATE_DIR / 'sessions.db',
+    poll_interval=CHAT_CONFIG['stop_poll_interval'],
+    max_sessions=CHAT_CONFIG['max_sessions'],
+    max_bytes=CHAT_CONFIG['max_history_bytes'],
+)
+
+# 按 session_timeout 清理过期会话的后台线程
+session_sweeper = SessionSweeper(session_store, CHAT_CONFIG['session_timeout'], CHAT_CONFIG['sweep_interval'])
+
+# 确定性种子模式下 /api/generate 的结果缓存
+image_cache = ImageResultCache()
+
+# /api/download 的本地磁盘缓存，多个worker共享
+download_cache = DownloadCache(DOWNLOAD_CACHE_CONFIG['dir'] or STATE_DIR / 'downloads')
+
+# /api/generate/batch 的线程池和每个模型的并发上限
+image_batch_runner = BatchRunner()
+
+# 随机种子图像请求的微批处理（IMAGE_MICRO_BATCH=true 时启用）
+micro_batcher = MicroBatcher()
+
+# 异步图像任务：状态保存在 STATE_DIR 中供所有worker查询，任务在接收请求的worker的线程池中执行
+image_job_store = ImageJobStore(STATE_DIR / 'image_jobs.db')
+image_job_executor = ImageJobExecutor(image_job_store)
+# /api/jobs/<id>/events 的连接名额，所有worker共享
+image_job_event_slots = TailSlots(STATE_DIR / 'job_events', IMAGE_JOB_CONFIG['events_max_subscribers'])
+
+# /api/logs 的日志读取器，把当前日志和轮转备份作为一个连续视图按行偏移索引读取
+log_reader = LogReader(log_dir)
+log_searcher = LogSearcher(log_reader)
+# /api/logs/<log_type>/stream 的订阅名额，所有worker共享
+log_tail_slots = TailSlots(STATE_DIR / 'log_tail')
+
+# 按IP和会话ID的速率限制，计数保存在 STATE_DIR 中由所有worker共享
+rate_limiter = RateLimiter(STATE_DIR / 'rate_limits.db')
+
+# 按比例采样的请求追踪，写入 Chrome trace-event 格式的轮转文件，可用 Perfetto 打开
+tracer = Tracer(Path(TRACING_CONFIG['dir'] or log_dir / 'traces') / 'trace.json')
+
+def collect_download_cache(values):
+    """下载缓存的命中数保存在共享的 SQLite 中，抓取 /metrics 时读取"""
+    stats = download_cache.stats()
+    values[(CACHE_REQUESTS.name, ('download', 'hit'))] = stats.get('hits', 0)
+    values[(CACHE_REQUESTS.name, ('download', 'miss'))] = stats.get('misses', 0)
+
+metrics_registry.add_collector(collect_download_cache)
+metrics_registry.add_collector(cache_hit_ratio)
 
 def cleanup_old_sessions():
     """清理过期的会话"""
-    current_time = time.time()
-    expired_sessions = []
-    
-    for session_id, last_active in session_last_active.items():
-        if current_time - last_active > CHAT_CONFIG['session_timeout']:
-            expired_sessions.append(session_id)
-    
-    for session_id in expired_sessions:
-        if session_id in chat_histories:
-            del chat_histories[session_id]
-        if session_id in session_last_active:
-            del session_last_active[session_id]
-        if session_id in session_stop_events:
-            del session_stop_events[session_id]
+    return session_store.cleanup_expired(CHAT_CONFIG['session_timeout'])
 
 def update_session_activity(session_id):
     """更新会话的最后活动时间"""
-    session_last_active[session_id] = time.time()
-    
-    # 如果会话数超过限制，清理最旧的会话
-    if len(chat_histories) > CHAT_CONFIG['max_sessions']:
-        oldest_session = min(session_last_active.items(), key=lambda x: x[1])[0]
-        del chat_histories[oldest_session]
-        del session_last_active[oldest_session]
-        if oldest_session in session_stop_events:
-            del session_stop_events[oldest_session]
-
-def trim_chat_history(session_id):
-    """限制会话历史记录长度"""
-    if session_id in chat_histories and len(chat_histories[session_id]) > CHAT_CONFIG['max_history_length']:
-        # 保留最新的消息
-        chat_histories[session_id] = chat_histories[session_id][-CHAT_CONFIG['max_history_length']:]
-
-# 全局变量
-DEFAULT_MODELS = {
-    "models": [
-        {
-            "id": "deepseek-ai/DeepSeek-V3",
-            "name": "DeepSeek-V3",
-            "description": "综合"
-        },
-        {
-            "id": "deepseek-ai/DeepSeek-R1",
-            "name": "DeepSeek R1",
-            "description": "推理"
-        },
-        {
-            "id": "Qwen/Qwen2.5-72B-Instruct-128K",
-            "name": "Qwen/Qwen2.5-72B-Instruct-128K",
-            "description": "编码"
-        },
-        {
-            "id": "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
-            "name": "DeepSeek R1-Distill-Qwen-7B",
-            "description": "免费"
+    session_sweeper.ensure_running()
+    session_store.touch(session_id)
+
+def parse_chat_request(method, args, data):
+    """从GET参数或POST数据中提取聊天请求参数"""
+    if method == 'GET':
+        return {
+            'session_id': args.get('session_id'),
+            'user_input': args.get('user_input'),
+            'history': None,
+            'system_prompt': args.get('system_prompt'),
+            'model': None,
         }
-    ]
-}
+    data = data or {}
+    return {
+        'session_id': data.get('session_id'),
+        'user_input': data.get('user_input'),
+        'history': data.get('history'),
+        'system_prompt': data.get('system_prompt'),
+        'model': data.get('model'),
+    }
+
+def build_chat_messages(session_id, user_input, history=None, system_prompt=None):
+    """构建发送给模型的消息列表，返回 (messages, history_source)"""
+    messages = []
+
+    # 如果提供了系统提示词，添加为系统消息
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+        chat_logger.debug(f"使用系统提示词: {system_prompt[:100]}{'...' if len(system_prompt) > 100 else ''}")
+
+    # 如果前端传来了历史记录，使用前端的历史
+    history_source = "none"
+    if history:
+        history_source = "frontend"
+        for msg in history:
+            messages.append({
+                "role": msg.get("role"),
+                "content": msg.get("content")
+            })
+    # 否则从服务器存储的历史中获取（系统提示词保持在最前面）
+    else:
+        stored_history = session_store.get_history(session_id)
+        if stored_history:
+            history_source = "server"
+            messages.extend(stored_history)
+
+    # 添加当前用户消息
+    messages.append({"role": "user", "content": user_input})
+    return messages, history_source
+
+def build_chat_payload(messages, model=None):
+    """构造聊天接口请求参数，消息按模型的token预算裁剪"""
+    model = model or "deepseek-ai/DeepSeek-V2.5"  # 默认模型
+    max_tokens = 2000
+    return {
+        "model": model,
+        "messages": build_context(messages, model, max_tokens),
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "stream": True
+    }
+
+def save_chat_turn(session_id, user_input, reply):
+    """把一轮对话保存到服务器端历史，返回保存后的历史长度"""
+    return session_store.append_messages(
+        session_id,
+        [{"role": "user", "content": user_input}, {"role": "assistant", "content": reply}],
+        CHAT_CONFIG['max_history_length'],
+    )
+
+def uses_deterministic_seed(data):
+    """请求是否使用确定性种子：显式指定 seed，或 deterministic 为真（默认取 IMAGE_DETERMINISTIC_SEED）"""
+    if data.get('seed') is not None:
+        return True
+    return bool(data.get('deterministic', IMAGE_CACHE_CONFIG['deterministic_seed']))
+
+def build_image_payload(data):
+    """校验图像生成请求并构造规范化的API参数，缺少或无效参数时抛出 ValueError
+
+    确定性种子模式下相同参数得到相同的 variation_seed，结果可以被缓存；否则每次使用随机种子。
+    """
+    required_fields = ['prompt', 'width', 'height', 'num_images']
+    for field in required_fields:
+        if field not in data:
+            raise ValueError(f"缺少必要参数: {field}")
+
+    try:
+        payload = {
+            "prompt": str(data['prompt']).strip(),
+            "model": data.get('model', 'black-forest-labs/FLUX.1-schnell'),
+            "width": int(data['width']),
+            "height": int(data['height']),
+            "batch_size": int(data['num_images']),
+            "num_inference_steps": 4,
+            "guidance_scale": float(data.get('guidance_scale', 4.0)),
+            "variation_seed": 0,
+            "variation_strength": 0.7
+        }
+        if data.get('seed') is not None:
+            payload["variation_seed"] = int(data['seed']) % SEED_RANGE
+        elif uses_deterministic_seed(data):
+            payload["variation_seed"] = deterministic_seed(payload)
+        else:
+            payload["variation_seed"] = random.randint(0, SEED_RANGE - 1)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"参数格式错误: {str(e)}")
+    return payload
+
+def use_image_cache(data):
+    """只有确定性种子的请求结果可以复用"""
+    return IMAGE_CACHE_CONFIG['enabled'] and uses_deterministic_seed(data)
+
+def generate_image_cached(data, payload, batchable=False, timeout=None):
+    """生成图像，返回 (响应数据, 状态码, 缓存状态)
+
+    确定性种子的请求通过结果缓存生成。batchable 为真（批量接口和异步任务，同一进程内有多个线程同时调用）
+    且启用微批处理时，随机种子的请求与参数相同的请求合并调用；/api/generate 在同步worker中每个进程只有一个请求线程，
+    合并不到其他请求，只会增加等待时间，因此不经过微批处理。
+    timeout 为上游调用的总时限（秒），与其他请求共享或合并的调用使用发起该调用的请求的时限。
+    """
+    if use_image_cache(data):
+        body, status, cache_status = image_cache.get_or_generate(payload, lambda: call_image_upstream(payload, timeout))
+    else:
+        if batchable and micro_batcher.enabled:
+            body, status = micro_batcher.submit(payload, lambda merged: call_image_upstream(merged, timeout))
+        else:
+            body, status = call_image_upstream(payload, timeout)
+        cache_status = 'BYPASS'
+    if cache_status != 'MISS':
+        logger.info("图像生成缓存: %s", cache_status)
+    CACHE_REQUESTS.inc(cache='image', result=cache_status.lower())
+    return body, status, cache_status
+
+def call_image_upstream(payload, timeout=None):
+    """调用上游生成图像，返回 (响应数据, 状态码)"""
+    logger.info(f"调用SiliconFlow API生成图像，模型: {payload['model']}")
+    # 使用LoggingSiliconFlowClient
+    client = LoggingSiliconFlowClient()  # 通过环境变量自动获取API密钥
+    if timeout is None:
+        return image_result_body(client.generate_image(payload))
+    return image_result_body(client.generate_image(payload, timeout=timeout))
+
+def parse_image_batch(data):
+    """解析批量生成请求，返回条目列表
+
+    请求体为条目数组，或 {"items": [...], 其他公共参数}，公共参数作为每个条目的默认值。
+    """
+    if isinstance(data, list):
+        items, defaults = data, {}
+    elif isinstance(data, dict) and isinstance(data.get('items'), list):
+        items = data['items']
+        defaults = {k: v for k, v in data.items() if k != 'items'}
+    else:
+        raise ValueError("请求体必须是条目数组或包含 items 数组的对象")
+    if not items:
+        raise ValueError("items 不能为空")
+    if len(items) > IMAGE_BATCH_CONFIG['max_items']:
+        raise ValueError(f"单次最多提交 {IMAGE_BATCH_CONFIG['max_items']} 个条目")
+    return [{**defaults, **item} if isinstance(item, dict) else item for item in items]
+
+def image_result_body(result):
+    """把客户端返回的生成结果转换为接口响应，返回 (响应数据, 状态码)"""
+    # 检查结果中是否有错误
+    if "error" in result:
+        logger.error(f"生成失败，API返回错误: {result['error']}")
+        if result.get("retry_after") is not None:
+            # 上游限流、排队超时(429)或熔断(503)，客户端可以在 retry_after 秒后重试
+            return {"error": result["error"], "retry_after": result["retry_after"]}, result["status"]
+        return {"error": result["error"]}, 500
+
+    # 检查是否有图像URL
+    if not result.get("images") or len(result["images"]) == 0:
+        logger.error("生成失败，API没有返回图像URL")
+        return {"error": "生成图像失败，未返回图像URL"}, 500
+
+    # 返回真实图片URL
+    response_data = {
+        "images": [img['url'] for img in result['images']],
+        "usage": {
+            "duration": result.get('timings', {}).get('inference', 0),
+            "credits_used": result.get('credits_used', 0)
+        }
+    }
+
+    logger.info(f"生成成功，返回 {len(response_data['images'])} 张图像")
+    return response_data, 200
+
+def serve_cached_download(cached, filename):
+    """发送缓存中的文件，Python 不读取文件内容
+
+    经过nginx代理（请求头 X-Sendfile-Type: X-Accel-Redirect）时交给nginx发送，
+    否则使用 send_file，由WSGI服务器的 sendfile 发送；两种方式都支持 ETag 和 Range 请求。
+    """
+    if request.if_none_match.contains(cached.digest):
+        response = Response(status=304)
+        response.set_etag(cached.digest)
+        return response
+
+    accel_prefix = DOWNLOAD_CACHE_CONFIG['accel_prefix']
+    if accel_prefix and request.headers.get('X-Sendfile-Type') == 'X-Accel-Redirect':
+        response = Response(mimetype=cached.content_type)
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix}/{cached.relative_path}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['Cache-Control'] = 'max-age=3600'
+        response.set_etag(cached.digest)
+        return response
+
+    return send_file(
+        cached.path,
+        mimetype=cached.content_type,
+        as_attachment=True,
+        download_name=filename,
+        etag=cached.digest,
+        conditional=True,
+        max_age=3600,
+    )
+
+# 模型目录：后台从上游加载，过期后继续返回旧快照直到刷新完成，上游不可用时使用内置的 DEFAULT_MODELS
+model_catalog = ModelCatalog(LoggingSiliconFlowClient)
 
 def create_app():
     """创建Flask应用实例并配置"""
@@ -251,25 +489,51 @@ def create_app():
         response.headers['Content-Type'] = 'text/plain'
         return response, 200  # 返回200状态码而不是204
 
-    # 响应日志中间件
+    # 响应日志中间件：包装响应体，在流结束时按实际发出的字节和时间记录一次
     @app.after_request
     def after_request(response):
-        # 记录响应信息
-        duration = (time.perf_counter() - request.start_time) * 1000
+        method, path, status_code = request.method, request.path, response.status_code
+        # 按路由规则而不是实际路径统计，避免路径参数产生大量标签
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        # 被 handle_preflight 提前返回的请求没有经过 start_timer
+        started = getattr(request, 'start_time', time.perf_counter())
+        trace = getattr(request, 'trace', None) or NullTrace(request_id_from(request.headers.get(REQUEST_ID_HEADER)))
+        response.headers[REQUEST_ID_HEADER] = trace.request_id
         content_type = response.headers.get('Content-Type', '')
-        if 'text' in content_type or 'json' in content_type:
-            body = response.get_data(as_text=True)[:500]
-        else:
-            body = '<binary data>'
-        
-        logger.info(f"""
-        [Response] {request.method} {request.path} => {response.status_code}
-        Duration: {duration:.2f}ms
-        Headers: {dict(response.headers)}
-        Body: {body}...
-        """)
-        
-        return response
+        handler_end = time.perf_counter()
+        handler_ms = (handler_end - started) * 1000
+        trace.add('handler', started, handler_end, route=route)
+
+        def log_response(metrics):
+            finished = metrics.last_byte or time.perf_counter()
+            HTTP_REQUEST_DURATION.observe(finished - started, route=route, method=method, status=status_code)
+            if trace.sampled:
+                trace.add('request', started, finished, method=method, path=path, status=status_code, bytes=metrics.bytes)
+                tracer.finish(trace)
+            logger.info("[Response] %s %s => %s | ID: %s | Handler: %.2fms | TTFB: %s | TTLB: %s | Size: %d bytes | Chunks: %d",
+                        method, path, status_code, trace.request_id, handler_ms,
+                        format_ms(metrics.ttfb_ms), format_ms(metrics.ttlb_ms), metrics.bytes, metrics.chunks)
+            if path.startswith('/api/'):
+                # 根据状态码确定日志级别
+                if status_code >= 500:
+                    log_method = api_logger.error
+                elif status_code >= 400:
+                    log_method = api_logger.warning
+                else:
+                    log_method = api_logger.info
+                log_method("API响应 | 方法: %s | 路径: %s | 状态码: %s | 大小: %d 字节", method, path, status_code, metrics.bytes)
+            if metrics.preview and ('text' in content_type or 'json' in content_type):
+                # 错误响应总是记录预览，其余按采样比例记录
+                log_payload(api_logger if path.startswith('/api/') else logger, logging.DEBUG,
+                            "[Response] Body", metrics.preview_text(), sample_rate=1 if status_code >= 400 else None)
+
+        # 本次请求在日志调用上花费的时间和等待上游发送名额（节流）的时间，通过 Server-Timing 暴露
+        response.headers.add('Server-Timing', f"log;dur={log_time() * 1000:.3f}, upstream-queue;dur={queue_time() * 1000:.3f}")
+
+        def trace_flush(start, end, size):
+            trace.add('client_flush', start, end, bytes=size)
+
+        return instrument_response(response, started, log_response, on_flush=trace_flush if trace.sampled else None)
 
     def get_request_source(request):
         """判断请求来源"""
@@ -285,15 +549,15 @@ def create_app():
     def log_request_info():
         """记录每个请求的详细信息"""
         if request.path.startswith('/api/'):
-            api_logger.info(f"收到API请求 | 方法: {request.method} | 路径: {request.path} | IP: {request.remote_addr}")
+            api_logger.info("收到API请求 | 方法: %s | 路径: %s | IP: %s", request.method, request.path, request.remote_addr)
             # 记录查询参数（GET请求）或JSON数据（POST请求）
             if request.method == 'GET' and request.args:
                 # 隐藏敏感信息
                 safe_args = {k: v if k not in ['api_key', 'token', 'password'] else '***' 
                              for k, v in request.args.items()}
-                api_logger.debug(f"请求参数: {safe_args}")
-            elif request.is_json:
-                # 记录适当长度的JSON数据，隐藏敏感字段
+                api_logger.debug("请求参数: %s", safe_args)
+            elif request.is_json and api_logger.isEnabledFor(logging.DEBUG):
+                # 按采样比例记录截断后的JSON数据，隐藏敏感字段
                 try:
                     data = request.get_json()
                     if isinstance(data, dict):
@@ -302,7 +566,7 @@ def create_app():
                                       else ('***' if k in ['api_key', 'token', 'password'] 
                                            else f"{v[:100]}..." if isinstance(v, str) and len(v) > 100 else v))
                                    for k, v in data.items()}
-                        api_logger.debug(f"请求数据: {safe_data}")
+                        log_payload(api_logger, logging.DEBUG, "请求数据", safe_data)
                 except Exception as e:
                     api_logger.warning(f"无法解析JSON数据: {str(e)}")
 
@@ -310,6 +574,14 @@ def create_app():
     @app.before_request
     def start_timer():
         request.start_time = time.perf_counter()
+        # 每个请求都有请求ID（沿用 X-Request-ID 或新生成），其中按比例采样的记录追踪；X-Trace: 1 强制采样
+        request.trace = tracer.begin(f"{request.method} {request.path}", request.headers.get(REQUEST_ID_HEADER),
+                                     force=request.headers.get('X-Trace') == '1')
+        reset_log_time()
+        reset_queue_time()
+
+    # 速率限制在计时之后检查，被拒绝的请求同样记录响应日志
+    init_rate_limiter(app, rate_limiter)
 
     @app.route('/')
     def root_health_check():
@@ -347,52 +619,18 @@ def create_app():
         
         try:
             # 构造API请求参数
-            required_fields = ['prompt', 'width', 'height', 'num_images']
-            for field in required_fields:
-                if field not in data:
-                    logger.error(f"缺少必要参数: {field}")
-                    return jsonify({"error": f"缺少必要参数: {field}"}), 400
+            payload = build_image_payload(data)
             
-            payload = {
-                "prompt": data['prompt'],
-                "model": data.get('model', 'black-forest-labs/FLUX.1-schnell'),
-                "width": data['width'],
-                "height": data['height'],
-                "batch_size": data['num_images'],
-                "num_inference_steps": 4,
-                "guidance_scale": data.get('guidance_scale', 4.0),
-                "variation_seed": random.randint(0, 999999999),
-                "variation_strength": 0.7
-            }
-            
-            logger.info(f"调用SiliconFlow API生成图像，模型: {payload['model']}")
-            
-            # 使用LoggingSiliconFlowClient
-            client = LoggingSiliconFlowClient()  # 通过环境变量自动获取API密钥
-            result = client.generate_image(payload)
-            
-            # 检查结果中是否有错误
-            if "error" in result:
-                logger.error(f"生成失败，API返回错误: {result['error']}")
-                return jsonify({"error": result["error"]}), 500
-            
-            # 检查是否有图像URL
-            if not result.get("images") or len(result["images"]) == 0:
-                logger.error("生成失败，API没有返回图像URL")
-                return jsonify({"error": "生成图像失败，未返回图像URL"}), 500
-            
-            # 返回真实图片URL
-            response_data = {
-                "images": [img['url'] for img in result['images']],
-                "usage": {
-                    "duration": result.get('timings', {}).get('inference', 0),
-                    "credits_used": result.get('credits_used', 0)
-                }
-            }
-            
-            logger.info(f"生成成功，返回 {len(response_data['images'])} 张图像")
-            return jsonify(response_data), 200
+            response_data, status, cache_status = generate_image_cached(data, payload)
+            response = jsonify(response_data)
+            response.headers['X-Cache'] = cache_status
+            if status in (429, 503) and 'retry_after' in response_data:
+                response.headers['Retry-After'] = str(math.ceil(response_data['retry_after']))
+            return response, status
             
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
         except KeyError as e:
             logger.error(f"参数错误：{str(e)}")
             return jsonify({"error": f"缺少必要参数：{str(e)}"}), 400
@@ -400,6 +638,212 @@ def create_app():
             logger.error(f"生成失败：{str(e)}", exc_info=True)
             return jsonify({"error": "图像生成失败"}), 500
 
+    @app.route('/api/generate/batch', methods=['POST'])
+    def generate_batch():
+        """批量生成图像，每个条目完成后立即以 NDJSON 行（或 SSE 事件）返回
+
+        单个条目的参数错误或生成失败只体现在该条目的结果中，不影响其他条目。
+        """
+        try:
+            items = parse_image_batch(request.get_json(force=True, silent=True))
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+
+        use_sse = request.args.get('format') == 'sse' or \
+            request.accept_mimetypes.best_match(['application/x-ndjson', 'text/event-stream']) == 'text/event-stream'
+        logger.info("收到批量图像生成请求，条目数: %d，格式: %s", len(items), 'sse' if use_sse else 'ndjson')
+
+        # 先校验全部条目，参数错误的条目直接返回结果
+        invalid, runnable = [], []
+        for index, data in enumerate(items):
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError("条目必须是对象")
+                payload = build_image_payload(data)
+                runnable.append((index, payload['model'], data, payload))
+            except ValueError as e:
+                invalid.append({"index": index, "status": 400, "error": str(e)})
+
+        def run_item(params):
+            data, payload = params
+            return generate_image_cached(data, payload, batchable=True)
+
+        def results():
+            yield from invalid
+            tasks = [(model, (data, payload)) for _, model, data, payload in runnable]
+            for position, outcome in image_batch_runner.run(tasks, run_item):
+                index = runnable[position][0]
+                if isinstance(outcome, Exception):
+                    yield {"index": index, "status": 500, "error": "图像生成失败"}
+                else:
+                    body, status, cache_status = outcome
+                    yield {"index": index, "status": status, "cache": cache_status, **body}
+
+        def stream():
+            writer = SSEWriter() if use_sse else None
+            succeeded = failed = 0
+            started = time.time()
+            try:
+                for result in results():
+                    if result['status'] == 200:
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    if writer is not None:
+                        yield writer.event(result)
+                    else:
+                        yield json.dumps(result, ensure_ascii=False) + '\n'
+                summary = {"done": True, "total": len(items), "succeeded": succeeded, "failed": failed}
+                if writer is not None:
+                    yield writer.event(summary) + writer.done()
+                else:
+                    yield json.dumps(summary) + '\n'
+            finally:
+                logger.info("批量图像生成结束，成功 %d，失败 %d，共 %d，耗时 %.2f秒",
+                            succeeded, failed, len(items), time.time() - started)
+
+        return Response(
+            stream(),
+            mimetype='text/event-stream' if use_sse else 'application/x-ndjson',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    @app.route('/api/jobs/images', methods=['POST'])
+    def submit_image_job():
+        """提交异步图像生成任务，立即返回任务ID"""
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "请求体为空或不是有效的 JSON"}), 400
+        try:
+            payload = build_image_payload(data)
+            deadline = data.get('deadline')
+            if deadline is not None:
+                deadline = min(max(float(deadline), 1), IMAGE_JOB_CONFIG['deadline'])
+        except (TypeError, ValueError) as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+
+        def run(remaining):
+            # 上游调用不超过任务剩余的截止时间
+            body, status, _ = generate_image_cached(data, payload, batchable=True, timeout=remaining)
+            return body, status
+
+        try:
+            job_id = image_job_executor.submit(data, run, deadline)
+        except JobQueueFull as e:
+            logger.warning(str(e))
+            response = jsonify({"error": "图像任务队列已满，请稍后重试"})
+            response.headers['Retry-After'] = '5'
+            return response, 429
+
+        logger.info("图像任务 %s 已提交，模型: %s", job_id, payload['model'])
+        response = jsonify({
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/api/jobs/{job_id}",
+            "events_url": f"/api/jobs/{job_id}/events",
+        })
+        response.headers['Location'] = f"/api/jobs/{job_id}"
+        return response, 202
+
+    @app.route('/api/jobs/stats', methods=['GET'])
+    def image_job_stats():
+        """图像任务的统计信息（所有worker共享）"""
+        return jsonify(image_job_store.stats())
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def get_image_job(job_id):
+        job = image_job_store.get(job_id)
+        if job is None:
+            return jsonify({"error": "任务不存在或已过期"}), 404
+        return jsonify(job)
+
+    @app.route('/api/jobs/<job_id>/events', methods=['GET'])
+    def image_job_events(job_id):
+        """以SSE推送任务状态变化，任务结束后发送结果并关闭
+
+        每个连接占用一个同步worker，因此所有worker合计的连接数有上限；
+        连接超过 events_max_duration 后发送 reconnect 事件并关闭，由客户端重新连接或改为查询任务状态。
+        """
+        if image_job_store.get(job_id) is None:
+            return jsonify({"error": "任务不存在或已过期"}), 404
+
+        slot = image_job_event_slots.acquire()
+        if slot is None:
+            logger.warning(f"任务进度流连接数已达上限: {job_id}")
+            response = jsonify({"error": "任务进度流连接数已达上限，请稍后重试或查询任务状态",
+                                "status_url": f"/api/jobs/{job_id}"})
+            response.status_code = 429
+            response.headers['Retry-After'] = '5'
+            return response
+
+        def events():
+            writer = SSEWriter()
+            last = None
+            started = time.monotonic()
+            try:
+                while True:
+                    job = image_job_store.get(job_id)
+                    if job is None:
+                        yield writer.event({"job_id": job_id, "error": "任务不存在或已过期"})
+                        break
+                    state = (job['status'], job.get('position'))
+                    if state != last:
+                        last = state
+                        yield writer.event(job)
+                    if job['status'] in FINISHED_STATES:
+                        break
+                    if time.monotonic() - started >= IMAGE_JOB_CONFIG['events_max_duration']:
+                        yield writer.event({"job_id": job_id, "type": "reconnect"})
+                        return
+                    time.sleep(IMAGE_JOB_CONFIG['poll_interval'])
+                yield writer.done()
+            finally:
+                slot.close()
+
+        return Response(
+            events(),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    @app.route('/api/generate/cache', methods=['GET'])
+    def image_cache_stats():
+        """图像结果缓存的统计信息（当前worker）"""
+        return jsonify(image_cache.stats())
+
+    @app.route('/api/generate/batching', methods=['GET'])
+    def micro_batch_stats():
+        """微批处理的合并次数以及 batch_size 和等待时间的直方图（当前worker）"""
+        return jsonify(micro_batcher.stats())
+
+    @app.route('/api/upstream/governor', methods=['GET'])
+    def upstream_governor_stats():
+        """上游节流器的状态：各密钥和模型的当前速率、暂停时间、排队等待时间直方图（当前worker）"""
+        return jsonify(governor.stats())
+
+    @app.route('/api/upstream/resilience', methods=['GET'])
+    def upstream_resilience_stats():
+        """上游调用的重试次数、重试预算和各接口熔断器的状态（当前worker）"""
+        return jsonify(resilience.stats())
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Prometheus 格式的指标，汇总所有worker"""
+        return Response(metrics_registry.render(), content_type=CONTENT_TYPE)
+
+    @app.route('/api/rate_limits', methods=['GET'])
+    def rate_limit_stats():
+        """速率限制的放行和拒绝次数以及当前计数的键数量（所有worker）"""
+        return jsonify(rate_limiter.stats())
+
     @app.route('/api/download', methods=['GET'])
     def download_proxy():
         try:
@@ -413,31 +857,21 @@ def create_app():
                 'sc-maas.oss-cn-shanghai.aliyuncs.com',
                 'cdn.siliconflow.com'
             ]
-            if not any(domain in image_url for domain in allowed_domains):
+            # 按主机名校验，避免 http://其他主机/cdn.siliconflow.com/... 这类地址写入缓存
+            if urlparse(image_url).hostname not in allowed_domains:
                 return jsonify({"error": "非法的图片地址"}), 403
             
-            # 设置合理的超时时间和请求头
-            response = requests.get(
-                image_url,
-                timeout=10,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-                },
-                stream=True
-            )
-            response.raise_for_status()
+            # 从本地缓存获取，未命中时下载到缓存
+            cached = download_cache.fetch(image_url)
             
             # 获取文件名
             filename = image_url.split('/')[-1].split('?')[0]
-            
-            return Response(
-                response.iter_content(chunk_size=8192),
-                mimetype=response.headers.get('Content-Type', 'application/octet-stream'),
-                headers={
-                    'Content-Disposition': f'attachment; filename="{filename}"',
-                    'Cache-Control': 'max-age=3600'
-                }
-            )
+            try:
+                return serve_cached_download(cached, filename)
+            except FileNotFoundError:
+                # 文件在查找之后被其他worker淘汰，重新获取一次
+                logger.warning("缓存文件在发送前被删除，重新获取: %s", cached.relative_path)
+                return serve_cached_download(download_cache.fetch(image_url), filename)
         except requests.exceptions.Timeout:
             logger.error("下载超时")
             return jsonify({"error": "下载超时"}), 504
@@ -445,17 +879,19 @@ def create_app():
             logger.error(f"下载失败: {str(e)}")
             return jsonify({"error": f"图片下载失败: {str(e)}"}), 500
 
+    @app.route('/api/download/cache', methods=['GET'])
+    def download_cache_stats():
+        """下载缓存的统计信息（所有worker共享）"""
+        return jsonify(download_cache.stats())
+
     @app.route('/api/stop', methods=['POST'])
     def stop_generation():
         try:
             data = request.get_json()
             session_id = data.get('session_id')
             
-            if session_id in session_stop_events:
-                # 设置停止事件
-                session_stop_events[session_id].set()
-                # 清理事件
-                del session_stop_events[session_id]
+            # 设置停止标记，正在输出该会话的worker（可能是其他进程）会在下一次检查时停止
+            if session_store.request_stop(session_id):
                 return jsonify({"status": "success", "message": "已停止生成"})
             
             return jsonify({"status": "not_found", "message": "未找到对应的会话"}), 404
@@ -468,19 +904,13 @@ def create_app():
     def chat():
         """处理用户的聊天请求"""
         start_time = time.time()
+        trace = request.trace
         
         try:
-            if request.method == 'GET':
-                session_id = request.args.get('session_id')
-                user_input = request.args.get('user_input')
-                history = None
-                system_prompt = request.args.get('system_prompt')
-            else:
-                data = request.get_json()
-                session_id = data.get('session_id')
-                user_input = data.get('user_input')
-                history = data.get('history')
-                system_prompt = data.get('system_prompt')
+            with trace.span('parse_request'):
+                params = parse_chat_request(request.method, request.args, request.get_json() if request.method == 'POST' else None)
+            session_id = params['session_id']
+            user_input = params['user_input']
 
             if not session_id or not user_input:
                 return jsonify({"error": "缺少必要参数"}), 400
@@ -488,71 +918,44 @@ def create_app():
             # 更新会话活动时间
             update_session_activity(session_id)
             
-            # 为新会话创建停止事件
-            stop_event = Event()
-            session_stop_events[session_id] = stop_event
+            # 为新会话创建停止信号
+            stop_event = session_store.begin_stream(session_id)
 
-            # 构建消息历史
-            messages = []
-            
-            # 如果提供了系统提示词，添加为系统消息
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-                chat_logger.debug(f"使用系统提示词: {system_prompt[:100]}{'...' if len(system_prompt) > 100 else ''}")
-            
-            # 如果前端传来了历史记录，使用前端的历史
-            history_source = "none"
-            if history:
-                history_source = "frontend"
-                for msg in history:
-                    messages.append({
-                        "role": msg.get("role"),
-                        "content": msg.get("content")
-                    })
-            # 否则从服务器存储的历史中获取
-            elif session_id in chat_histories:
-                history_source = "server"
-                messages = [{"role": msg["role"], "content": msg["content"]} for msg in chat_histories[session_id]]
-            
-            # 添加当前用户消息
-            messages.append({"role": "user", "content": user_input})
-            
-            # 获取用户选择的模型
-            model = "deepseek-ai/DeepSeek-V2.5"  # 默认模型
-            if request.method == 'POST' and data.get('model'):
-                model = data.get('model')
-                
-            # 构造请求参数
-            payload = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 2000,
-                "stream": True
-            }
+            with trace.span('build_messages'):
+                # 构建消息历史
+                messages, history_source = build_chat_messages(
+                    session_id, user_input, params['history'], params['system_prompt'])
+
+                # 构造请求参数
+                payload = build_chat_payload(messages, params['model'])
 
             # 详细记录聊天请求
-            chat_logger.info(f"开始聊天请求 | 会话ID: {session_id} | 历史来源: {history_source} | 消息数量: {len(messages)}")
-            chat_logger.debug(f"用户输入: {user_input[:100]}{'...' if len(user_input) > 100 else ''}")
-            chat_logger.debug(f"历史消息数: {len(messages) - 1}")
+            chat_logger.info("开始聊天请求 | 会话ID: %s | 历史来源: %s | 消息数量: %d/%d", session_id, history_source, len(payload['messages']), len(messages))
+            log_payload(chat_logger, logging.DEBUG, "用户输入", user_input)
+            chat_logger.debug("历史消息数: %d", len(payload['messages']) - 1)
             
-            client = LoggingSiliconFlowClient()
-            response = client.chat_completion(payload)
+            with trace.span('client_init'):
+                client = LoggingSiliconFlowClient()
+            try:
+                response = client.chat_completion(payload)
+            except Exception:
+                session_store.end_stream(session_id, stop_event)
+                raise
+
+            request_started = request.start_time
+            traced = trace.sampled
 
             def generate():
+                writer = SSEWriter()
+                stream_metrics = ChatStreamMetrics(request_started)
+                chunk_count = 0
                 try:
                     # 首先返回用户的消息
-                    yield f"data: {json.dumps({'type': 'user', 'content': user_input}, ensure_ascii=False)}\n\n"
+                    yield writer.event({'type': 'user', 'content': user_input})
                     
-                    accumulated_content = ""
-                    in_code_block = False
-                    current_lang = None
-                    code_block_content = ""
-                    code_block_start = False
-                    newline = "\n"  # 预定义换行符
+                    formatter = ReplyFormatter(session_id)
                     response_start_time = time.time()
                     last_log_time = time.time()
-                    chunk_count = 0
                     
                     for chunk in response:
                         chunk_count += 1
@@ -560,107 +963,64 @@ def create_app():
                         
                         # 每隔5秒或每100个块记录一次进度
                         if chunk_count % 100 == 0 or current_time - last_log_time > 5:
-                            chat_logger.debug(f"会话 {session_id} 生成中，已处理 {chunk_count} 个块，累积内容长度: {len(accumulated_content)}")
+                            chat_logger.debug("会话 %s 生成中，已处理 %d 个块，累积内容长度: %d", session_id, chunk_count, formatter.length)
                             last_log_time = current_time
                             
                         if stop_event.is_set():
-                            chat_logger.info(f"会话 {session_id} 被用户终止，已生成 {len(accumulated_content)} 字符")
+                            chat_logger.info(f"会话 {session_id} 被用户终止，已生成 {formatter.length} 字符")
+                            stream_metrics.outcome = 'stopped'
                             break
 
                         if chunk and 'choices' in chunk and chunk['choices']:
                             content = chunk['choices'][0].get('delta', {}).get('content', '')
                             if content:
-                                accumulated_content += content
-                                
-                                # 处理代码块开始
-                                if '```' in content and not in_code_block:
-                                    parts = content.split('```', 1)
-                                    if len(parts) > 1:
-                                        # 发送代码块前的内容
-                                        if parts[0]:
-                                            yield f"data: {json.dumps({'type': 'assistant', 'reply': parts[0]}, ensure_ascii=False)}\n\n"
-                                        
-                                        # 处理语言标记
-                                        remaining = parts[1]
-                                        lang_end = remaining.find('\n')
-                                        if lang_end != -1:
-                                            current_lang = remaining[:lang_end].strip()
-                                            code_block_content = remaining[lang_end+1:]
-                                        else:
-                                            current_lang = remaining.strip()
-                                            code_block_content = ""
-                                        
-                                        in_code_block = True
-                                        code_block_start = True
-                                        
-                                        # 记录代码块开始
-                                        chat_logger.debug(f"会话 {session_id} 开始代码块，语言: {current_lang}")
-                                        
-                                        # 发送代码块开始标记
-                                        lang_marker = '```' + (current_lang if current_lang else '')
-                                        yield f"data: {json.dumps({'type': 'assistant', 'reply': lang_marker}, ensure_ascii=False)}\n\n"
-                                        # 单独发送换行符
-                                        yield f"data: {json.dumps({'type': 'assistant', 'reply': newline}, ensure_ascii=False)}\n\n"
-                                        if code_block_content:
-                                            yield f"data: {json.dumps({'type': 'assistant', 'reply': code_block_content}, ensure_ascii=False)}\n\n"
-                                        continue
-                                
-                                # 处理代码块结束
-                                if '```' in content and in_code_block:
-                                    parts = content.split('```', 1)
-                                    code_block_content = parts[0]
-                                    if code_block_content:
-                                        yield f"data: {json.dumps({'type': 'assistant', 'reply': code_block_content}, ensure_ascii=False)}\n\n"
-                                        # 分开发送结束标记和换行符
-                                        yield f"data: {json.dumps({'type': 'assistant', 'reply': '```'}, ensure_ascii=False)}\n\n"
-                                        yield f"data: {json.dumps({'type': 'assistant', 'reply': newline}, ensure_ascii=False)}\n\n"
-                                        if len(parts) > 1 and parts[1]:
-                                            yield f"data: {json.dumps({'type': 'assistant', 'reply': parts[1]}, ensure_ascii=False)}\n\n"
-                                        
-                                        # 记录代码块结束
-                                        chat_logger.debug(f"会话 {session_id} 结束代码块，代码长度: {len(code_block_content)}")
-                                        
-                                        in_code_block = False
-                                        current_lang = None
-                                        code_block_content = ""
-                                        continue
-                                
-                                # 处理代码块内的内容
-                                if in_code_block:
-                                    code_block_content += content
-                                    yield f"data: {json.dumps({'type': 'assistant', 'reply': content}, ensure_ascii=False)}\n\n"
-                                    continue
-                                
-                                # 处理普通文本
-                                yield f"data: {json.dumps({'type': 'assistant', 'reply': content}, ensure_ascii=False)}\n\n"
+                                stream_metrics.delta()
+                                if traced and stream_metrics.deltas == 1:
+                                    trace.add('first_delta', request_started, stream_metrics.first_delta)
+                            if traced:
+                                fence_started = time.perf_counter()
+                                fragments = formatter.feed(content)
+                                trace.add('fence', fence_started, time.perf_counter())
+                            else:
+                                fragments = formatter.feed(content)
+                            for fragment in fragments:
+                                frame = writer.assistant(fragment)
+                                if frame:
+                                    yield frame
                     
+                    # 发送暂存的不完整代码块标记和合并窗口中剩余的内容
+                    for fragment in formatter.flush():
+                        frame = writer.assistant(fragment)
+                        if frame:
+                            yield frame
+                    frame = writer.flush()
+                    if frame:
+                        yield frame
+
                     response_time = time.time() - response_start_time
+                    if stream_metrics.outcome == 'cancelled':
+                        stream_metrics.outcome = 'completed'
                     
                     # 获取最后的AI回复并保存到聊天历史
+                    accumulated_content = formatter.text
                     if accumulated_content:
-                        # 初始化会话历史（如果不存在）
-                        if session_id not in chat_histories:
-                            chat_histories[session_id] = []
-                        
-                        # 添加用户消息和AI回复到历史
-                        chat_histories[session_id].append({"role": "user", "content": user_input})
-                        chat_histories[session_id].append({"role": "assistant", "content": accumulated_content})
-                        
-                        # 限制历史记录长度
-                        trim_chat_history(session_id)
+                        history_length = save_chat_turn(session_id, user_input, accumulated_content)
                         
                         # 详细记录完成的聊天
-                        chat_logger.info(f"会话 {session_id} 完成 | 响应时间: {response_time:.2f}秒 | 生成字符: {len(accumulated_content)} | 历史长度: {len(chat_histories[session_id])}")
+                        chat_logger.info(f"会话 {session_id} 完成 | 响应时间: {response_time:.2f}秒 | 生成字符: {len(accumulated_content)} | 历史长度: {history_length}")
                         
                 except Exception as e:
+                    stream_metrics.outcome = 'error'
                     chat_logger.error(f"会话 {session_id} 流式输出错误：{str(e)}", exc_info=True)
-                    yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+                    yield writer.event({'error': str(e)})
                 finally:
-                    if session_id in session_stop_events:
-                        del session_stop_events[session_id]
-                    yield "data: [DONE]\n\n"
+                    stream_metrics.chunks = chunk_count
+                    stream_metrics.finish()
+                    session_store.end_stream(session_id, stop_event)
+                    yield writer.done()
                     total_time = time.time() - start_time
-                    chat_logger.info(f"会话 {session_id} 总处理时间: {total_time:.2f}秒")
+                    sse_stats = writer.stats()
+                    chat_logger.info(f"会话 {session_id} 总处理时间: {total_time:.2f}秒 | 片段: {sse_stats['fragments']} | 帧: {sse_stats['frames']} | 字节: {sse_stats['bytes']}")
 
             return Response(
                 stream_with_context(generate()),
@@ -686,8 +1046,7 @@ def create_app():
             data = request.get_json()
             session_id = data.get('session_id')
             
-            if session_id in chat_histories:
-                del chat_histories[session_id]
+            if session_store.clear(session_id):
                 return jsonify({"status": "success", "message": "会话历史已清除"})
             
             return jsonify({"status": "not_found", "message": "未找到对应的会话"}), 404
@@ -700,8 +1059,13 @@ def create_app():
     def get_models():
         """获取可用模型列表"""
         try:
-            logger.info("请求获取模型列表")
-            return jsonify(DEFAULT_MODELS)
+            snapshot = model_catalog.get()
+            logger.info("请求获取模型列表，来源: %s", snapshot.source)
+            response = jsonify(snapshot.body)
+            # 前端用 If-None-Match 重新验证，目录未变化时返回 304
+            response.set_etag(snapshot.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
         except Exception as e:
             logger.error(f"获取模型列表失败: {str(e)}", exc_info=True)
             return jsonify({"error": "获取模型列表失败", "detail": str(e)}), 500
@@ -743,40 +1107,149 @@ def create_app():
 
     @app.route('/api/logs/<log_type>/download', methods=['GET'])
     def download_log(log_type):
-        """下载指定类型的日志文件"""
+        """下载指定类型的日志文件
+
+        默认发送未压缩的当前日志，支持 Range 断点续传；compress=gzip 时边读边压缩发送；
+        bundle=true 时把当前日志和所有轮转备份打包为流式生成的 tar.gz，不在磁盘上生成临时文件。
+        """
         # 获取API日志记录器
         api_logger.info(f"请求下载日志文件: {log_type}")
         
         # 验证日志类型
-        valid_log_types = ['app', 'error', 'api', 'chat']
+        valid_log_types = LOG_TYPES
         if log_type not in valid_log_types:
             api_logger.warning(f"无效的日志类型下载请求: {log_type}")
             return jsonify({"error": f"无效的日志类型: {log_type}，可用类型为: {', '.join(valid_log_types)}"}), 400
         
         # 构建日志文件路径
-        log_file_path = f"/app/logs/{log_type}.log"
+        log_file_path = log_reader.log_dir / f"{log_type}.log"
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        bundle = request.args.get('bundle', '').lower() in ('1', 'true')
+        compress = request.args.get('compress', '').lower()
+        if compress not in ('', 'gzip'):
+            return jsonify({"error": f"不支持的压缩格式: {compress}"}), 400
         
         try:
+            if bundle:
+                segments = log_reader.segments(log_type)
+                if not segments:
+                    return jsonify({"error": f"日志文件 {log_type}.log 不存在"}), 404
+                # 先打开所有文件，打包过程中发生轮转也能读到完整的内容
+                members = [(s.name[:-3] if s.name.endswith('.gz') else s.name, s.size, s.index.open()) for s in segments]
+                return Response(
+                    gzip_stream(tar_stream(members)),
+                    mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={log_type}_{timestamp}.tar.gz'}
+                )
+
             if not os.path.exists(log_file_path):
                 api_logger.warning(f"日志文件不存在: {log_file_path}")
                 return jsonify({"error": f"日志文件 {log_type}.log 不存在"}), 404
-            
-            # 生成带有时间戳的文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            download_filename = f"{log_type}_{timestamp}.log"
-            
-            # 设置响应头以触发下载
+
+            if compress == 'gzip':
+                log_file = open(log_file_path, 'rb')
+                size = os.fstat(log_file.fileno()).st_size
+
+                def compressed():
+                    with log_file:
+                        yield from gzip_stream(file_chunks(log_file, size))
+
+                return Response(
+                    compressed(),
+                    mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={log_type}_{timestamp}.log.gz'}
+                )
+
+            # 未压缩的下载由 send_file 处理 Range 和 If-Range，支持断点续传
             return send_file(
                 log_file_path,
                 mimetype='text/plain',
                 as_attachment=True,
-                download_name=download_filename
+                download_name=f"{log_type}_{timestamp}.log",
+                conditional=True
             )
             
         except Exception as e:
             api_logger.error(f"下载日志失败: {str(e)}", exc_info=True)
             return jsonify({"error": f"下载日志失败: {str(e)}"}), 500
 
+    @app.route('/api/logs/<log_type>/query', methods=['GET'])
+    def query_logs(log_type):
+        """按级别、日志器、时间范围、会话ID和关键字查询日志记录（包括轮转备份），按游标分页"""
+        if log_type not in LOG_TYPES:
+            return jsonify({"error": f"无效的日志类型: {log_type}，可用类型为: {', '.join(LOG_TYPES)}"}), 400
+
+        args = request.args
+        try:
+            query = LogQuery(
+                level=args.get('level'),
+                logger_name=args.get('logger'),
+                since=args.get('since'),
+                until=args.get('until'),
+                session_id=args.get('session_id'),
+                text=args.get('q'),
+            )
+            result = log_searcher.search(log_type, query, cursor=args.get('cursor'), limit=args.get('limit', type=int))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            api_logger.error(f"查询日志失败: {str(e)}", exc_info=True)
+            return jsonify({"error": f"查询日志失败: {str(e)}"}), 500
+
+        api_logger.info(f"查询日志 {log_type}，返回 {result['count']} 条记录")
+        return jsonify({"log_type": log_type, **result})
+
+    @app.route('/api/logs/<log_type>/stream', methods=['GET'])
+    def stream_logs(log_type):
+        """以SSE推送日志文件新追加的行；断线重连时从 Last-Event-ID 对应的位置继续"""
+        if log_type not in LOG_TYPES:
+            return jsonify({"error": f"无效的日志类型: {log_type}，可用类型为: {', '.join(LOG_TYPES)}"}), 400
+        segments = log_reader.segments(log_type)
+        if not segments or segments[-1].name != f"{log_type}.log":
+            return jsonify({"error": f"日志文件 {log_type}.log 不存在"}), 404
+
+        backlog = []
+        try:
+            position = request.headers.get('Last-Event-ID') or request.args.get('position')
+            if position:
+                inode, offset = parse_position(position)
+            else:
+                # 先补发当前文件最后 backlog 行，再从这些行之后开始跟踪
+                current = segments[-1]
+                count = min(max(0, request.args.get('backlog', default=0, type=int)), LOG_TAIL_CONFIG['backlog_max'], current.lines)
+                backlog = current.index.read_lines(current.lines - count, current.lines)
+                inode, offset = current.inode, current.index.indexed_bytes
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        slot = log_tail_slots.acquire()
+        if slot is None:
+            api_logger.warning(f"日志订阅数已达上限: {log_type}")
+            response = jsonify({"error": "日志订阅数已达上限，请稍后重试"})
+            response.status_code = 429
+            response.headers['Retry-After'] = '5'
+            return response
+
+        follower = LogFollower(log_reader.log_dir / f"{log_type}.log", inode, offset,
+                               backups=[log_reader.log_dir / s.name for s in reversed(segments[:-1])
+                                        if not s.index.compressed])
+
+        def events():
+            try:
+                yield from tail_events(follower, backlog)
+            finally:
+                follower.close()
+                slot.close()
+
+        return Response(
+            events(),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
     @app.route('/api/logs/<log_type>', methods=['GET'])
     def get_logs(log_type):
         """获取指定类型的日志文件内容"""
@@ -784,7 +1257,7 @@ def create_app():
         api_logger.info(f"请求获取日志文件: {log_type}")
         
         # 验证日志类型
-        valid_log_types = ['app', 'error', 'api', 'chat']
+        valid_log_types = LOG_TYPES
         if log_type not in valid_log_types:
             api_logger.warning(f"无效的日志类型请求: {log_type}")
             return jsonify({"error": f"无效的日志类型: {log_type}，可用类型为: {', '.join(valid_log_types)}"}), 400
@@ -793,91 +1266,31 @@ def create_app():
         lines = request.args.get('lines', default=100, type=int)
         lines = min(max(10, lines), 1000)  # 限制行数在10-1000行内
         
-        start_line = request.args.get('start_line', default=0, type=int)
-        start_line = max(0, start_line)  # 确保不是负数
-        
-        # 构建日志文件路径
-        log_file_path = f"/app/logs/{log_type}.log"
-        
+        # start_line 为整个视图（包括轮转备份）中的行号；cursor 为上一页返回的游标，direction=backward 时向前翻页
+        start_line = request.args.get('start_line', type=int)
+        cursor = request.args.get('cursor')
+        backward = request.args.get('direction') == 'backward'
+        if start_line is None and cursor is None and not backward:
+            start_line = 0  # 默认从最早的一行开始；direction=backward 且没有游标时返回最后一页
+
         try:
-            if not os.path.exists(log_file_path):
-                api_logger.warning(f"日志文件不存在: {log_file_path}")
+            if not log_reader.files(log_type):
+                api_logger.warning(f"日志文件不存在: {log_type}.log")
                 return jsonify({"error": f"日志文件 {log_type}.log 不存在"}), 404
-            
-            # 获取文件的总行数
-            with open(log_file_path, 'r', encoding='utf-8') as f:
-                total_lines = sum(1 for _ in f)
-            
-            # 如果请求的起始行超过了文件总行数，则从文件末尾开始读取
-            if start_line >= total_lines:
-                start_line = max(0, total_lines - lines)
-            
-            # 读取指定行数的日志
-            if start_line == 0 and lines >= total_lines:
-                # 请求读取整个文件
-                with open(log_file_path, 'r', encoding='utf-8') as f:
-                    log_content = f.read()
-                    line_count = total_lines
-            else:
-                # 读取指定的行
-                result_lines = []
-                current_line = 0
-                with open(log_file_path, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        if current_line >= start_line:
-                            result_lines.append(line)
-                            if len(result_lines) >= lines:
-                                break
-                        current_line += 1
-                log_content = ''.join(result_lines)
-                line_count = len(result_lines)
-            
-            # 返回日志内容和元数据
-            response_data = {
-                "log_type": log_type,
-                "content": log_content,
-                "lines_read": line_count,
-                "total_lines": total_lines,
-                "start_line": start_line,
-                "next_start_line": start_line + line_count if start_line + line_count < total_lines else None,
-                "file_size": os.path.getsize(log_file_path),
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            api_logger.info(f"成功读取日志 {log_type}，返回 {line_count}/{total_lines} 行")
+
+            # 通过行偏移索引直接定位到请求的行，不再逐行扫描整个文件
+            page = log_reader.read(log_type, start=start_line, lines=lines, cursor=cursor, backward=backward)
+            response_data = {"log_type": log_type, **page, "timestamp": datetime.now().isoformat()}
+
+            api_logger.info(f"成功读取日志 {log_type}，返回 {page['lines_read']}/{page['total_lines']} 行")
             return jsonify(response_data)
-            
+
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
             api_logger.error(f"获取日志失败: {str(e)}", exc_info=True)
             return jsonify({"error": f"获取日志失败: {str(e)}"}), 500
 
-    @app.after_request
-    def log_response_info(response):
-        """记录响应信息"""
-        if request.path.startswith('/api/'):
-            status_code = response.status_code
-            response_size = response.calculate_content_length() if hasattr(response, 'calculate_content_length') else len(response.get_data(as_text=True))
-            
-            # 根据状态码确定日志级别
-            if status_code >= 500:
-                log_method = api_logger.error
-            elif status_code >= 400:
-                log_method = api_logger.warning
-            else:
-                log_method = api_logger.info
-                
-            log_method(f"API响应 | 方法: {request.method} | 路径: {request.path} | 状态码: {status_code} | 大小: {response_size} 字节")
-            
-            # 对于错误响应，记录更多详情
-            if status_code >= 400 and response.is_json:
-                try:
-                    error_data = json.loads(response.get_data(as_text=True))
-                    api_logger.debug(f"错误响应: {error_data}")
-                except Exception:
-                    pass
-        
-        return response
-
     return app
 
 app = create_app()
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""ASGI 入口
+
+/api/chat 和 /api/generate 直接在事件循环上处理，一个 worker 可以同时保持大量等待上游输出的流式连接；
+其余路由通过 WsgiToAsgi 交给原有的 Flask 应用处理。
+
+启动方式: gunicorn -k uvicorn.workers.UvicornWorker src.asgi:app
+"""
+import asyncio
+import json
+import math
+import sqlite3
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from .app import (
+    app as flask_app,
+    logger,
+    api_logger,
+    chat_logger,
+    CHAT_CONFIG,
+    session_store,
+    update_session_activity,
+    parse_chat_request,
+    build_chat_messages,
+    build_chat_payload,
+    save_chat_turn,
+    build_image_payload,
+    image_result_body,
+    image_cache,
+    use_image_cache,
+    rate_limiter,
+    tracer,
+)
+from .api_client import AsyncSiliconFlowClient
+from .chat_stream import ReplyFormatter
+from .sse import SSEWriter
+from .metrics import CACHE_REQUESTS, HTTP_REQUEST_DURATION, ChatStreamMetrics
+from .tracing import REQUEST_ID_HEADER, current_trace
+from .middleware.rate_limit import RATE_LIMIT_CONFIG, build_checks, client_ip, route_limits
+
+
+def _get_header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _cors_headers(scope):
+    """与 Flask 应用中 add_cors_headers 保持一致的跨域响应头"""
+    origin = _get_header(scope, b'origin') or '*'
+    return [
+        (b'access-control-allow-origin', origin.encode('latin-1')),
+        (b'access-control-allow-headers', b'Content-Type,Authorization,X-Requested-With,Accept,Origin'),
+        (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS'),
+        (b'access-control-allow-credentials', b'true'),
+        (b'access-control-max-age', b'3600'),
+    ]
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def _send_json(scope, send, status, data, headers=()):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers,
+            *_cors_headers(scope),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _rate_limit_headers(decision):
+    return [(name.lower().encode(), value.encode()) for name, value in decision.headers().items()]
+
+
+def _with_headers(send, headers):
+    """在响应开始时追加额外的响应头"""
+    async def wrapped(message):
+        if message['type'] == 'http.response.start':
+            message = {**message, 'headers': [*message.get('headers', []), *headers]}
+        await send(message)
+    return wrapped
+
+
+def _capture_status(send, status):
+    """记录响应的状态码，用于请求耗时指标"""
+    async def wrapped(message):
+        if message['type'] == 'http.response.start':
+            status[0] = message['status']
+        await send(message)
+    return wrapped
+
+
+async def _watch_disconnect(receive, stop_event, stopped):
+    """客户端断开连接时设置停止事件，及时释放上游流"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            stop_event.set()
+            stopped.set()
+            return
+
+
+class StopPoller:
+    """每个worker一个后台任务，统一轮询所有正在输出的流的停止信号
+
+    其他worker发出的停止请求需要查询 SQLite，不能在事件循环上执行；
+    每个间隔只把一次检查交给线程池，而不是每个流各自轮询。没有正在输出的流时任务结束。
+    """
+
+    def __init__(self, interval=None):
+        self.interval = CHAT_CONFIG['stop_poll_interval'] if interval is None else interval
+        self._streams = {}
+        self._task = None
+
+    def watch(self, stop_event) -> asyncio.Event:
+        """登记一个流的停止信号，返回停止时被设置的 asyncio.Event"""
+        stopped = asyncio.Event()
+        self._streams[stop_event] = stopped
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+        return stopped
+
+    def unwatch(self, stop_event):
+        self._streams.pop(stop_event, None)
+
+    async def _run(self):
+        while self._streams:
+            await asyncio.sleep(self.interval)
+            signals = list(self._streams)
+            for signal in await asyncio.to_thread(lambda: [signal for signal in signals if signal.is_set()]):
+                stopped = self._streams.get(signal)
+                if stopped is not None:
+                    stopped.set()
+
+
+async def _until_stopped(stream, stopped):
+    """逐个产出上游的数据块；stopped 先于下一个数据块被设置时立即结束，不再等待上游"""
+    stop = asyncio.ensure_future(stopped.wait())
+    try:
+        while True:
+            chunk = asyncio.ensure_future(stream.__anext__())
+            await asyncio.wait((chunk, stop), return_when=asyncio.FIRST_COMPLETED)
+            if stop.done():
+                # 取消正在等待的读取，上游生成器在 finally 中关闭响应
+                chunk.cancel()
+                await asyncio.gather(chunk, return_exceptions=True)
+                return
+            try:
+                item = chunk.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        stop.cancel()
+
+
+class AsyncChatApp:
+    """在事件循环上处理聊天和图像生成请求的 ASGI 应用"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+        self.client = AsyncSiliconFlowClient()
+        self.limits = route_limits()
+        self.stops = StopPoller()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            path, method = scope['path'], scope['method']
+            handler = None
+            if path == '/api/chat' and method in ('GET', 'POST'):
+                handler = self.chat
+            elif path == '/api/generate' and method == 'POST':
+                handler = self.generate
+            if handler is not None:
+                started = time.perf_counter()
+                status = [500]
+                trace = tracer.begin(f"{method} {path}", _get_header(scope, REQUEST_ID_HEADER.lower().encode()),
+                                     force=_get_header(scope, b'x-trace') == '1')
+                send = _with_headers(_capture_status(send, status),
+                                     [(REQUEST_ID_HEADER.lower().encode(), trace.request_id.encode())])
+                try:
+                    decision = await self._check_rate_limit(scope)
+                    if decision is None:
+                        await handler(scope, receive, send)
+                    elif not decision.allowed:
+                        await _send_json(scope, send, 429, {"error": "请求过于频繁，请稍后重试",
+                                                            "retry_after": math.ceil(decision.retry_after)},
+                                         _rate_limit_headers(decision))
+                    else:
+                        await handler(scope, receive, _with_headers(send, _rate_limit_headers(decision)))
+                finally:
+                    finished = time.perf_counter()
+                    HTTP_REQUEST_DURATION.observe(finished - started, route=path, method=method, status=status[0])
+                    if trace.sampled:
+                        trace.add('request', started, finished, method=method, path=path, status=status[0])
+                        await asyncio.to_thread(tracer.finish, trace)
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                logger.info("ASGI 应用启动")
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _check_rate_limit(self, scope):
+        """与 Flask 应用相同的速率限制；这里不读取请求体，会话ID只从查询参数中获取"""
+        limits = self.limits.get(scope['path'])
+        if not RATE_LIMIT_CONFIG['enabled'] or not limits:
+            return None
+        query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+        session_id = query.get('session_id', [None])[0]
+        ip = client_ip({'X-Real-IP': _get_header(scope, b'x-real-ip')}, (scope.get('client') or ('-', 0))[0])
+        try:
+            decision = await asyncio.to_thread(rate_limiter.hit, build_checks(scope['path'], limits, ip, session_id))
+        except sqlite3.Error as e:
+            logger.error(f"速率限制检查失败: {str(e)}")
+            return None
+        if not decision.allowed:
+            logger.warning("触发速率限制 | 路径: %s | IP: %s | 会话: %s", scope['path'], ip, session_id or '-')
+        return decision
+
+    def _log_request(self, scope):
+        client = scope.get('client') or ('-', 0)
+        api_logger.info(f"收到API请求 | 方法: {scope['method']} | 路径: {scope['path']} | IP: {client[0]}")
+
+    async def generate(self, scope, receive, send):
+        """异步版本的 /api/generate"""
+        self._log_request(scope)
+        try:
+            data = json.loads(await _read_body(receive) or b'null')
+            if not data:
+                logger.error("请求体为空或不是有效的 JSON")
+                await _send_json(scope, send, 400, {"error": "请求体为空或不是有效的 JSON"})
+                return
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.error(f"无法解析请求体为 JSON: {str(e)}")
+            await _send_json(scope, send, 400, {"error": f"无法解析请求体: {str(e)}"})
+            return
+
+        cache_status = 'BYPASS'
+        try:
+            payload = build_image_payload(data)
+
+            async def call_upstream():
+                logger.info(f"调用SiliconFlow API生成图像，模型: {payload['model']}")
+                return image_result_body(await self.client.generate_image(payload))
+
+            if use_image_cache(data):
+                response_data, status, cache_status = await image_cache.aget_or_generate(payload, call_upstream)
+                if cache_status != 'MISS':
+                    logger.info("图像生成缓存: %s", cache_status)
+            else:
+                response_data, status = await call_upstream()
+            CACHE_REQUESTS.inc(cache='image', result=cache_status.lower())
+        except ValueError as e:
+            logger.error(str(e))
+            response_data, status = {"error": str(e)}, 400
+        except Exception as e:
+            logger.error(f"生成失败：{str(e)}", exc_info=True)
+            response_data, status = {"error": "图像生成失败"}, 500
+
+        headers = [(b'x-cache', cache_status.encode())]
+        if status in (429, 503) and 'retry_after' in response_data:
+            headers.append((b'retry-after', str(math.ceil(response_data['retry_after'])).encode()))
+        await _send_json(scope, send, status, response_data, headers)
+
+    async def chat(self, scope, receive, send):
+        """异步版本的 /api/chat，输出格式与 Flask 路由完全一致"""
+        start_time = time.time()
+        request_started = time.perf_counter()
+        trace = current_trace()
+        self._log_request(scope)
+
+        try:
+            if scope['method'] == 'GET':
+                with trace.span('parse_request'):
+                    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+                    params = parse_chat_request('GET', {k: v[0] for k, v in query.items()}, None)
+            else:
+                body = await _read_body(receive)
+                with trace.span('parse_request'):
+                    params = parse_chat_request('POST', {}, json.loads(body or b'null'))
+        except (ValueError, UnicodeDecodeError, AttributeError) as e:
+            await _send_json(scope, send, 400, {"error": f"无法解析请求体: {str(e)}"})
+            return
+
+        session_id = params['session_id']
+        user_input = params['user_input']
+        if not session_id or not user_input:
+            await _send_json(scope, send, 400, {"error": "缺少必要参数"})
+            return
+
+        # 会话存储可能是 SQLite，读写放到线程中执行
+        await asyncio.to_thread(update_session_activity, session_id)
+        stop_event = await asyncio.to_thread(session_store.begin_stream, session_id)
+
+        with trace.span('build_messages'):
+            messages, history_source = await asyncio.to_thread(
+                build_chat_messages, session_id, user_input, params['history'], params['system_prompt'])
+            payload = build_chat_payload(messages, params['model'])
+        chat_logger.info(f"开始聊天请求 | 会话ID: {session_id} | 历史来源: {history_source} | 消息数量: {len(payload['messages'])}/{len(messages)}")
+
+        try:
+            stream = await self.client.chat_completion(payload)
+        except Exception as e:
+            logger.error(f"聊天生成失败：{str(e)}", exc_info=True)
+            await asyncio.to_thread(session_store.end_stream, session_id, stop_event)
+            await _send_json(scope, send, 500, {"error": "对话生成失败", "detail": str(e)})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                *_cors_headers(scope),
+            ],
+        })
+
+        traced = trace.sampled
+
+        async def send_frame(frame):
+            if frame:
+                if traced:
+                    with trace.span('client_flush', bytes=len(frame)):
+                        await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+                else:
+                    await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+
+        # 停止请求和客户端断开都会设置 stopped，正在等待上游的读取随即被取消
+        stopped = self.stops.watch(stop_event)
+        watcher = asyncio.create_task(_watch_disconnect(receive, stop_event, stopped))
+        formatter = ReplyFormatter(session_id)
+        writer = SSEWriter()
+        response_start_time = time.time()
+        stream_metrics = ChatStreamMetrics(request_started)
+        chunk_count = 0
+        try:
+            await send_frame(writer.event({'type': 'user', 'content': user_input}))
+            async for chunk in _until_stopped(stream, stopped):
+                chunk_count += 1
+                if chunk and 'choices' in chunk and chunk['choices']:
+                    content = chunk['choices'][0].get('delta', {}).get('content', '')
+                    if content:
+                        stream_metrics.delta()
+                        if traced and stream_metrics.deltas == 1:
+                            trace.add('first_delta', request_started, stream_metrics.first_delta)
+                    if traced:
+                        with trace.span('fence'):
+                            fragments = formatter.feed(content)
+                    else:
+                        fragments = formatter.feed(content)
+                    for fragment in fragments:
+                        await send_frame(writer.assistant(fragment))
+            if stopped.is_set():
+                chat_logger.info(f"会话 {session_id} 被用户终止，已生成 {formatter.length} 字符")
+                stream_metrics.outcome = 'cancelled' if watcher.done() else 'stopped'
+            else:
+                stream_metrics.outcome = 'completed'
+            for fragment in formatter.flush():
+                await send_frame(writer.assistant(fragment))
+            await send_frame(writer.flush())
+
+            if formatter.text:
+                history_length = await asyncio.to_thread(save_chat_turn, session_id, user_input, formatter.text)
+                chat_logger.info(f"会话 {session_id} 完成 | 响应时间: {time.time() - response_start_time:.2f}秒 | 生成字符: {len(formatter.text)} | 历史长度: {history_length}")
+        except Exception as e:
+            stream_metrics.outcome = 'cancelled' if watcher.done() else 'error'
+            chat_logger.error(f"会话 {session_id} 流式输出错误：{str(e)}", exc_info=True)
+            try:
+                await send_frame(writer.event({'error': str(e)}))
+            except Exception:
+                pass
+        finally:
+            stream_metrics.chunks = chunk_count
+            stream_metrics.finish()
+            await stream.aclose()
+            watcher.cancel()
+            self.stops.unwatch(stop_event)
+            await asyncio.to_thread(session_store.end_stream, session_id, stop_event)
+            try:
+                await send({'type': 'http.response.body', 'body': writer.done(), 'more_body': False})
+            except Exception:
+                pass
+            sse_stats = writer.stats()
+            chat_logger.info(f"会话 {session_id} 总处理时间: {time.time() - start_time:.2f}秒 | 片段: {sse_stats['fragments']} | 帧: {sse_stats['frames']} | 字节: {sse_stats['bytes']}")
+
+
+app = AsyncChatApp(flask_app)
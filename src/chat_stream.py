@@ -0,0 +1,98 @@
+import logging
+
+chat_logger = logging.getLogger('chat')
+
+FENCE = '```'
+# 代码块开始标记后等待语言标记换行的最大字符数，超过后按普通内容发送
+MAX_FENCE_HEADER = 64
+
+
+class ReplyFormatter:
+    """增量识别模型流式回复中的代码块标记
+
+    同步(Flask)和异步(ASGI)两条聊天路径共用。上游增量可能在任意位置切开代码块标记，
+    feed() 会把末尾不完整的反引号以及尚未读到换行的语言标记暂存到下一个增量，
+    保证开始标记（含语言标记和换行）和结束标记各自作为一个完整片段发送；
+    所有片段按顺序拼接后与上游原文完全一致。流结束时需调用 flush() 发送暂存内容。
+    完整回复用列表累积，text 只在读取时拼接一次。
+    """
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.in_code_block = False
+        self.current_lang = None
+        self.length = 0
+        self._parts = []
+        self._text = None
+        self._pending = ""
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = "".join(self._parts)
+            self._parts = [self._text] if self._text else []
+        return self._text
+
+    def feed(self, content):
+        """处理一个上游增量，返回需要发送的回复片段列表"""
+        if not content:
+            return []
+        self._parts.append(content)
+        self._text = None
+        self.length += len(content)
+
+        buffer = self._pending + content if self._pending else content
+        self._pending = ""
+        fragments = []
+        start = 0
+        while True:
+            index = buffer.find(FENCE, start)
+            if index == -1:
+                # 末尾的1~2个反引号可能是被切开的代码块标记，留到下一个增量
+                end = len(buffer)
+                while end > start and end > len(buffer) - 2 and buffer[end - 1] == '`':
+                    end -= 1
+                if end > start:
+                    fragments.append(buffer[start:end])
+                self._pending = buffer[end:]
+                return fragments
+
+            if index > start:
+                fragments.append(buffer[start:index])
+
+            if self.in_code_block:
+                fragments.append(FENCE)
+                self._close_block()
+                start = index + len(FENCE)
+                continue
+
+            newline = buffer.find('\n', index + len(FENCE))
+            if newline == -1:
+                if len(buffer) - index <= MAX_FENCE_HEADER:
+                    # 语言标记还没读完，等待换行
+                    self._pending = buffer[index:]
+                    return fragments
+                newline = len(buffer) - 1
+            fragments.append(buffer[index:newline + 1])
+            self._open_block(buffer[index + len(FENCE):newline + 1].strip())
+            start = newline + 1
+
+    def flush(self):
+        """流结束时返回暂存的内容"""
+        if not self._pending:
+            return []
+        pending = self._pending
+        self._pending = ""
+        if pending.startswith(FENCE) and not self.in_code_block:
+            self._open_block(pending[len(FENCE):].strip())
+        return [pending]
+
+    def _open_block(self, lang):
+        self.in_code_block = True
+        self.current_lang = lang or None
+        chat_logger.debug(f"会话 {self.session_id} 开始代码块，语言: {self.current_lang}")
+
+    def _close_block(self):
+        chat_logger.debug(f"会话 {self.session_id} 结束代码块，语言: {self.current_lang}")
+        self.in_code_block = False
+        self.current_lang = None
@@ -0,0 +1,98 @@
+import os
+import logging
+from functools import lru_cache
+from typing import List, Dict
+
+logger = logging.getLogger(__name__)
+
+# 上下文窗口配置
+CONTEXT_CONFIG = {
+    'default_context_length': int(os.getenv('CHAT_DEFAULT_CONTEXT_LENGTH', 32768)),  # 未知模型的上下文长度
+    'max_context_tokens': int(os.getenv('CHAT_MAX_CONTEXT_TOKENS', 16000)),  # 单次请求发送的历史上限，控制延迟和费用
+    'safety_margin': 256,        # 估算误差预留
+    'message_overhead': 4,       # 每条消息的角色和分隔符开销
+}
+
+# 模型ID -> 上下文长度，由模型目录填充
+_model_context_lengths: Dict[str, int] = {}
+
+
+def update_model_limits(models):
+    """根据模型目录更新各模型的上下文长度
+
+    models 为模型目录中的模型列表，包含 id 和可选的 context_length 字段。
+    """
+    for model in models:
+        if model.get('context_length'):
+            _model_context_lengths[model['id']] = int(model['context_length'])
+
+
+def context_length_for(model) -> int:
+    return _model_context_lengths.get(model, CONTEXT_CONFIG['default_context_length'])
+
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(content) -> int:
+    """粗略估算文本的token数
+
+    英文等ASCII文本约4个字符一个token，中文等非ASCII字符约一个字符一个token。
+    结果按内容缓存，同一条历史消息在后续轮次中不会重复计算。
+    """
+    if not content:
+        return 0
+    char_count = len(content)
+    # 非ASCII字符在UTF-8中占2~4字节，按3字节近似计算其数量
+    non_ascii = (len(content.encode('utf-8')) - char_count) // 2
+    ascii_count = max(0, char_count - non_ascii)
+    return ascii_count // 4 + non_ascii + 1
+
+
+def message_tokens(message) -> int:
+    content = message.get("content")
+    if not isinstance(content, str):
+        content = str(content or "")
+    return estimate_tokens(content) + CONTEXT_CONFIG['message_overhead']
+
+
+def token_budget(model, reply_tokens) -> int:
+    """计算模型可用于输入消息的token预算"""
+    available = context_length_for(model) - reply_tokens - CONTEXT_CONFIG['safety_margin']
+    return max(0, min(available, CONTEXT_CONFIG['max_context_tokens']))
+
+
+def build_context(messages: List[Dict[str, str]], model, reply_tokens) -> List[Dict[str, str]]:
+    """按模型的token预算裁剪消息列表
+
+    开头的系统提示词和最后一条用户消息始终保留，其余历史从最新往前尽量装入预算；
+    装入的历史不会以助手回复开头，保证对话轮次完整。
+    """
+    if not messages:
+        return messages
+
+    pinned_head = 0
+    while pinned_head < len(messages) - 1 and messages[pinned_head].get("role") == "system":
+        pinned_head += 1
+    system_messages = messages[:pinned_head]
+    history = messages[pinned_head:-1]
+    current = messages[-1]
+
+    budget = token_budget(model, reply_tokens)
+    used = sum(message_tokens(m) for m in system_messages) + message_tokens(current)
+    if used > budget:
+        logger.warning(f"系统提示词和当前消息已超出模型 {model} 的token预算: {used}/{budget}")
+
+    kept = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        cost = message_tokens(history[index])
+        if used + cost > budget:
+            break
+        used += cost
+        kept = index
+
+    selected = history[kept:]
+    while selected and selected[0].get("role") == "assistant":
+        selected = selected[1:]
+
+    if len(selected) < len(history):
+        logger.debug(f"上下文裁剪: 模型 {model} 预算 {budget} tokens，历史 {len(history)} 条保留 {len(selected)} 条")
+    return [*system_messages, *selected, current]
@@ -0,0 +1,231 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from .image_cache import url_expiry
+from .sqlite_state import SQLiteState
+from .transport import get_session
+
+logger = logging.getLogger(__name__)
+
+# 下载缓存配置
+DOWNLOAD_CACHE_CONFIG = {
+    'dir': os.getenv('DOWNLOAD_CACHE_DIR', ''),  # 为空时使用 STATE_DIR/downloads；使用 X-Accel-Redirect 时需要与nginx容器共享
+    'max_bytes': int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+    # nginx 中映射到缓存目录的 internal location，为空时由 Flask 通过 sendfile 发送
+    'accel_prefix': os.getenv('DOWNLOAD_ACCEL_PREFIX', '/_download_cache'),
+    'fetch_timeout': int(os.getenv('DOWNLOAD_FETCH_TIMEOUT', 10)),
+    # 最近这么多秒内访问过的文件不淘汰：查找到打开文件（sendfile 或 nginx 的 X-Accel-Redirect）之间有时间差
+    'evict_grace': float(os.getenv('DOWNLOAD_CACHE_EVICT_GRACE', 30)),
+    'chunk_size': 64 * 1024,
+}
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+
+def url_key(url) -> str:
+    """同一个对象的签名URL每次的查询参数不同，只用主机和路径定位对象
+
+    签名的有效期另外记录在索引中，见 DownloadCache.lookup。
+    """
+    parsed = urlparse(url)
+    return hashlib.sha256(f"{parsed.netloc}{parsed.path}".encode('utf-8')).hexdigest()
+
+
+class CachedFile:
+    """缓存中的一个文件，digest 为内容的 SHA-256，同时用作 ETag"""
+
+    __slots__ = ('digest', 'size', 'content_type', 'path', 'relative_path')
+
+    def __init__(self, root, digest, size, content_type):
+        self.digest = digest
+        self.size = size
+        self.content_type = content_type
+        self.relative_path = f"blobs/{digest[:2]}/{digest}"
+        self.path = Path(root) / self.relative_path
+
+
+class DownloadCache:
+    """按内容寻址的图片下载缓存，同一主机的多个worker共享
+
+    文件按内容摘要保存在 blobs/ 下，URL 到摘要的映射、文件大小和最近访问时间保存在 SQLite 索引中；
+    总大小超过 max_bytes 时按最近访问时间淘汰最旧的文件，最近 evict_grace 秒内访问过的文件除外，
+    因此总大小可能暂时超过上限。
+    URL 映射的有效期不超过下载时签名URL的 Expires，过期后需要用新的签名URL重新从上游获取。
+    """
+
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS urls (
+        url_key TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        content_type TEXT NOT NULL,
+        expires_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_urls_digest ON urls(digest);
+    CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_blobs_last_access ON blobs(last_access);
+    CREATE TABLE IF NOT EXISTS cache_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO cache_stats (name, value) VALUES
+        ('bytes', 0), ('hits', 0), ('misses', 0), ('evicted', 0);
+    """
+
+    def __init__(self, directory, max_bytes=None, fetch_timeout=None, evict_grace=None):
+        self.root = Path(directory)
+        self.max_bytes = DOWNLOAD_CACHE_CONFIG['max_bytes'] if max_bytes is None else max_bytes
+        self.evict_grace = DOWNLOAD_CACHE_CONFIG['evict_grace'] if evict_grace is None else evict_grace
+        self.fetch_timeout = DOWNLOAD_CACHE_CONFIG['fetch_timeout'] if fetch_timeout is None else fetch_timeout
+        self._fetch_locks = [threading.Lock() for _ in range(64)]
+        (self.root / 'tmp').mkdir(parents=True, exist_ok=True)
+        self._db = SQLiteState(self.root / 'index.db', self.SCHEMA, self.SCHEMA_VERSION)
+
+    def _conn(self):
+        return self._db.conn()
+
+    @staticmethod
+    def _add_stat(conn, name, delta):
+        conn.execute('UPDATE cache_stats SET value = value + ? WHERE name = ?', (delta, name))
+
+    def _fetch_lock(self, key):
+        # 按URL摘要分段加锁，锁的数量固定
+        return self._fetch_locks[int(key[:8], 16) % len(self._fetch_locks)]
+
+    def lookup(self, url) -> Optional[CachedFile]:
+        """查找URL对应的缓存文件，命中时刷新访问时间
+
+        请求的URL或缓存时使用的URL的签名已经过期时视为未命中，由上游重新校验签名。
+        """
+        now = time.time()
+        expiry = url_expiry(url)
+        if expiry is not None and expiry <= now:
+            return None
+        conn = self._conn()
+        key = url_key(url)
+        row = conn.execute(
+            'SELECT b.digest, b.size, u.content_type, u.expires_at FROM urls u JOIN blobs b ON b.digest = u.digest '
+            'WHERE u.url_key = ?',
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        cached = CachedFile(self.root, *row[:3])
+        with conn:
+            if row[3] is not None and row[3] <= now:
+                # 签名已过期，只删除URL映射，文件可能被其他URL引用，由淘汰流程回收
+                conn.execute('DELETE FROM urls WHERE url_key = ? AND expires_at <= ?', (key, now))
+                return None
+            if not cached.path.exists():
+                # 文件被外部删除，清理索引
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_blob(conn, cached.digest)
+                return None
+            conn.execute('UPDATE blobs SET last_access = ? WHERE digest = ?', (time.time(), cached.digest))
+            self._add_stat(conn, 'hits', 1)
+        return cached
+
+    def store(self, url, chunks, content_type) -> CachedFile:
+        """把数据块写入缓存，返回缓存文件；相同内容只保存一份"""
+        tmp_path = self.root / 'tmp' / uuid.uuid4().hex
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    if chunk:
+                        digest.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+            cached = CachedFile(self.root, digest.hexdigest(), size, content_type)
+            cached.path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, cached.path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO blobs (digest, size, last_access) VALUES (?, ?, ?)',
+                (cached.digest, size, time.time()),
+            ).rowcount
+            if inserted:
+                self._add_stat(conn, 'bytes', size)
+            conn.execute(
+                'INSERT OR REPLACE INTO urls (url_key, digest, content_type, expires_at) VALUES (?, ?, ?, ?)',
+                (url_key(url), cached.digest, content_type, url_expiry(url)),
+            )
+            self._evict(conn, keep=cached.digest)
+        return cached
+
+    def fetch(self, url) -> CachedFile:
+        """返回URL对应的缓存文件，未命中时从上游下载到缓存中
+
+        同一进程内对同一URL的并发请求只下载一次；上游请求失败时抛出 requests 的异常。
+        """
+        cached = self.lookup(url)
+        if cached is not None:
+            return cached
+        with self._fetch_lock(url_key(url)):
+            cached = self.lookup(url)
+            if cached is not None:
+                return cached
+            logger.info("下载缓存未命中，从上游获取: %s", urlparse(url).path)
+            response = get_session().get(
+                url, timeout=self.fetch_timeout, headers={"User-Agent": USER_AGENT}, stream=True,
+            )
+            try:
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', 'application/octet-stream')
+                cached = self.store(url, response.iter_content(chunk_size=DOWNLOAD_CACHE_CONFIG['chunk_size']), content_type)
+            finally:
+                response.close()
+            with self._conn() as conn:
+                self._add_stat(conn, 'misses', 1)
+            return cached
+
+    def _delete_blob(self, conn, digest):
+        row = conn.execute('SELECT size FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        conn.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+        if row is not None:
+            conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self._add_stat(conn, 'bytes', -row[0])
+        path = CachedFile(self.root, digest, 0, '').path
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, conn, keep=None):
+        """在事务中按最近访问时间淘汰文件，直到总大小不超过上限或只剩最近访问过的文件"""
+        total = conn.execute("SELECT value FROM cache_stats WHERE name = 'bytes'").fetchone()[0]
+        accessed_before = time.time() - self.evict_grace
+        while total > self.max_bytes:
+            row = conn.execute(
+                'SELECT digest, size FROM blobs WHERE digest != ? AND last_access < ? ORDER BY last_access LIMIT 1',
+                (keep or '', accessed_before),
+            ).fetchone()
+            if row is None:
+                break
+            self._delete_blob(conn, row[0])
+            self._add_stat(conn, 'evicted', 1)
+            total -= row[1]
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._conn()
+        stats = dict(conn.execute('SELECT name, value FROM cache_stats').fetchall())
+        stats['files'] = conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
+        return stats
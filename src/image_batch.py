@@ -0,0 +1,118 @@
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 批量图像生成配置
+IMAGE_BATCH_CONFIG = {
+    'max_items': int(os.getenv('IMAGE_BATCH_MAX_ITEMS', 50)),  # 每个批量请求最多包含的条目数
+    'workers': int(os.getenv('IMAGE_BATCH_WORKERS', 8)),  # 每个worker进程中执行批量条目的线程数
+    'model_concurrency': int(os.getenv('IMAGE_BATCH_MODEL_CONCURRENCY', 2)),  # 每个模型同时进行的上游调用数
+}
+
+
+class BatchRunner:
+    """在有界线程池中执行批量条目，并限制每个模型的并发数
+
+    模型并发数在同一进程的所有批量请求之间共享；条目按提交顺序调度，
+    某个模型没有空闲名额时先调度其他模型的条目。结果按完成顺序返回。
+    """
+
+    def __init__(self, workers=None, model_concurrency=None):
+        self.workers = IMAGE_BATCH_CONFIG['workers'] if workers is None else workers
+        self.model_concurrency = IMAGE_BATCH_CONFIG['model_concurrency'] if model_concurrency is None else model_concurrency
+        self._executor = None
+        self._executor_pid = None
+        self._cond = threading.Condition()
+        self._running: Dict[str, int] = {}
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _pool(self):
+        # gunicorn fork 之后在各自的进程中创建线程池
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-batch')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _acquire(self, model):
+        if self._running.get(model, 0) >= self.model_concurrency:
+            return False
+        self._running[model] = self._running.get(model, 0) + 1
+        return True
+
+    def _release(self, model):
+        remaining = self._running[model] - 1
+        if remaining:
+            self._running[model] = remaining
+        else:
+            del self._running[model]
+
+    def run(self, items: List[Tuple[str, object]], handler: Callable) -> Iterator[Tuple[int, object]]:
+        """执行 [(模型, 参数), ...]，按完成顺序产出 (序号, handler(参数) 的结果)
+
+        handler 抛出的异常作为结果返回，不会中断其余条目。
+        迭代器被提前关闭时不再调度剩余条目，已经开始的条目在后台执行完。
+        """
+        pending = deque(enumerate(items))
+        finished = deque()
+        outstanding = 0
+
+        def execute(index, model, params):
+            # handler 抛出 BaseException 时也要归还名额并通知调度循环，否则该模型的名额永久占用
+            result = RuntimeError("批量条目执行被中断")
+            try:
+                result = handler(params)
+            except Exception as e:
+                logger.error("批量条目 %d 执行失败: %s", index, str(e), exc_info=True)
+                result = e
+            finally:
+                with self._cond:
+                    self._release(model)
+                    self.completed += 1
+                    if isinstance(result, Exception):
+                        self.failed += 1
+                    finished.append((index, result))
+                    self._cond.notify_all()
+
+        while pending or outstanding:
+            with self._cond:
+                while True:
+                    # 调度有空闲名额的条目，名额不足的模型保持原有顺序等待
+                    blocked = deque()
+                    while pending:
+                        index, (model, params) = pending.popleft()
+                        if self._acquire(model):
+                            try:
+                                self._pool().submit(execute, index, model, params)
+                            except BaseException:
+                                self._release(model)
+                                raise
+                            self.submitted += 1
+                            outstanding += 1
+                        else:
+                            blocked.append((index, (model, params)))
+                    pending = blocked
+                    if finished:
+                        break
+                    self._cond.wait()
+                ready = list(finished)
+                finished.clear()
+            outstanding -= len(ready)
+            yield from ready
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'model_concurrency': self.model_concurrency,
+                'running': dict(self._running),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
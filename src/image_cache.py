@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# 图像结果缓存配置
+IMAGE_CACHE_CONFIG = {
+    'enabled': os.getenv('IMAGE_CACHE_ENABLED', 'true').lower() == 'true',
+    'deterministic_seed': os.getenv('IMAGE_DETERMINISTIC_SEED', 'false').lower() == 'true',  # 未指定时是否默认使用确定性种子
+    'ttl': int(os.getenv('IMAGE_CACHE_TTL', 3600)),  # 上游图片URL约1小时后失效
+    'expiry_margin': int(os.getenv('IMAGE_CACHE_EXPIRY_MARGIN', 120)),  # 在URL失效前提前淘汰，留给用户下载的时间
+    'max_entries': int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', 1000)),
+    'max_bytes': int(os.getenv('IMAGE_CACHE_MAX_BYTES', 4 * 1024 * 1024)),
+}
+
+SEED_RANGE = 1000000000
+
+
+def cache_key(payload) -> str:
+    """规范化的生成参数的摘要"""
+    normalized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def deterministic_seed(payload) -> int:
+    """由不含种子的生成参数推导出固定种子，相同参数总是得到相同种子"""
+    seedless = {k: v for k, v in payload.items() if k != 'variation_seed'}
+    return int(cache_key(seedless)[:15], 16) % SEED_RANGE
+
+
+def url_expiry(url) -> Optional[float]:
+    """从签名URL的 Expires 参数中读取失效时间（Unix时间戳），没有时返回 None"""
+    try:
+        values = parse_qs(urlparse(url).query).get('Expires')
+        return float(values[0]) if values else None
+    except (ValueError, TypeError):
+        return None
+
+
+class _CacheEntry:
+    __slots__ = ('body', 'size', 'expires_at')
+
+    def __init__(self, body, size, expires_at):
+        self.body = body
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ImageResultCache:
+    """按规范化参数缓存 /api/generate 的成功结果
+
+    条目在上游图片URL失效前过期，按最近使用顺序淘汰以满足条目数和字节数上限。
+    相同参数的并发请求只发起一次上游调用，其余请求等待同一个结果。
+    缓存只在当前进程内有效。
+    """
+
+    def __init__(self, ttl=None, max_entries=None, max_bytes=None, expiry_margin=None, clock=time.time):
+        self.ttl = IMAGE_CACHE_CONFIG['ttl'] if ttl is None else ttl
+        self.max_entries = IMAGE_CACHE_CONFIG['max_entries'] if max_entries is None else max_entries
+        self.max_bytes = IMAGE_CACHE_CONFIG['max_bytes'] if max_bytes is None else max_bytes
+        self.expiry_margin = IMAGE_CACHE_CONFIG['expiry_margin'] if expiry_margin is None else expiry_margin
+        self._clock = clock
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._async_inflight: Dict[Tuple[int, str], asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _expires_at(self, body, now):
+        expires_at = now + self.ttl
+        for url in body.get('images', []):
+            expiry = url_expiry(url)
+            if expiry is not None:
+                expires_at = min(expires_at, expiry)
+        return expires_at - self.expiry_margin
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.size
+
+    def get(self, key):
+        """返回未过期的缓存结果，没有时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= self._clock():
+                self._remove(key)
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry.body
+
+    def put(self, key, body):
+        """缓存一个成功结果，超出上限时淘汰最久未使用的条目"""
+        now = self._clock()
+        expires_at = self._expires_at(body, now)
+        size = len(json.dumps(body, ensure_ascii=False).encode('utf-8'))
+        if expires_at <= now or size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _CacheEntry(body, size, expires_at)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evicted += 1
+        return True
+
+    def get_or_generate(self, payload, generate):
+        """返回 (响应数据, 状态码, 缓存状态)
+
+        generate() 返回 (响应数据, 状态码)，只有状态码为200的结果会被缓存。
+        缓存状态为 HIT、MISS 或 SHARED（等待了其他请求正在进行的同一次调用）。
+        """
+        key = cache_key(payload)
+        body = self.get(key)
+        if body is not None:
+            with self._lock:
+                self.hits += 1
+            return body, 200, 'HIT'
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            body, status = future.result()
+            return body, status, 'SHARED'
+
+        try:
+            body, status = generate()
+            if status == 200:
+                self.put(key, body)
+            future.set_result((body, status))
+            return body, status, 'MISS'
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aget_or_generate(self, payload, generate):
+        """get_or_generate 的异步版本，generate 为返回 (响应数据, 状态码) 的协程函数"""
+        key = cache_key(payload)
+        body = self.get(key)
+        if body is not None:
+            with self._lock:
+                self.hits += 1
+            return body, 200, 'HIT'
+
+        loop = asyncio.get_running_loop()
+        inflight_key = (id(loop), key)
+        future = self._async_inflight.get(inflight_key)
+        if future is not None:
+            with self._lock:
+                self.coalesced += 1
+            body, status = await asyncio.shield(future)
+            return body, status, 'SHARED'
+
+        future = loop.create_future()
+        self._async_inflight[inflight_key] = future
+        with self._lock:
+            self.misses += 1
+        try:
+            body, status = await generate()
+            if status == 200:
+                self.put(key, body)
+            future.set_result((body, status))
+            return body, status, 'MISS'
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._async_inflight.pop(inflight_key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'hit_ratio': round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from .sqlite_state import SQLiteState
+
+logger = logging.getLogger(__name__)
+
+# 异步图像任务配置
+IMAGE_JOB_CONFIG = {
+    'workers': int(os.getenv('IMAGE_JOB_WORKERS', 2)),  # 每个worker进程中执行任务的线程数
+    'max_pending': int(os.getenv('IMAGE_JOB_MAX_PENDING', 100)),  # 所有worker合计排队和执行中的任务上限
+    'deadline': int(os.getenv('IMAGE_JOB_DEADLINE', 300)),  # 任务从提交到完成的最长时间（秒）
+    'retention': int(os.getenv('IMAGE_JOB_RETENTION', 3600)),  # 已结束任务的结果保留时间（秒）
+    'poll_interval': float(os.getenv('IMAGE_JOB_POLL_INTERVAL', 0.5)),  # SSE 进度流查询任务状态的间隔（秒）
+    # 所有worker合计的进度流连接数；同步worker模式下每个连接占用一个worker，应小于worker数，asgi模式下连接在线程池中执行
+    'events_max_subscribers': int(os.getenv('IMAGE_JOB_EVENTS_MAX_SUBSCRIBERS', 16)),
+    'events_max_duration': float(os.getenv('IMAGE_JOB_EVENTS_MAX_DURATION', 60)),  # 单个进度流连接的最长时间（秒），到期后客户端重连
+}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+EXPIRED = 'expired'
+FINISHED_STATES = (SUCCEEDED, FAILED, EXPIRED)
+
+
+class JobQueueFull(Exception):
+    """排队和执行中的任务数已达到上限"""
+
+
+class ImageJobStore:
+    """基于 SQLite(WAL 模式) 的任务状态存储，同一主机的多个 worker 共享
+
+    任务由接收请求的进程执行，任何 worker 都可以查询任务状态和结果。
+    超过截止时间仍未结束的任务（包括执行进程已退出的任务）在查询时标记为 expired。
+    """
+
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        request TEXT NOT NULL,
+        result TEXT,
+        http_status INTEGER,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        deadline REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);
+    CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+    CREATE TABLE IF NOT EXISTS job_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO job_stats (name, value) VALUES
+        ('submitted', 0), ('rejected', 0), ('succeeded', 0), ('failed', 0), ('expired', 0), ('purged', 0);
+    """
+
+    def __init__(self, path, max_pending=None, deadline=None, retention=None, clock=time.time):
+        self.path = str(path)
+        self.max_pending = IMAGE_JOB_CONFIG['max_pending'] if max_pending is None else max_pending
+        self.deadline = IMAGE_JOB_CONFIG['deadline'] if deadline is None else deadline
+        self.retention = IMAGE_JOB_CONFIG['retention'] if retention is None else retention
+        self._clock = clock
+        self._next_purge = 0
+        self._db = SQLiteState(self.path, self.SCHEMA, self.SCHEMA_VERSION)
+
+    def _conn(self):
+        return self._db.conn()
+
+    @staticmethod
+    def _add_stat(conn, name, delta):
+        conn.execute('UPDATE job_stats SET value = value + ? WHERE name = ?', (delta, name))
+
+    def create(self, request, deadline=None) -> str:
+        """登记一个排队中的任务并返回任务ID，排队和执行中的任务已满时抛出 JobQueueFull"""
+        now = self._clock()
+        job_id = uuid.uuid4().hex
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._expire_overdue(conn, now)
+            pending = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING),
+            ).fetchone()[0]
+            full = pending >= self.max_pending
+            if full:
+                self._add_stat(conn, 'rejected', 1)
+            else:
+                conn.execute(
+                    'INSERT INTO jobs (job_id, status, request, created_at, deadline) VALUES (?, ?, ?, ?, ?)',
+                    (job_id, QUEUED, json.dumps(request, ensure_ascii=False), now, now + (deadline or self.deadline)),
+                )
+                self._add_stat(conn, 'submitted', 1)
+        if full:
+            raise JobQueueFull(f"任务队列已满（{pending} 个任务等待或执行中）")
+        if now >= self._next_purge:
+            self._next_purge = now + 60
+            self.purge()
+        return job_id
+
+    def start(self, job_id) -> Optional[float]:
+        """把排队中的任务标记为执行中并返回剩余的秒数；任务已超过截止时间时标记为 expired 并返回 None"""
+        now = self._clock()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            started = conn.execute(
+                'UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ? AND status = ? AND deadline > ?',
+                (RUNNING, now, job_id, QUEUED, now),
+            ).rowcount
+            if not started:
+                self._expire_overdue(conn, now)
+                return None
+            deadline = conn.execute('SELECT deadline FROM jobs WHERE job_id = ?', (job_id,)).fetchone()[0]
+        return deadline - now
+
+    def finish(self, job_id, result=None, http_status=200, error=None) -> str:
+        """记录任务结果，返回最终状态；在截止时间之后才完成的任务记为 expired"""
+        now = self._clock()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT status, deadline FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None or row[0] in FINISHED_STATES:
+                return row[0] if row else EXPIRED
+            if now > row[1]:
+                status, error = EXPIRED, "任务超过截止时间"
+            else:
+                status = SUCCEEDED if error is None and http_status == 200 else FAILED
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, http_status = ?, error = ?, finished_at = ? WHERE job_id = ?',
+                (status, None if result is None else json.dumps(result, ensure_ascii=False), http_status, error, now, job_id),
+            )
+            self._add_stat(conn, status, 1)
+        return status
+
+    def _expire_overdue(self, conn, now):
+        """在事务中把超过截止时间仍未结束的任务标记为 expired"""
+        expired = conn.execute(
+            'UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?) AND deadline <= ?',
+            (EXPIRED, "任务超过截止时间", now, QUEUED, RUNNING, now),
+        ).rowcount
+        if expired:
+            self._add_stat(conn, 'expired', expired)
+
+    def get(self, job_id) -> Optional[Dict]:
+        """返回任务的状态和结果，任务不存在或已被清理时返回 None"""
+        now = self._clock()
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT status, result, http_status, error, created_at, started_at, finished_at, deadline '
+            'FROM jobs WHERE job_id = ?', (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, result, http_status, error, created_at, started_at, finished_at, deadline = row
+        if status not in FINISHED_STATES and deadline <= now:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._expire_overdue(conn, now)
+            return self.get(job_id)
+
+        job = {
+            'job_id': job_id,
+            'status': status,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'deadline': deadline,
+        }
+        if status == QUEUED:
+            # 排在前面的任务数（所有worker合计）
+            job['position'] = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?', (QUEUED, created_at),
+            ).fetchone()[0]
+        if result is not None:
+            job['result'] = json.loads(result)
+        if http_status is not None:
+            job['http_status'] = http_status
+        if error is not None:
+            job['error'] = error
+        return job
+
+    def purge(self) -> int:
+        """删除结束时间超过保留期的任务"""
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            purged = conn.execute(
+                'DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+                (self._clock() - self.retention,),
+            ).rowcount
+            if purged:
+                self._add_stat(conn, 'purged', purged)
+        if purged:
+            logger.info("清理已过保留期的图像任务 %d 个", purged)
+        return purged
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._conn()
+        stats = dict(conn.execute('SELECT name, value FROM job_stats').fetchall())
+        for status, count in conn.execute('SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status',
+                                          (QUEUED, RUNNING)):
+            stats[status] = count
+        stats.setdefault(QUEUED, 0)
+        stats.setdefault(RUNNING, 0)
+        return stats
+
+
+class ImageJobExecutor:
+    """在后台线程池中执行图像任务，结果写入 ImageJobStore
+
+    线程池属于接收任务的进程，fork 之后在子进程中重新创建。
+    """
+
+    def __init__(self, store: ImageJobStore, workers=None):
+        self.store = store
+        self.workers = IMAGE_JOB_CONFIG['workers'] if workers is None else workers
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-job')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def submit(self, request, run: Callable[[float], tuple], deadline=None) -> str:
+        """登记任务并交给线程池执行，返回任务ID
+
+        run(剩余秒数) 返回 (响应数据, 状态码)，上游调用不应超过剩余的截止时间；队列已满时抛出 JobQueueFull。
+        """
+        job_id = self.store.create(request, deadline)
+        self._pool().submit(self._execute, job_id, run)
+        return job_id
+
+    def _execute(self, job_id, run):
+        # 排队期间已经超过截止时间的任务不再执行，其余任务的上游调用以剩余时间为时限
+        remaining = self.store.start(job_id)
+        if remaining is None:
+            logger.warning("图像任务 %s 在开始前已超过截止时间", job_id)
+            return
+        try:
+            body, status = run(remaining)
+            if status == 200:
+                final = self.store.finish(job_id, body, status)
+            else:
+                final = self.store.finish(job_id, None, status, body.get('error', '图像生成失败'))
+        except Exception as e:
+            logger.error("图像任务 %s 执行失败: %s", job_id, str(e), exc_info=True)
+            final = self.store.finish(job_id, None, 500, "图像生成失败")
+        logger.info("图像任务 %s 结束，状态: %s", job_id, final)
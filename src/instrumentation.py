@@ -0,0 +1,123 @@
+import os
+import time
+import logging
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 响应埋点配置
+INSTRUMENTATION_CONFIG = {
+    'preview_bytes': int(os.getenv('RESPONSE_PREVIEW_BYTES', 512)),  # 日志中保留的响应体预览字节数
+}
+
+
+def format_ms(value) -> str:
+    return '-' if value is None else f"{value:.2f}ms"
+
+
+class ResponseMetrics:
+    """一次响应的输出统计"""
+
+    __slots__ = ('started', 'first_byte', 'last_byte', 'bytes', 'chunks', 'preview', 'preview_limit', 'passthrough')
+
+    def __init__(self, started, preview_limit, passthrough=False):
+        self.started = started
+        self.first_byte = None
+        self.last_byte = None
+        self.bytes = 0
+        self.chunks = 0
+        self.preview = bytearray()
+        self.preview_limit = preview_limit
+        self.passthrough = passthrough
+
+    @property
+    def ttfb_ms(self) -> Optional[float]:
+        return None if self.first_byte is None else (self.first_byte - self.started) * 1000
+
+    @property
+    def ttlb_ms(self) -> Optional[float]:
+        return None if self.last_byte is None else (self.last_byte - self.started) * 1000
+
+    def preview_text(self) -> str:
+        return self.preview.decode('utf-8', errors='replace')
+
+    def as_dict(self) -> Dict:
+        return {
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'ttfb_ms': self.ttfb_ms,
+            'ttlb_ms': self.ttlb_ms,
+            'passthrough': self.passthrough,
+        }
+
+
+class InstrumentedBody:
+    """包装响应体迭代器，在数据块发出时统计字节数和首/末字节时间
+
+    只保留前 preview_limit 个字节作为预览，不会缓冲整个响应；
+    WSGI服务器关闭迭代器时先关闭原响应体，再调用一次 on_close。
+    """
+
+    def __init__(self, body, metrics: ResponseMetrics, on_close: Callable[[ResponseMetrics], None], clock=time.perf_counter,
+                 on_flush: Optional[Callable[[float, float, int], None]] = None):
+        self._body = body
+        self._metrics = metrics
+        self._on_close = on_close
+        self._clock = clock
+        self._on_flush = on_flush
+        self._closed = False
+
+    def __iter__(self):
+        metrics = self._metrics
+        for chunk in self._body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            now = self._clock()
+            if metrics.first_byte is None:
+                metrics.first_byte = now
+            metrics.last_byte = now
+            metrics.bytes += len(chunk)
+            metrics.chunks += 1
+            remaining = metrics.preview_limit - len(metrics.preview)
+            if remaining > 0:
+                metrics.preview += chunk[:remaining]
+            yield chunk
+            if self._on_flush is not None:
+                # 服务器把数据块写入socket之后生成器才继续，yield 前后的时间即为写给客户端的时间
+                self._on_flush(now, self._clock(), len(chunk))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            try:
+                self._on_close(self._metrics)
+            except Exception:
+                logger.exception("记录响应统计失败")
+
+
+def instrument_response(response, started, on_close: Callable[[ResponseMetrics], None], preview_bytes=None,
+                        on_flush: Optional[Callable[[float, float, int], None]] = None):
+    """为 Flask 响应加上输出统计，响应关闭时调用 on_close(metrics)
+
+    send_file 等直接透传文件的响应不包装响应体，以保留 wsgi.file_wrapper/sendfile；
+    这类响应体由服务器直接关闭，因此立即按 Content-Length 记录。
+    on_flush(开始, 结束, 字节数) 在每个数据块写给客户端之后调用，用于请求追踪。
+    """
+    limit = INSTRUMENTATION_CONFIG['preview_bytes'] if preview_bytes is None else preview_bytes
+    if response.direct_passthrough:
+        metrics = ResponseMetrics(started, 0, passthrough=True)
+        metrics.bytes = response.content_length or 0
+        on_close(metrics)
+        return response
+
+    metrics = ResponseMetrics(started, limit)
+    response.response = InstrumentedBody(response.response, metrics, on_close, on_flush=on_flush)
+    return response
@@ -0,0 +1,188 @@
+import os
+import json
+import copy
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List
+
+# 日志管道配置
+LOG_CONFIG = {
+    'queue_size': int(os.getenv('LOG_QUEUE_SIZE', 10000)),  # 每个日志器队列的容量，写满后丢弃新日志而不是阻塞请求
+    'payload_sample_rate': float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.1)),  # 大体积内容（历史、请求体、回复）的记录比例
+    'payload_max_chars': int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 1000)),  # 记录大体积内容时保留的最大字符数
+}
+
+# 当前线程（请求）在日志调用上花费的时间
+_request_timing = threading.local()
+
+
+def reset_log_time():
+    _request_timing.seconds = 0.0
+
+
+def log_time() -> float:
+    """返回当前线程自上次 reset_log_time() 以来在日志调用中花费的秒数"""
+    return getattr(_request_timing, 'seconds', 0.0)
+
+
+def _serialize(payload) -> str:
+    if isinstance(payload, str):
+        return payload
+    try:
+        return json.dumps(payload, ensure_ascii=False, default=str)
+    except (TypeError, ValueError):
+        return str(payload)
+
+
+class TruncatedPayload:
+    """延迟序列化的大体积日志内容
+
+    只有日志真正被写出时（在后台线程中）才序列化，并截断到 max_chars 个字符。
+    内容在写出前可能被调用方修改，可变对象应先用 log_payload 记录。
+    """
+
+    __slots__ = ('payload', 'max_chars')
+
+    def __init__(self, payload, max_chars=None):
+        self.payload = payload
+        self.max_chars = LOG_CONFIG['payload_max_chars'] if max_chars is None else max_chars
+
+    def __str__(self):
+        text = _serialize(self.payload)
+        if len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}...(共 {len(text)} 字符)"
+        return text
+
+
+def log_payload(target_logger, level, label, payload, sample_rate=None):
+    """按采样比例记录大体积内容，返回是否记录
+
+    未启用对应级别或未被采样时不做任何序列化。被记录的内容在调用时序列化，
+    之后调用方修改消息列表等可变对象不会影响后台线程写出的日志；截断仍在后台线程进行。
+    """
+    if not target_logger.isEnabledFor(level):
+        return False
+    rate = LOG_CONFIG['payload_sample_rate'] if sample_rate is None else sample_rate
+    if rate < 1 and random.random() >= rate:
+        return False
+    target_logger.log(level, "%s: %s", label, TruncatedPayload(_serialize(payload)))
+    return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """把日志记录放入有界队列的处理器
+
+    消息的格式化推迟到后台监听线程；队列写满时直接丢弃并计数，保证请求线程不会因磁盘I/O阻塞。
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 保留 msg 和 args，由监听线程中的处理器格式化；只复制记录，避免其他处理器修改共享对象
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def handle(self, record):
+        started = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            _request_timing.seconds = log_time() + time.perf_counter() - started
+
+
+class DropReportingListener(QueueListener):
+    """后台写日志的监听线程，队列中出现丢弃时补记一条警告"""
+
+    def __init__(self, log_queue, queue_handler, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.reported_drops = 0
+        self.handled = 0
+
+    def enqueue_sentinel(self):
+        # 队列写满时等待监听线程腾出空间，保证停止时剩余日志都被写出
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        super().handle(record)
+        self.handled += 1
+        dropped = self.queue_handler.dropped
+        if dropped > self.reported_drops:
+            warning = logging.LogRecord(
+                record.name, logging.WARNING, __file__, 0,
+                "日志队列已满，丢弃了 %d 条日志", (dropped - self.reported_drops,), None,
+            )
+            self.reported_drops = dropped
+            super().handle(warning)
+
+
+_listeners: Dict[str, DropReportingListener] = {}
+_lock = threading.Lock()
+
+
+def install_queue_logging(logger_names: List[str], queue_size=None):
+    """把指定日志器的处理器移到后台线程中执行
+
+    每个日志器原有的处理器交给一个 QueueListener，日志器本身只保留一个非阻塞的 QueueHandler。
+    重复调用时不会重复安装。
+    """
+    size = LOG_CONFIG['queue_size'] if queue_size is None else queue_size
+    with _lock:
+        for name in logger_names:
+            target = logging.getLogger(name)
+            if name in _listeners or not target.handlers:
+                continue
+            handlers = list(target.handlers)
+            log_queue = queue.Queue(maxsize=size)
+            queue_handler = NonBlockingQueueHandler(log_queue)
+            listener = DropReportingListener(log_queue, queue_handler, *handlers)
+            for handler in handlers:
+                target.removeHandler(handler)
+            target.addHandler(queue_handler)
+            listener.start()
+            _listeners[name] = listener
+    return _listeners
+
+
+def stop_queue_logging(logger_names=None):
+    """停止监听线程并写完队列中剩余的日志，未指定日志器时停止全部"""
+    with _lock:
+        for name, listener in list(_listeners.items()):
+            if logger_names is not None and name not in logger_names:
+                continue
+            target = logging.getLogger(name)
+            target.removeHandler(listener.queue_handler)
+            listener.stop()
+            for handler in listener.handlers:
+                target.addHandler(handler)
+            del _listeners[name]
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """各日志器队列的统计信息"""
+    return {
+        name or 'root': {
+            'enqueued': listener.queue_handler.enqueued,
+            'dropped': listener.queue_handler.dropped,
+            'handled': listener.handled,
+            'pending': listener.queue.qsize(),
+        }
+        for name, listener in list(_listeners.items())
+    }
+
+
+atexit.register(stop_queue_logging)
@@ -0,0 +1,227 @@
+import os
+import re
+import bisect
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .log_reader import LineIndex, LogReader, Segment
+
+logger = logging.getLogger(__name__)
+
+# 日志查询配置
+LOG_QUERY_CONFIG = {
+    'sample_every': int(os.getenv('LOG_QUERY_SAMPLE_EVERY', 256)),  # 稀疏时间索引每隔多少行记录一次时间戳
+    'max_results': int(os.getenv('LOG_QUERY_MAX_RESULTS', 500)),  # 每页最多返回的记录数
+    'max_bytes': int(os.getenv('LOG_QUERY_MAX_BYTES', 1024 * 1024)),  # 每页返回的记录总字节数上限
+    'max_scan_lines': int(os.getenv('LOG_QUERY_MAX_SCAN_LINES', 200000)),  # 每次请求最多扫描的行数，超过后返回游标
+    'batch_lines': 2048,  # 扫描时每次读取的行数
+}
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+# 与日志配置中 detailed 格式对应：时间 [级别] [日志器:行号] 消息
+RECORD_HEADER = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) \[([A-Z]+)\] \[([^\]:]+)(?::\d+)?\] ')
+# 只看行首是否为时间戳，用于采样
+TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}')
+
+Record = namedtuple('Record', ['timestamp', 'level', 'logger', 'text', 'line'])
+
+
+def log_timestamp(value) -> str:
+    """把 ISO 格式的时间转换为日志中的时间格式，二者可以直接按字符串比较"""
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', ''))
+    except ValueError:
+        raise ValueError(f"无效的时间: {value}")
+    return parsed.strftime('%Y-%m-%d %H:%M:%S,%f')[:23]
+
+
+class LogQuery:
+    """日志记录的过滤条件；一条记录包括首行和之后的续行（如异常堆栈）"""
+
+    def __init__(self, level=None, logger_name=None, since=None, until=None, session_id=None, text=None):
+        if level is not None and level.upper() not in LEVELS:
+            raise ValueError(f"无效的日志级别: {level}，可用级别为: {', '.join(LEVELS)}")
+        self.min_level = LEVELS[level.upper()] if level else None
+        self.logger_name = logger_name or None
+        self.since = log_timestamp(since) if since else None
+        self.until = log_timestamp(until) if until else None
+        self.session_id = session_id or None
+        self.text = text or None
+
+    def matches(self, record: Record) -> bool:
+        if self.since is not None and record.timestamp < self.since:
+            return False
+        if self.until is not None and record.timestamp > self.until:
+            return False
+        if self.min_level is not None and LEVELS.get(record.level, 0) < self.min_level:
+            return False
+        if self.logger_name is not None and not (record.logger == self.logger_name
+                                                 or record.logger.startswith(self.logger_name + '.')):
+            return False
+        if self.session_id is not None and self.session_id not in record.text:
+            return False
+        return self.text is None or self.text in record.text
+
+
+class TimeIndex:
+    """单个日志文件的稀疏时间索引：每隔 every 行记录一次该位置之后第一条记录的时间戳
+
+    日志按时间顺序追加，时间范围查询可以二分查找到起止行，只扫描范围内的内容。
+    """
+
+    def __init__(self, every=None):
+        self.every = every or LOG_QUERY_CONFIG['sample_every']
+        self.lines: List[int] = []
+        self.timestamps: List[str] = []
+        self._lock = threading.Lock()
+
+    def extend(self, index: LineIndex):
+        """为索引中新增的行补充采样点"""
+        with self._lock:
+            next_line = len(self.lines) * self.every
+            if next_line >= len(index):
+                return
+            with index.open() as f:
+                while next_line < len(index):
+                    last = min(len(index), next_line + self.every)
+                    timestamp = None
+                    # 采样行可能是堆栈等续行，向后找第一条记录的首行
+                    for probe in range(next_line, last, 16):
+                        for line in index.read_lines(probe, min(last, probe + 16), f):
+                            match = TIMESTAMP.match(line)
+                            if match:
+                                timestamp = match.group(0)
+                                break
+                        if timestamp:
+                            break
+                    if timestamp is None:
+                        timestamp = self.timestamps[-1] if self.timestamps else ''
+                    self.lines.append(next_line)
+                    self.timestamps.append(timestamp)
+                    next_line += self.every
+
+    def start_line(self, since: Optional[str]) -> int:
+        """时间不早于 since 的记录只可能出现在这一行之后"""
+        if since is None:
+            return 0
+        position = bisect.bisect_left(self.timestamps, since)
+        return self.lines[position - 1] if position > 0 else 0
+
+    def end_line(self, until: Optional[str], total: int) -> int:
+        """时间不晚于 until 的记录只可能出现在这一行之前"""
+        if until is None:
+            return total
+        position = bisect.bisect_right(self.timestamps, until)
+        return self.lines[position] if position < len(self.lines) else total
+
+
+class LogSearcher:
+    """在当前日志和轮转备份中按条件查找记录，结果按时间顺序分页
+
+    游标与 LogReader 相同，为 "<inode>:<行号>"，指向下一次扫描的起始行。
+    每页的记录数、字节数和扫描行数都有上限，超过时返回游标，由客户端继续请求。
+    """
+
+    def __init__(self, reader: LogReader, max_results=None, max_bytes=None, max_scan_lines=None):
+        self.reader = reader
+        self.max_results = LOG_QUERY_CONFIG['max_results'] if max_results is None else max_results
+        self.max_bytes = LOG_QUERY_CONFIG['max_bytes'] if max_bytes is None else max_bytes
+        self.max_scan_lines = LOG_QUERY_CONFIG['max_scan_lines'] if max_scan_lines is None else max_scan_lines
+        self._time_indexes: Dict[str, TimeIndex] = {}
+        self._lock = threading.Lock()
+
+    def _time_index(self, segments: List[Segment], segment: Segment) -> TimeIndex:
+        key = segment.index.index_path.name
+        with self._lock:
+            time_index = self._time_indexes.get(key)
+            if time_index is None:
+                # 顺便丢弃已经不在视图中的文件的时间索引
+                live = {s.index.index_path.name for s in segments}
+                self._time_indexes = {k: v for k, v in self._time_indexes.items() if k in live}
+                time_index = self._time_indexes[key] = TimeIndex()
+        time_index.extend(segment.index)
+        return time_index
+
+    def search(self, log_type, query: LogQuery, cursor=None, limit=None) -> Dict:
+        limit = min(limit or self.max_results, self.max_results)
+        segments = self.reader.segments(log_type)
+        position = 0
+        if cursor is not None:
+            position = self.reader.resolve(segments, cursor)
+            # 游标所在的文件已经被轮转删除，从最早的一行继续
+            position = 0 if position is None else position
+
+        matches = []
+        size = 0
+        scanned = 0
+        next_position = None
+        for segment in segments:
+            if segment.base + segment.lines <= position:
+                continue
+            first = max(0, position - segment.base)
+            last = segment.lines
+            if query.since is not None or query.until is not None:
+                time_index = self._time_index(segments, segment)
+                first = max(first, time_index.start_line(query.since))
+                last = time_index.end_line(query.until, segment.lines)
+            if first >= last:
+                if query.until is not None and last < segment.lines:
+                    break  # 之后的文件都晚于 until
+                continue
+
+            for record in self._records(segment, first, last):
+                record_end = record.line + record.text.count('\n')
+                if query.matches(record):
+                    matches.append({
+                        "timestamp": record.timestamp,
+                        "level": record.level,
+                        "logger": record.logger,
+                        "message": record.text.rstrip('\n'),
+                        "file": segment.name,
+                        "line": record.line,
+                    })
+                    size += len(record.text)
+                if len(matches) >= limit or size >= self.max_bytes or scanned + record_end - first >= self.max_scan_lines:
+                    next_position = segment.base + record_end
+                    break
+            if next_position is not None:
+                break
+            scanned += last - first
+            if query.until is not None and last < segment.lines:
+                break
+
+        more = next_position is not None and next_position < segments[-1].base + segments[-1].lines
+        return {
+            "matches": matches,
+            "count": len(matches),
+            "next_cursor": self.reader.cursor(segments, next_position) if more else None,
+        }
+
+    def _records(self, segment: Segment, first: int, last: int):
+        """按记录读取从 first 行开始、首行在 last 行之前的记录
+
+        开头不属于任何记录的续行被跳过；最后一条记录的续行即使超过 last 也会读完。
+        """
+        batch = LOG_QUERY_CONFIG['batch_lines']
+        pending = None
+        with segment.index.open() as f:
+            for start in range(first, segment.lines, batch):
+                for offset, line in enumerate(segment.index.read_lines(start, min(segment.lines, start + batch), f)):
+                    match = RECORD_HEADER.match(line)
+                    if match:
+                        if pending is not None:
+                            yield Record(pending[0], pending[1], pending[2], ''.join(pending[3]), pending[4])
+                            pending = None
+                        if start + offset >= last:
+                            return
+                        pending = (match.group(1), match.group(2), match.group(3), [line], start + offset)
+                    elif pending is not None:
+                        pending[3].append(line)
+                    elif start + offset >= last:
+                        return
+        if pending is not None:
+            yield Record(pending[0], pending[1], pending[2], ''.join(pending[3]), pending[4])
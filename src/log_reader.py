@@ -0,0 +1,291 @@
+import os
+import fcntl
+import logging
+import threading
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .log_rotation import open_log
+
+logger = logging.getLogger(__name__)
+
+# 日志读取配置
+LOG_READER_CONFIG = {
+    'index_dir': os.getenv('LOG_INDEX_DIR', ''),  # 行偏移索引目录，为空时使用日志目录下的 .index
+    'backup_count': 5,  # 与 RotatingFileHandler 的 backupCount 一致
+    'chunk_size': 1024 * 1024,  # 扩展索引时每次读取的字节数
+}
+
+LOG_TYPES = ('app', 'error', 'api', 'chat')
+
+
+class LineIndex:
+    """单个日志文件的行偏移索引
+
+    ends[i] 为第 i 行结束（下一行开始）的字节偏移，只索引以换行符结尾的完整行。
+    索引以 8 字节整数数组的形式追加写入 index_path，并按文件的 inode 命名，因此日志轮转（重命名）后仍然有效；
+    多个worker通过文件锁共享同一份索引，每个worker只扫描其他worker还没有索引的新内容。
+    压缩的备份（.gz）按解压后的内容建立索引。
+    """
+
+    def __init__(self, path, index_path, chunk_size=None):
+        self.path = Path(path)
+        self.index_path = Path(index_path)
+        self.chunk_size = chunk_size or LOG_READER_CONFIG['chunk_size']
+        self.ends = array('Q')
+        self.lock = threading.Lock()
+        self._size = -1
+        self._validated = False
+
+    def __len__(self):
+        return len(self.ends)
+
+    @property
+    def compressed(self) -> bool:
+        return self.path.name.endswith('.gz')
+
+    def open(self):
+        """打开文件，读取的是解压后的内容"""
+        return open_log(self.path, self.index_path.parent)
+
+    def content_size(self, stat) -> int:
+        """解压后的大小；压缩的备份不再变化，只计算一次"""
+        if not self.compressed:
+            return stat.st_size
+        if self._size < 0:
+            with self.open() as f:
+                return f.size
+        return self._size
+
+    @property
+    def indexed_bytes(self) -> int:
+        return self.ends[-1] if self.ends else 0
+
+    def refresh(self, size: int):
+        """文件增长到 size 字节后扩展索引；文件大小没有变化时不做任何IO"""
+        with self.lock:
+            if size == self._size:
+                return
+            with open(self.index_path, 'a+b') as idx, self.open() as f:
+                fcntl.flock(idx, fcntl.LOCK_EX)
+                self._load(idx, f, size)
+                if size < self.indexed_bytes:
+                    # 文件被截断或替换，重建索引
+                    logger.info("日志文件被截断，重建行索引: %s", self.path)
+                    self.ends = array('Q')
+                    idx.truncate(0)
+                new = self._scan(f, self.indexed_bytes, size)
+                idx.write(new.tobytes())
+                self.ends.extend(new)
+            self._size = size
+
+    def _load(self, idx, f, size):
+        """读入其他worker追加的索引；第一次加载时检查索引是否属于当前文件（inode 可能被复用）"""
+        stored = os.fstat(idx.fileno()).st_size // 8
+        if stored > len(self.ends):
+            idx.seek(len(self.ends) * 8)
+            self.ends.frombytes(idx.read((stored - len(self.ends)) * 8))
+        elif stored < len(self.ends):
+            idx.truncate(0)
+            idx.write(self.ends.tobytes())
+        if not self._validated:
+            self._validated = True
+            if self.ends and not (self.indexed_bytes <= size and self._ends_line(f, self.indexed_bytes)):
+                self.ends = array('Q')
+                idx.truncate(0)
+
+    @staticmethod
+    def _ends_line(f, offset) -> bool:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+
+    def _scan(self, f, start, end) -> array:
+        ends = array('Q')
+        f.seek(start)
+        position = start
+        while position < end:
+            chunk = f.read(min(self.chunk_size, end - position))
+            if not chunk:
+                break
+            found = chunk.find(b'\n')
+            while found != -1:
+                ends.append(position + found + 1)
+                found = chunk.find(b'\n', found + 1)
+            position += len(chunk)
+        return ends
+
+    def span(self, first: int, last: int) -> Tuple[int, int]:
+        """第 first 行到第 last 行（不含）的字节范围"""
+        start = self.ends[first - 1] if first > 0 else 0
+        return start, self.ends[last - 1] if last > 0 else 0
+
+    def read_lines(self, first: int, last: int, f=None) -> List[str]:
+        """读取第 first 行到第 last 行（不含），f 为已经打开的文件时复用它"""
+        start, end = self.span(first, last)
+        if end <= start:
+            return []
+        if f is None:
+            with self.open() as f:
+                return self.read_lines(first, last, f)
+        f.seek(start)
+        return f.read(end - start).decode('utf-8', errors='replace').splitlines(keepends=True)
+
+
+class Segment:
+    """连续视图中的一个文件：name 为文件名，base 为该文件第一行在整个视图中的行号"""
+
+    __slots__ = ('name', 'inode', 'size', 'index', 'base')
+
+    def __init__(self, name, inode, size, index, base):
+        self.name = name
+        self.inode = inode
+        self.size = size
+        self.index = index
+        self.base = base
+
+    @property
+    def lines(self) -> int:
+        return len(self.index)
+
+
+class LogReader:
+    """把 <type>.log.5 … <type>.log.1、<type>.log 作为一个连续的、可以向前和向后翻页的视图读取
+
+    每页通过行偏移索引直接 seek 到起始位置，读取量只与请求的行数有关。
+    游标为 "<inode>:<行号>"，文件轮转后仍然指向同一行。
+    """
+
+    def __init__(self, log_dir, index_dir=None, backup_count=None):
+        self.log_dir = Path(log_dir)
+        self.index_dir = Path(index_dir or LOG_READER_CONFIG['index_dir'] or self.log_dir / '.index')
+        self.backup_count = LOG_READER_CONFIG['backup_count'] if backup_count is None else backup_count
+        self._indexes: Dict[Tuple[int, int], LineIndex] = {}
+        self._lock = threading.Lock()
+
+    def files(self, log_type) -> List[Path]:
+        """从最旧到最新排列的日志文件；备份在后台压缩完成后为 .gz，压缩完成前为未压缩的文件"""
+        base = self.log_dir / f"{log_type}.log"
+        files = []
+        for n in range(self.backup_count, 0, -1):
+            for path in (Path(f"{base}.{n}.gz"), Path(f"{base}.{n}")):
+                if path.exists():
+                    files.append(path)
+                    break
+        if base.exists():
+            files.append(base)
+        return files
+
+    def _index_for(self, path, stat) -> Tuple[LineIndex, bool]:
+        key = (stat.st_dev, stat.st_ino)
+        index = self._indexes.get(key)
+        created = False
+        if index is None or index.path != path:
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    self.index_dir.mkdir(parents=True, exist_ok=True)
+                    index = LineIndex(path, self.index_dir / f"{stat.st_dev}-{stat.st_ino}.idx")
+                    self._indexes[key] = index
+                    created = True
+                # 轮转后同一个 inode 换了文件名
+                index.path = Path(path)
+        return index, created
+
+    def segments(self, log_type) -> List[Segment]:
+        segments = []
+        base = 0
+        rotated = False
+        for path in self.files(log_type):
+            try:
+                stat = path.stat()
+                index, created = self._index_for(path, stat)
+                size = index.content_size(stat)
+                index.refresh(size)
+            except FileNotFoundError:
+                # 读取过程中发生了轮转，被删除的最旧备份直接跳过
+                continue
+            rotated = rotated or created
+            segments.append(Segment(path.name, stat.st_ino, size, index, base))
+            base += len(index)
+        if rotated:
+            # 出现了新文件（启动或轮转），顺便清理已删除文件的索引
+            self.purge_indexes()
+        return segments
+
+    def purge_indexes(self, log_types=LOG_TYPES):
+        """删除已经不存在的日志文件的行索引和块表"""
+        live = set()
+        for log_type in log_types:
+            for path in self.files(log_type):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                live.add(f"{stat.st_dev}-{stat.st_ino}")
+        with self._lock:
+            self._indexes = {key: index for key, index in self._indexes.items()
+                             if index.index_path.stem in live}
+        if self.index_dir.exists():
+            for index_file in [*self.index_dir.glob('*.idx'), *self.index_dir.glob('*.blocks')]:
+                if index_file.stem not in live:
+                    index_file.unlink(missing_ok=True)
+
+    @staticmethod
+    def cursor(segments: List[Segment], line: int) -> Optional[str]:
+        """第 line 行的游标；line 为总行数时指向当前文件的末尾，之后追加的内容从这里开始"""
+        for segment in segments:
+            if line < segment.base + segment.lines or segment is segments[-1]:
+                return f"{segment.inode}:{line - segment.base}"
+        return None
+
+    @staticmethod
+    def resolve(segments: List[Segment], cursor: str) -> Optional[int]:
+        """把游标转换为当前视图中的行号；对应的文件已被删除时返回 None"""
+        try:
+            inode, line = (int(part) for part in cursor.split(':', 1))
+        except ValueError:
+            raise ValueError(f"无效的游标: {cursor}")
+        for segment in segments:
+            if segment.inode == inode:
+                return segment.base + min(line, segment.lines)
+        return None
+
+    def read(self, log_type, start=None, lines=100, cursor=None, backward=False) -> Dict:
+        """读取一页日志
+
+        start 为视图中的起始行号；cursor 为某一行的游标，backward 为真时返回该行之前的 lines 行。
+        都没有指定时返回最后 lines 行。
+        """
+        segments = self.segments(log_type)
+        total = segments[-1].base + segments[-1].lines if segments else 0
+        if cursor is not None:
+            position = self.resolve(segments, cursor)
+            # 游标所在的文件已经被轮转删除：向后翻页时没有更早的内容，向前翻页从最早的一行开始
+            position = 0 if position is None else position
+            start = max(0, position - lines) if backward else position
+        elif start is None or start >= total:
+            # 起始行超过总行数时同样返回最后一页
+            start = max(0, total - lines)
+        start = max(0, start)
+        end = min(total, start + lines)
+
+        content = []
+        for segment in segments:
+            first = max(start, segment.base) - segment.base
+            last = min(end, segment.base + segment.lines) - segment.base
+            if first < last:
+                content.extend(segment.index.read_lines(first, last))
+
+        return {
+            "content": ''.join(content),
+            "lines_read": end - start,
+            "total_lines": total,
+            "start_line": start,
+            "next_start_line": end if end < total else None,
+            "prev_start_line": max(0, start - lines) if start > 0 else None,
+            "cursor": self.cursor(segments, start),
+            "next_cursor": self.cursor(segments, end),
+            "files": [{"name": s.name, "lines": s.lines, "size": s.size} for s in segments],
+            "file_size": sum(s.size for s in segments),
+        }
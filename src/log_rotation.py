@@ -0,0 +1,298 @@
+import os
+import sys
+import gzip
+import time
+import zlib
+import fcntl
+import bisect
+import tarfile
+import threading
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+# 日志轮转和压缩配置
+LOG_ROTATION_CONFIG = {
+    'compress': os.getenv('LOG_COMPRESS_BACKUPS', 'true').lower() == 'true',  # 轮转后在后台把备份压缩为 .gz
+    'block_size': int(os.getenv('LOG_COMPRESS_BLOCK_SIZE', 1024 * 1024)),  # 压缩块大小，读取时最多解压一个块即可定位
+    'level': 6,
+    'chunk_size': 64 * 1024,  # 流式压缩下载时每次读取的字节数
+}
+
+
+def blocks_path(index_dir, stat) -> Path:
+    """按块压缩文件的块表，与行索引一样按 inode 命名"""
+    return Path(index_dir) / f"{stat.st_dev}-{stat.st_ino}.blocks"
+
+
+def compress_log(source, dest, index_dir, block_size=None, level=None, inode=None):
+    """把 source 压缩为由多个 gzip 成员组成的 dest，然后删除 source
+
+    每 block_size 字节为一个独立的 gzip 成员（整个文件仍然可以直接用 gunzip 解压），
+    每个成员的未压缩和压缩起始偏移写入块表，读取任意位置时只需解压所在的成员。
+    给出 inode 时只压缩该文件，source 已经换成其他文件时不做任何操作；删除前确认 source 仍然是压缩的文件。
+    多个进程轮转同一个文件时，调用方需要持有轮转锁。
+    """
+    block_size = block_size or LOG_ROTATION_CONFIG['block_size']
+    level = LOG_ROTATION_CONFIG['level'] if level is None else level
+    source, dest = Path(source), Path(dest)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    table = array('Q')
+    try:
+        with open(source, 'rb') as src:
+            compressed_inode = os.fstat(src.fileno()).st_ino
+            if inode is not None and compressed_inode != inode:
+                return
+            with open(tmp, 'wb') as out:
+                position = 0
+                while True:
+                    chunk = src.read(block_size)
+                    if not chunk:
+                        break
+                    table.extend((position, out.tell()))
+                    out.write(gzip.compress(chunk, compresslevel=level, mtime=0))
+                    position += len(chunk)
+                table.extend((position, out.tell()))
+                out.flush()
+                os.fsync(out.fileno())
+                stat = os.fstat(out.fileno())
+        # 块表在文件出现之前写好，读取方看到 .gz 文件时总能找到块表
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        table_path = blocks_path(index_dir, stat)
+        table_tmp = table_path.with_name(f".{table_path.name}.{os.getpid()}.tmp")
+        table_tmp.write_bytes(table.tobytes())
+        os.replace(table_tmp, table_path)
+        os.replace(tmp, dest)
+    except FileNotFoundError:
+        # 其他worker已经压缩并删除了该文件
+        tmp.unlink(missing_ok=True)
+        return
+    try:
+        if os.stat(source).st_ino == compressed_inode:
+            source.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class BlockGzipFile:
+    """按块压缩的日志备份，提供 seek/read 接口，读取的是解压后的内容
+
+    没有块表的 .gz 文件（例如手工压缩的）整体视为一个块，第一次读取时解压整个文件。
+    """
+
+    def __init__(self, path, table_path=None):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        compressed_size = os.fstat(self._file.fileno()).st_size
+        table = array('Q')
+        if table_path is not None and os.path.exists(table_path):
+            table.frombytes(Path(table_path).read_bytes())
+        if len(table) < 2 or table[-1] != compressed_size:
+            size = len(gzip.decompress(self._file.read()))
+            table = array('Q', (0, 0, size, compressed_size))
+        self._starts = table[0::2]
+        self._offsets = table[1::2]
+        self.size = self._starts[-1]
+        self._position = 0
+        self._cached = (None, b'')
+
+    def seek(self, offset, whence=0):
+        self._position = offset if whence == 0 else self._position + offset if whence == 1 else self.size + offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def _block(self, number) -> bytes:
+        if self._cached[0] != number:
+            self._file.seek(self._offsets[number])
+            data = self._file.read(self._offsets[number + 1] - self._offsets[number])
+            self._cached = (number, gzip.decompress(data))
+        return self._cached[1]
+
+    def read(self, size=-1) -> bytes:
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        parts = []
+        while self._position < end:
+            number = bisect.bisect_right(self._starts, self._position) - 1
+            start = self._position - self._starts[number]
+            piece = self._block(number)[start:start + end - self._position]
+            if not piece:
+                break
+            parts.append(piece)
+            self._position += len(piece)
+        return b''.join(parts)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_log(path, index_dir):
+    """打开日志文件或按块压缩的备份，返回可以 seek/read 解压后内容的文件对象"""
+    path = Path(path)
+    if path.name.endswith('.gz'):
+        return BlockGzipFile(path, blocks_path(index_dir, path.stat()))
+    return open(path, 'rb')
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """轮转后在后台线程中把 <文件>.1 压缩为 <文件>.1.gz 的 RotatingFileHandler
+
+    备份的命名为 <文件>.N.gz，原有的重命名顺序不变；写日志的线程只做一次重命名，不等待压缩。
+    多个worker各自持有同一个文件的处理器，轮转和压缩通过索引目录中的锁文件互斥：
+    轮转前发现文件已经被其他worker轮转时只重新打开新文件；还没有压缩的备份先压缩，再移动编号。
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=False,
+                 compress=None, index_dir=None):
+        super().__init__(filename, mode, maxBytes, backupCount, encoding, delay)
+        self.compress = LOG_ROTATION_CONFIG['compress'] if compress is None else compress
+        self.index_dir = Path(index_dir) if index_dir else Path(self.baseFilename).parent / '.index'
+        self.lock_path = self.index_dir / f"{Path(self.baseFilename).name}.rotate.lock"
+        self._pending = []
+        if self.compress:
+            self.namer = self._gz_name
+            self.rotator = self._rotate
+            # 上次运行中没有压缩完的备份
+            for number in range(1, backupCount + 1):
+                plain = f"{self.baseFilename}.{number}"
+                if os.path.exists(plain) and not os.path.exists(plain + '.gz'):
+                    self._submit(plain, plain + '.gz')
+
+    @staticmethod
+    def _gz_name(name):
+        return name + '.gz'
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='log-compress')
+            return cls._executor
+
+    @contextmanager
+    def _rotation_lock(self):
+        """所有进程共享的轮转锁，每次获取都重新打开锁文件，同一进程的多个线程之间同样互斥"""
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _submit(self, source, dest, inode=None):
+        self._pending.append(self._get_executor().submit(self._compress, source, dest, inode))
+
+    def _compress(self, source, dest, inode=None):
+        try:
+            with self._rotation_lock():
+                compress_log(source, dest, self.index_dir, inode=inode)
+        except Exception as e:
+            # 轮转时持有处理器的锁并等待压缩完成，这里不能再写日志
+            sys.stderr.write(f"压缩日志备份失败: {source}: {e}\n")
+
+    def _rotate(self, source, dest):
+        plain = dest[:-3]
+        os.replace(source, plain)
+        # 记录重命名的文件，压缩前其他worker再次轮转时不会压缩或删除别的文件
+        self._submit(plain, dest, os.stat(plain).st_ino)
+
+    def _stream_replaced(self) -> bool:
+        """打开的文件已经不是 baseFilename 指向的文件（被其他worker轮转）"""
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        return self.maxBytes > 0 and self._stream_replaced()
+
+    def doRollover(self):
+        self.wait()
+        with self._rotation_lock():
+            if self._stream_replaced():
+                self.stream.close()
+                self.stream = None
+                if not self.delay:
+                    self.stream = self._open()
+                return
+            if self.compress:
+                # 其他worker轮转后还没有压缩的备份，编号移动之前压缩
+                for number in range(1, self.backupCount + 1):
+                    plain = f"{self.baseFilename}.{number}"
+                    if os.path.exists(plain):
+                        compress_log(plain, plain + '.gz', self.index_dir)
+            super().doRollover()
+
+    def wait(self):
+        """等待本处理器提交的压缩任务完成（用于测试和退出）"""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+
+def gzip_stream(chunks: Iterable[bytes], level=None) -> Iterator[bytes]:
+    """流式 gzip 压缩"""
+    compressor = zlib.compressobj(LOG_ROTATION_CONFIG['level'] if level is None else level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def file_chunks(f, size: Optional[int] = None, chunk_size=None) -> Iterator[bytes]:
+    """从文件对象的当前位置读取 size 字节（None 表示到文件末尾）"""
+    chunk_size = chunk_size or LOG_ROTATION_CONFIG['chunk_size']
+    remaining = size
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def tar_stream(members) -> Iterator[bytes]:
+    """流式生成 tar 归档，members 为 (名称, 大小, 已打开的文件对象) 的序列，写完后关闭文件
+
+    文件在打包过程中可能继续增长，每个成员只读取开始时记录的大小。
+    """
+    members = list(members)
+    now = int(time.time())
+    try:
+        for name, size, f in members:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = now
+            info.mode = 0o644
+            yield info.tobuf(format=tarfile.GNU_FORMAT)
+            written = 0
+            for chunk in file_chunks(f, size):
+                written += len(chunk)
+                yield chunk
+            f.close()
+            if written < size:
+                # 文件在打包过程中被截断，用空字节补足声明的大小
+                yield b'\0' * (size - written)
+            if size % tarfile.BLOCKSIZE:
+                yield b'\0' * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+        yield b'\0' * (tarfile.BLOCKSIZE * 2)
+    finally:
+        for _, _, f in members:
+            f.close()
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import fcntl
+import logging
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 日志实时跟踪配置
+LOG_TAIL_CONFIG = {
+    'max_subscribers': int(os.getenv('LOG_TAIL_MAX_SUBSCRIBERS', 2)),  # 所有worker合计的同时订阅数，避免占满同步worker
+    'flush_interval': int(os.getenv('LOG_TAIL_FLUSH_INTERVAL_MS', 500)) / 1000,  # 每隔多久检查并发送一次新内容（秒）
+    'heartbeat': float(os.getenv('LOG_TAIL_HEARTBEAT', 15)),  # 没有新内容时发送心跳的间隔（秒），同时用于发现断开的连接
+    'max_duration': float(os.getenv('LOG_TAIL_MAX_DURATION', 600)),  # 单个连接的最长时间（秒），到期后由客户端带 Last-Event-ID 重连
+    'read_size': 256 * 1024,  # 每次检查最多读取的字节数
+    'backlog_max': 1000,  # 连接时最多补发的历史行数
+}
+
+
+class TailSlots:
+    """同一主机上所有worker共享的订阅名额
+
+    每个名额是一个锁文件，订阅期间持有其上的非阻塞排他锁；进程退出时锁自动释放，不会遗留占用。
+    """
+
+    def __init__(self, directory, count=None):
+        self.directory = Path(directory)
+        self.count = LOG_TAIL_CONFIG['max_subscribers'] if count is None else count
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def acquire(self):
+        """返回持有锁的文件对象，名额已满时返回 None"""
+        for slot in range(self.count):
+            handle = open(self.directory / f"slot-{slot}.lock", 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except BlockingIOError:
+                handle.close()
+        return None
+
+    def in_use(self) -> int:
+        used = 0
+        for slot in range(self.count):
+            with open(self.directory / f"slot-{slot}.lock", 'a') as handle:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                except BlockingIOError:
+                    used += 1
+        return used
+
+
+def parse_position(value) -> Optional[tuple]:
+    """解析 "<inode>:<字节偏移>" 形式的位置"""
+    try:
+        inode, offset = (int(part) for part in value.split(':', 1))
+    except (AttributeError, ValueError):
+        raise ValueError(f"无效的位置: {value}")
+    return inode, offset
+
+
+class LogFollower:
+    """跟踪一个不断追加的日志文件
+
+    保持文件句柄打开并记录已读取的偏移，每次 poll() 只读取新增的完整行。
+    文件被轮转（路径对应的 inode 变化）时先读完旧文件剩余的内容，再从头读取新文件；文件被截断时从头读取。
+    """
+
+    def __init__(self, path, inode=None, offset=None, backups=(), read_size=None):
+        self.path = Path(path)
+        self.read_size = read_size or LOG_TAIL_CONFIG['read_size']
+        self.rotations = 0
+        self._partial = b''
+        self._file = None
+        self.inode = None
+        self.offset = 0
+        if inode is not None:
+            # 从断开前的位置继续：文件可能已经被轮转成备份
+            for candidate in [self.path, *backups]:
+                if self._open(candidate, inode):
+                    self.offset = offset
+                    break
+        if self._file is None:
+            self._open(self.path)
+            self.offset = os.fstat(self._file.fileno()).st_size if self._file else 0
+
+    def _open(self, path, inode=None) -> bool:
+        try:
+            handle = open(path, 'rb')
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(handle.fileno())
+        if inode is not None and stat.st_ino != inode:
+            handle.close()
+            return False
+        if self._file is not None:
+            self._file.close()
+        self._file = handle
+        self.inode = stat.st_ino
+        self.offset = 0
+        self._partial = b''
+        return True
+
+    @property
+    def position(self) -> str:
+        """下一行在文件中的位置，可以传给新的 LogFollower 继续读取"""
+        return f"{self.inode}:{self.offset - len(self._partial)}"
+
+    def poll(self) -> List[str]:
+        if self._file is None:
+            self._open(self.path)
+            if self._file is None:
+                return []
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.offset:
+            logger.info("日志文件被截断，从头读取: %s", self.path)
+            self.offset = 0
+            self._partial = b''
+        lines = self._read()
+        if self.offset >= os.fstat(self._file.fileno()).st_size:
+            # 当前文件已经读完；如果路径已经指向新文件（轮转），下次从新文件开头读取
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = self.inode
+            if current != self.inode and self._open(self.path):
+                self.rotations += 1
+        return lines
+
+    def _read(self) -> List[str]:
+        self._file.seek(self.offset)
+        data = self._file.read(self.read_size)
+        if not data:
+            return []
+        self.offset += len(data)
+        data = self._partial + data
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        return data[:end].decode('utf-8', errors='replace').splitlines(keepends=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _frame(position, data) -> bytes:
+    return f"id: {position}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+def tail_events(follower: LogFollower, backlog: List[str] = (), flush_interval=None, heartbeat=None,
+                max_duration=None, sleep=time.sleep, clock=time.monotonic) -> Iterator[bytes]:
+    """把新追加的行按 flush_interval 合并成SSE事件
+
+    每个事件的 id 为读取位置，EventSource 断线重连时通过 Last-Event-ID 带回，从断开的位置继续。
+    一次读取的行放在同一个事件里（大小受 read_size 限制），保证 id 正好是事件中最后一行之后的位置。
+    """
+    flush_interval = LOG_TAIL_CONFIG['flush_interval'] if flush_interval is None else flush_interval
+    heartbeat = LOG_TAIL_CONFIG['heartbeat'] if heartbeat is None else heartbeat
+    max_duration = LOG_TAIL_CONFIG['max_duration'] if max_duration is None else max_duration
+
+    started = last_sent = clock()
+    yield f"retry: {int(flush_interval * 1000) + 1000}\n\n".encode('utf-8')
+    pending = list(backlog)
+    rotations = follower.rotations
+    while True:
+        pending.extend(follower.poll())
+        if pending:
+            yield _frame(follower.position, {"type": "lines", "lines": pending})
+            last_sent = clock()
+            pending = []
+        if follower.rotations != rotations:
+            rotations = follower.rotations
+            yield _frame(follower.position, {"type": "rotated"})
+        now = clock()
+        if now - started >= max_duration:
+            yield _frame(follower.position, {"type": "reconnect"})
+            return
+        if now - last_sent >= heartbeat:
+            # SSE 注释，客户端忽略；写入失败时服务器得以发现连接已断开
+            yield b": keepalive\n\n"
+            last_sent = now
+        sleep(flush_interval)
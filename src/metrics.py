@@ -0,0 +1,455 @@
+import os
+import json
+import mmap
+import time
+import bisect
+import struct
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Prometheus 指标配置
+METRICS_CONFIG = {
+    'enabled': os.getenv('METRICS_ENABLED', 'true').lower() == 'true',
+    # 每个worker的指标文件目录，为空时使用 STATE_DIR/metrics；服务启动前应清空
+    'dir': os.getenv('METRICS_DIR', '') or str(Path(os.getenv('STATE_DIR', '/tmp/aiapp')) / 'metrics'),
+    'initial_size': 64 * 1024,  # 指标文件的初始大小，写满后按两倍扩容
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 请求和上游调用耗时（秒）的默认分桶
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_LENGTH = struct.Struct('i')
+_VALUE = struct.Struct('d')
+
+
+class MmapValues:
+    """一个进程的指标值文件，按 key 保存 double 值
+
+    文件开头 8 字节记录已使用的长度，之后依次为 [key 长度][key（按 8 字节对齐补空格）][值]。
+    新 key 先写入数据再更新已使用长度，读取方（抓取 /metrics 的其他worker）读到的总是完整的条目；
+    已有 key 的更新只是原地改写 8 字节，进程内只需要一把锁。
+    """
+
+    def __init__(self, path, reset=False, initial_size=None):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if reset:
+            os.ftruncate(self._fd, 0)
+        capacity = os.fstat(self._fd).st_size
+        if capacity == 0:
+            capacity = initial_size or METRICS_CONFIG['initial_size']
+            os.ftruncate(self._fd, capacity)
+        self._capacity = capacity
+        self._mmap = mmap.mmap(self._fd, capacity)
+        self._used = _LENGTH.unpack_from(self._mmap, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            _LENGTH.pack_into(self._mmap, 0, self._used)
+        self._positions = {key: offset for key, _, offset in _entries(self._mmap, self._used)}
+
+    def _init_value(self, key: str) -> int:
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * ((-(len(encoded) + _LENGTH.size)) % 8)
+        entry = _LENGTH.pack(len(padded)) + padded + _VALUE.pack(0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._mmap.close()
+            os.ftruncate(self._fd, self._capacity)
+            self._mmap = mmap.mmap(self._fd, self._capacity)
+        self._mmap[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        _LENGTH.pack_into(self._mmap, 0, self._used)
+        offset = self._positions[key] = self._used - _VALUE.size
+        return offset
+
+    def add(self, key: str, amount: float):
+        with self._lock:
+            offset = self._positions.get(key)
+            if offset is None:
+                offset = self._init_value(key)
+            _VALUE.pack_into(self._mmap, offset, _VALUE.unpack_from(self._mmap, offset)[0] + amount)
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            offset = self._positions.get(key)
+            if offset is None:
+                offset = self._init_value(key)
+            _VALUE.pack_into(self._mmap, offset, value)
+
+    def close(self):
+        with self._lock:
+            self._mmap.close()
+            os.close(self._fd)
+
+
+def _entries(data, used) -> Iterator[Tuple[str, float, int]]:
+    position = 8
+    while position < used:
+        length = _LENGTH.unpack_from(data, position)[0]
+        position += _LENGTH.size
+        key = bytes(data[position:position + length]).decode('utf-8').rstrip(' ')
+        position += length
+        yield key, _VALUE.unpack_from(data, position)[0], position
+        position += _VALUE.size
+
+
+def read_values(path) -> Iterator[Tuple[str, float]]:
+    """读取一个指标文件中的所有值（不需要映射，直接读取文件内容）"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 8:
+        return
+    used = min(_LENGTH.unpack_from(data, 0)[0], len(data))
+    for key, value, _ in _entries(data, used):
+        yield key, value
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """指标的公共部分：名称、说明和标签名；每组标签值对应的 key 只序列化一次"""
+
+    type = ''
+    kind = 'counter'  # 写入哪一类文件：counter（累加，保留已退出进程的值）或 gauge（只统计存活的进程）
+
+    def __init__(self, registry, name, documentation, labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys: Dict[tuple, object] = {}
+
+    def _labelvalues(self, labels) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为: {', '.join(self.labelnames)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _key(self, labels) -> str:
+        # 关键字参数按标签名的顺序传入时，以原始的标签值直接命中缓存
+        raw = tuple(labels.values()) if tuple(labels) == self.labelnames else None
+        key = self._keys.get(raw)
+        if key is None:
+            values = self._labelvalues(labels)
+            key = self._keys[values] = json.dumps([self.name, values])
+            if raw is not None:
+                self._keys[raw] = key
+        return key
+
+    def samples(self, values: Dict[tuple, float]) -> List[Tuple[str, tuple, float]]:
+        return [(self.name, labelvalues, value) for (name, labelvalues), value in values.items() if name == self.name]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        if self.registry.enabled:
+            self.registry.store(self.kind).add(self._key(labels), amount)
+
+
+class Gauge(Metric):
+    """各worker的值相加；已退出的worker不计入"""
+
+    type = 'gauge'
+    kind = 'gauge'
+
+    def inc(self, amount=1.0, **labels):
+        if self.registry.enabled:
+            self.registry.store(self.kind).add(self._key(labels), amount)
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        if self.registry.enabled:
+            self.registry.store(self.kind).set(self._key(labels), value)
+
+
+class Histogram(Metric):
+    """直方图：每个分桶单独计数（非累积），输出时再按 le 累加"""
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+
+    def _key(self, labels):
+        raw = tuple(labels.values()) if tuple(labels) == self.labelnames else None
+        keys = self._keys.get(raw)
+        if keys is None:
+            values = self._labelvalues(labels)
+            keys = self._keys[values] = (
+                [json.dumps([f"{self.name}_bucket", values + (bound,)]) for bound in self._bounds],
+                json.dumps([f"{self.name}_sum", values]),
+                json.dumps([f"{self.name}_count", values]),
+            )
+            if raw is not None:
+                self._keys[raw] = keys
+        return keys
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        buckets, total, count = self._key(labels)
+        store = self.registry.store(self.kind)
+        store.add(buckets[bisect.bisect_left(self.buckets, value)], 1.0)
+        store.add(total, value)
+        store.add(count, 1.0)
+
+    def samples(self, values):
+        series: Dict[tuple, Dict[str, float]] = {}
+        for (name, labelvalues), value in values.items():
+            if name == f"{self.name}_bucket":
+                series.setdefault(labelvalues[:-1], {})[labelvalues[-1]] = value
+            elif name in (f"{self.name}_sum", f"{self.name}_count"):
+                series.setdefault(labelvalues, {})
+        result = []
+        for labelvalues in sorted(series):
+            cumulative = 0.0
+            for bound in self._bounds:
+                cumulative += series[labelvalues].get(bound, 0.0)
+                result.append((f"{self.name}_bucket", labelvalues + (bound,), cumulative))
+            result.append((f"{self.name}_sum", labelvalues, values.get((f"{self.name}_sum", labelvalues), 0.0)))
+            result.append((f"{self.name}_count", labelvalues, values.get((f"{self.name}_count", labelvalues), 0.0)))
+        return result
+
+
+class MetricsRegistry:
+    """多进程共享的指标注册表
+
+    与 prometheus_client 的多进程模式相同：每个worker把值写入自己的 mmap 文件（counter_<pid>.db、gauge_<pid>.db），
+    更新只是进程内的一次内存写入；任何一个worker收到 /metrics 请求时读取目录中的所有文件并汇总。
+    计数器和直方图保留已退出进程的值；仪表只统计仍然存活的进程，已退出进程的文件在汇总时删除。
+    """
+
+    def __init__(self, directory=None, enabled=None):
+        self.directory = Path(directory or METRICS_CONFIG['dir'])
+        self.enabled = METRICS_CONFIG['enabled'] if enabled is None else enabled
+        self.metrics: List[Metric] = []
+        self._collectors: List[Callable[[Dict[tuple, float]], None]] = []
+        self._stores: Dict[str, MmapValues] = {}
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_stores)
+
+    def _forget_stores(self):
+        # fork 出的子进程不能继续写父进程的文件
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self, kind) -> MmapValues:
+        store = self._stores.get(kind)
+        if store is None:
+            with self._lock:
+                store = self._stores.get(kind)
+                if store is None:
+                    self.directory.mkdir(parents=True, exist_ok=True)
+                    store = MmapValues(self.directory / f"{kind}_{os.getpid()}.db", reset=(kind == 'gauge'))
+                    self._stores[kind] = store
+        return store
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[Dict[tuple, float]], None]):
+        """注册抓取时调用的函数，参数为汇总后的 {(样本名, 标签值): 值}，可以补充或派生样本"""
+        self._collectors.append(collector)
+
+    def collect(self) -> Dict[tuple, float]:
+        """汇总目录中所有worker的值"""
+        values: Dict[tuple, float] = {}
+        if not self.directory.exists():
+            return values
+        for path in self.directory.glob('*.db'):
+            kind, _, pid = path.stem.partition('_')
+            if kind == 'gauge' and pid.isdigit() and not _pid_alive(int(pid)):
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                entries = list(read_values(path))
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning("读取指标文件失败: %s: %s", path.name, e)
+                continue
+            for key, value in entries:
+                name, labelvalues = json.loads(key)
+                sample = (name, tuple(labelvalues))
+                values[sample] = values.get(sample, 0.0) + value
+        return values
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        values = self.collect()
+        for collector in self._collectors:
+            try:
+                collector(values)
+            except Exception:
+                logger.exception("指标收集失败")
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            labelnames = metric.labelnames + ('le',) if metric.type == 'histogram' else metric.labelnames
+            for name, labelvalues, value in metric.samples(values):
+                names = labelnames if name.endswith('_bucket') else metric.labelnames
+                if names:
+                    labels = ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, labelvalues))
+                    lines.append(f"{name}{{{labels}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """删除所有指标文件（服务启动和测试时使用）"""
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores = {}
+            if self.directory.exists():
+                for path in self.directory.glob('*.db'):
+                    path.unlink(missing_ok=True)
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    'aiapp_http_request_duration_seconds', '请求从开始处理到最后一个字节发出的耗时（流式响应包括整个流）',
+    ('route', 'method', 'status'))
+UPSTREAM_DURATION = registry.histogram(
+    'aiapp_upstream_request_duration_seconds', '上游接口调用耗时，流式接口计到收到响应头为止',
+    ('operation', 'outcome'))
+CHAT_TTFT = registry.histogram(
+    'aiapp_chat_time_to_first_token_seconds', '聊天请求从开始处理到收到第一个内容增量的时间',
+    buckets=(0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 20.0))
+CHAT_TOKENS_PER_SECOND = registry.histogram(
+    'aiapp_chat_tokens_per_second', '首个内容增量之后的输出速度（每个内容增量按一个token估算）',
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300))
+CHAT_CHUNKS = registry.histogram(
+    'aiapp_chat_chunks_per_reply', '每次回复收到的上游数据块数',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+CHAT_ACTIVE_STREAMS = registry.gauge('aiapp_chat_active_streams', '正在输出的聊天流')
+CHAT_STREAMS = registry.counter(
+    'aiapp_chat_streams_total', '结束的聊天流，按结束方式：completed/stopped(用户停止)/cancelled(客户端断开)/error',
+    ('outcome',))
+CACHE_REQUESTS = registry.counter(
+    'aiapp_cache_requests_total', '缓存查询次数；image 的 result 为 hit/shared/miss/bypass，download 为 hit/miss',
+    ('cache', 'result'))
+CACHE_HIT_RATIO = registry.gauge('aiapp_cache_hit_ratio', '缓存命中率（image 的 shared 计为命中，不含 bypass）', ('cache',))
+UPSTREAM_CONNECTIONS = registry.counter(
+    'aiapp_upstream_connections_total', '从上游连接池取出连接(checkout)和新建连接(handshake)的次数', ('event',))
+UPSTREAM_POOL = registry.gauge(
+    'aiapp_upstream_pool_connections', '每个主机连接池的空闲连接数(idle)和容量(maxsize)，各worker相加', ('pool', 'state'))
+
+
+def cache_hit_ratio(values):
+    """由 aiapp_cache_requests_total 派生各缓存的命中率，在其他收集函数补充完样本之后注册"""
+    totals: Dict[str, List[float]] = {}
+    for (name, labelvalues), value in list(values.items()):
+        if name != CACHE_REQUESTS.name or labelvalues[1] == 'bypass':
+            continue
+        counts = totals.setdefault(labelvalues[0], [0.0, 0.0])
+        counts[1] += value
+        if labelvalues[1] in ('hit', 'shared'):
+            counts[0] += value
+    for cache, (hits, total) in totals.items():
+        values[(CACHE_HIT_RATIO.name, (cache,))] = round(hits / total, 4) if total else 0.0
+
+
+def upstream_outcome(status: Optional[int]) -> str:
+    if status is None:
+        return 'ok'
+    if status in (429, 503):
+        return 'throttled'
+    return 'ok' if status < 400 else 'http_error'
+
+
+class UpstreamTimer:
+    """记录一次上游调用的耗时；with 块内抛出异常时 outcome 为 error，否则按 status 分类"""
+
+    __slots__ = ('operation', 'status', 'started')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.status = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = 'error' if exc_type is not None else upstream_outcome(self.status)
+        UPSTREAM_DURATION.observe(time.perf_counter() - self.started, operation=self.operation, outcome=outcome)
+        return False
+
+
+class ChatStreamMetrics:
+    """一次聊天流的统计
+
+    流式输出的循环里只做属性赋值和计数，结束时 finish() 一次性写入直方图。
+    """
+
+    __slots__ = ('started', 'first_delta', 'deltas', 'chunks', 'outcome')
+
+    def __init__(self, started):
+        self.started = started
+        self.first_delta = None
+        self.deltas = 0
+        self.chunks = 0
+        self.outcome = 'cancelled'  # 没有走到结束分支（生成器被关闭）时视为客户端断开
+        CHAT_ACTIVE_STREAMS.inc()
+
+    def delta(self):
+        """收到一个非空的内容增量"""
+        if self.first_delta is None:
+            self.first_delta = time.perf_counter()
+        self.deltas += 1
+
+    def finish(self):
+        now = time.perf_counter()
+        CHAT_ACTIVE_STREAMS.dec()
+        CHAT_STREAMS.inc(outcome=self.outcome)
+        CHAT_CHUNKS.observe(self.chunks)
+        if self.first_delta is not None:
+            CHAT_TTFT.observe(self.first_delta - self.started)
+            if self.deltas > 1 and now > self.first_delta:
+                CHAT_TOKENS_PER_SECOND.observe((self.deltas - 1) / (now - self.first_delta))
@@ -0,0 +1,138 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+from .stats import Histogram
+
+logger = logging.getLogger(__name__)
+
+# 图像请求微批处理配置
+# 只用于批量接口和异步任务：同步worker每个进程只有一个请求线程，/api/generate 的请求之间无法合并
+MICRO_BATCH_CONFIG = {
+    'enabled': os.getenv('IMAGE_MICRO_BATCH', 'false').lower() == 'true',
+    'window_ms': int(os.getenv('IMAGE_MICRO_BATCH_WINDOW_MS', 50)),  # 第一个请求到达后等待合并的时间（毫秒）
+    'max_batch_size': int(os.getenv('IMAGE_MICRO_BATCH_MAX_SIZE', 4)),  # 合并后的 batch_size 上限，受账户等级限制
+}
+
+# 合并的请求必须相同的参数；上游一次调用只接受一个提示词，因此提示词也必须相同
+BATCH_KEY_FIELDS = ('model', 'prompt', 'width', 'height', 'num_inference_steps', 'guidance_scale', 'variation_strength')
+
+
+class _PendingBatch:
+    __slots__ = ('payload', 'waiters', 'size', 'full')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.waiters: List[Tuple[int, float, Future]] = []
+        self.size = 0
+        self.full = threading.Event()
+
+
+def batch_key(payload) -> tuple:
+    return tuple(payload.get(field) for field in BATCH_KEY_FIELDS)
+
+
+def split_images(body, counts):
+    """把合并调用返回的图片按各请求的数量依次分配，图片不足时后面的请求得到错误"""
+    images = body.get('images', [])
+    results = []
+    offset = 0
+    for count in counts:
+        share = images[offset:offset + count]
+        offset += count
+        if share:
+            results.append(({**body, 'images': share}, 200))
+        else:
+            results.append(({"error": "生成图像失败，未返回图像URL"}, 500))
+    return results
+
+
+class MicroBatcher:
+    """把短时间内参数相同的随机种子图像请求合并为一次上游调用
+
+    第一个请求到达后等待 window_ms，期间参数相同的请求加入同一批，batch_size 累加到 max_batch_size 为止；
+    然后由第一个请求所在的线程发起一次调用，返回的图片按顺序拆分给各个请求。
+    只在同一进程的线程之间合并（批量接口、异步任务、多线程worker）。
+    """
+
+    def __init__(self, window_ms=None, max_batch_size=None, enabled=None, clock=time.monotonic):
+        self.window = (MICRO_BATCH_CONFIG['window_ms'] if window_ms is None else window_ms) / 1000
+        self.max_batch_size = MICRO_BATCH_CONFIG['max_batch_size'] if max_batch_size is None else max_batch_size
+        self.enabled = MICRO_BATCH_CONFIG['enabled'] if enabled is None else enabled
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending: Dict[tuple, _PendingBatch] = {}
+        self.batch_sizes = Histogram([1, 2, 3, 4, 8, 16])
+        self.wait_ms = Histogram([1, 5, 10, 25, 50, 100, 250, 500, 1000])
+        self.requests = 0
+        self.calls = 0
+
+    def submit(self, payload, generate: Callable[[Dict], tuple]):
+        """返回 (响应数据, 状态码)，generate(payload) 为实际的上游调用"""
+        count = payload.get('batch_size', 1)
+        key = batch_key(payload)
+        future = Future()
+        with self._lock:
+            self.requests += 1
+            batch = self._pending.get(key)
+            if batch is not None and batch.size + count <= self.max_batch_size:
+                batch.waiters.append((count, self._clock(), future))
+                batch.size += count
+                if batch.size >= self.max_batch_size:
+                    self._pending.pop(key, None)
+                    batch.full.set()
+                leader = False
+            else:
+                batch = _PendingBatch(payload)
+                batch.waiters.append((count, self._clock(), future))
+                batch.size = count
+                leader = True
+                if count < self.max_batch_size:
+                    self._pending[key] = batch
+                else:
+                    batch.full.set()
+
+        if not leader:
+            return future.result()
+
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            waiters = list(batch.waiters)
+            self.calls += 1
+            self.batch_sizes.observe(batch.size)
+            dispatched = self._clock()
+            for _, queued_at, _ in waiters:
+                self.wait_ms.observe((dispatched - queued_at) * 1000)
+
+        if len(waiters) > 1:
+            logger.info("合并 %d 个图像请求为一次调用，batch_size: %d", len(waiters), batch.size)
+        try:
+            body, status = generate({**batch.payload, 'batch_size': batch.size})
+            if status == 200:
+                results = split_images(body, [count for count, _, _ in waiters])
+            else:
+                results = [(body, status)] * len(waiters)
+            for (_, _, waiter), result in zip(waiters, results):
+                waiter.set_result(result)
+        except BaseException as e:
+            for _, _, waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        return future.result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+                'requests': self.requests,
+                'calls': self.calls,
+                'batch_size': self.batch_sizes.snapshot(),
+                'wait_ms': self.wait_ms.snapshot(),
+            }
@@ -0,0 +1,3 @@
+from .rate_limit import RATE_LIMIT_CONFIG, RateLimiter, init_rate_limiter
+
+__all__ = ['RATE_LIMIT_CONFIG', 'RateLimiter', 'init_rate_limiter']
@@ -1,14 +1,228 @@
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-
-limiter = Limiter(
-    app=app,
-    key_func=get_remote_address,
-    default_limits=[os.getenv("RATE_LIMIT", "5 per minute")]
-)
-
-@app.after_request
-def inject_headers(response):
-    response.headers["X-RateLimit-Limit"] = str(limiter.current_limit.limit.amount)
-    response.headers["X-RateLimit-Remaining"] = str(limiter.current_limit.remaining)
-    return response 
\ No newline at end of file
+import os
+import re
+import math
+import time
+import sqlite3
+import logging
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flask import g, jsonify, request
+
+from ..sqlite_state import SQLiteState
+
+logger = logging.getLogger(__name__)
+
+# 速率限制配置，格式与 "5 per minute"、"100/hour" 相同，多个限制用分号分隔，空字符串表示不限制
+RATE_LIMIT_CONFIG = {
+    'enabled': os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true',
+    'trust_proxy': os.getenv('RATE_LIMIT_TRUST_PROXY', 'true').lower() == 'true',  # 使用nginx传入的 X-Real-IP 作为客户端IP
+    'routes': {
+        '/api/generate': os.getenv('RATE_LIMIT_GENERATE', os.getenv('RATE_LIMIT', '5 per minute')),
+        '/api/generate/batch': os.getenv('RATE_LIMIT_GENERATE_BATCH', '5 per minute'),
+        '/api/jobs/images': os.getenv('RATE_LIMIT_JOBS', '30 per minute'),
+        '/api/chat': os.getenv('RATE_LIMIT_CHAT', '20 per minute; 300 per hour'),
+    },
+}
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+Limit = namedtuple('Limit', ['count', 'period'])
+
+
+def parse_limits(spec) -> List[Limit]:
+    """解析 "5 per minute; 100/hour" 形式的限制"""
+    limits = []
+    for part in (spec or '').split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)\s*(?:per|/)\s*(\d*)\s*(second|minute|hour|day)s?', part)
+        if not match:
+            raise ValueError(f"无效的速率限制: {part}")
+        count, multiplier, unit = match.groups()
+        limits.append(Limit(int(count), PERIODS[unit] * int(multiplier or 1)))
+    return limits
+
+
+class RateDecision:
+    """一次检查的结果，对应最严格的那个限制"""
+
+    __slots__ = ('allowed', 'limit', 'remaining', 'reset_after', 'retry_after')
+
+    def __init__(self, allowed, limit, remaining, reset_after, retry_after=0.0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_after = reset_after
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            'X-RateLimit-Limit': str(self.limit.count),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    """基于 GCRA 的速率限制器，状态保存在 SQLite(WAL 模式) 中，同一主机的所有 worker 共享
+
+    每个键只保存一个理论到达时间(TAT)，每次检查是一次主键读写，与请求量和窗口长度无关。
+    一次请求的多个键（IP、会话）和多个限制在同一个事务中检查，任意一个超限时都不计数。
+    """
+
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        key TEXT PRIMARY KEY,
+        tat REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_rate_limits_tat ON rate_limits(tat);
+    CREATE TABLE IF NOT EXISTS limiter_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO limiter_stats (name, value) VALUES ('allowed', 0), ('rejected', 0);
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = str(path)
+        self._clock = clock
+        self._next_purge = 0
+        self._db = SQLiteState(self.path, self.SCHEMA, self.SCHEMA_VERSION)
+
+    def _conn(self):
+        return self._db.conn()
+
+    def hit(self, checks: Iterable[Tuple[str, Limit]]) -> Optional[RateDecision]:
+        """对 [(键, 限制), ...] 计一次请求，返回最严格的结果；没有需要检查的限制时返回 None"""
+        checks = list(checks)
+        if not checks:
+            return None
+        now = self._clock()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            updates = []
+            decision = None
+            for key, limit in checks:
+                row = conn.execute('SELECT tat FROM rate_limits WHERE key = ?', (key,)).fetchone()
+                interval = limit.period / limit.count
+                tat = max(row[0], now) if row else now
+                new_tat = tat + interval
+                allow_at = new_tat - limit.period
+                if now < allow_at:
+                    result = RateDecision(False, limit, 0, tat - now, allow_at - now)
+                else:
+                    remaining = int((limit.period - (new_tat - now)) // interval)
+                    result = RateDecision(True, limit, remaining, new_tat - now)
+                    updates.append((key, new_tat))
+                if decision is None or self._stricter(result, decision):
+                    decision = result
+
+            if decision.allowed:
+                conn.executemany('INSERT OR REPLACE INTO rate_limits (key, tat) VALUES (?, ?)', updates)
+            conn.execute('UPDATE limiter_stats SET value = value + 1 WHERE name = ?',
+                         ('allowed' if decision.allowed else 'rejected',))
+            if now >= self._next_purge:
+                # TAT 已经过去的键与不存在等价，定期删除
+                self._next_purge = now + 60
+                conn.execute('DELETE FROM rate_limits WHERE tat < ?', (now,))
+        return decision
+
+    @staticmethod
+    def _stricter(candidate, current):
+        if candidate.allowed != current.allowed:
+            return not candidate.allowed
+        if not candidate.allowed:
+            return candidate.retry_after > current.retry_after
+        return candidate.remaining < current.remaining
+
+    def reset(self):
+        """清除所有计数"""
+        with self._conn() as conn:
+            conn.execute('DELETE FROM rate_limits')
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._conn()
+        stats = dict(conn.execute('SELECT name, value FROM limiter_stats').fetchall())
+        stats['keys'] = conn.execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+        return stats
+
+
+def client_ip(headers, remote_addr, trust_proxy=None) -> str:
+    """客户端IP：经过nginx代理时使用 X-Real-IP，否则使用连接的对端地址"""
+    trust = RATE_LIMIT_CONFIG['trust_proxy'] if trust_proxy is None else trust_proxy
+    if trust and headers.get('X-Real-IP'):
+        return headers['X-Real-IP'].strip()
+    return remote_addr or '-'
+
+
+def build_checks(route, limits: List[Limit], ip, session_id=None) -> List[Tuple[str, Limit]]:
+    """每个限制分别按IP和（如果有）会话ID计数"""
+    checks = []
+    for limit in limits:
+        suffix = f"{limit.count}/{limit.period}"
+        checks.append((f"{route}|ip:{ip}|{suffix}", limit))
+        if session_id:
+            checks.append((f"{route}|session:{session_id}|{suffix}", limit))
+    return checks
+
+
+def route_limits(routes=None) -> Dict[str, List[Limit]]:
+    routes = RATE_LIMIT_CONFIG['routes'] if routes is None else routes
+    return {route: parse_limits(spec) for route, spec in routes.items() if parse_limits(spec)}
+
+
+def _request_session_id():
+    session_id = request.args.get('session_id')
+    if not session_id and request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            session_id = data.get('session_id')
+    return session_id if isinstance(session_id, str) else None
+
+
+def init_rate_limiter(app, limiter: RateLimiter, routes=None):
+    """为 Flask 应用注册按路由配置的速率限制
+
+    超限的请求直接返回429和 Retry-After；受限路由的响应都带有 X-RateLimit-* 头。
+    """
+    limits_by_route = route_limits(routes)
+
+    @app.before_request
+    def check_rate_limit():
+        if not RATE_LIMIT_CONFIG['enabled'] or request.method == 'OPTIONS' or request.url_rule is None:
+            return None
+        limits = limits_by_route.get(request.url_rule.rule)
+        if not limits:
+            return None
+        ip = client_ip(request.headers, request.remote_addr)
+        session_id = _request_session_id()
+        try:
+            decision = limiter.hit(build_checks(request.url_rule.rule, limits, ip, session_id))
+        except sqlite3.Error as e:
+            # 限流存储不可用时放行请求，不影响服务
+            logger.error(f"速率限制检查失败: {str(e)}")
+            return None
+        g.rate_limit = decision
+        if not decision.allowed:
+            logger.warning("触发速率限制 | 路径: %s | IP: %s | 会话: %s | %d/%ds",
+                           request.path, ip, session_id or '-', decision.limit.count, decision.limit.period)
+            response = jsonify({"error": "请求过于频繁，请稍后重试", "retry_after": math.ceil(decision.retry_after)})
+            response.status_code = 429
+            return response
+        return None
+
+    @app.after_request
+    def add_rate_limit_headers(response):
+        decision = g.pop('rate_limit', None)
+        if decision is not None:
+            response.headers.update(decision.headers())
+        return response
+
+    return limiter
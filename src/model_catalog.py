@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from .context_window import update_model_limits
+
+logger = logging.getLogger(__name__)
+
+# 模型目录配置
+MODEL_CATALOG_CONFIG = {
+    'ttl': int(os.getenv('MODEL_CATALOG_TTL', 600)),  # 目录快照的有效期（秒），过期后在后台刷新
+    'retry_interval': int(os.getenv('MODEL_CATALOG_RETRY_INTERVAL', 60)),  # 刷新失败后的重试间隔（秒）
+    'refresh': os.getenv('MODEL_CATALOG_REFRESH', 'true').lower() == 'true',  # 为 false 时只使用内置模型列表
+}
+
+# 内置模型列表，上游不可用时使用；也为上游返回的同名模型补充名称、说明和上下文长度
+DEFAULT_MODELS = {
+    "models": [
+        {
+            "id": "deepseek-ai/DeepSeek-V3",
+            "name": "DeepSeek-V3",
+            "description": "综合",
+            "context_length": 65536
+        },
+        {
+            "id": "deepseek-ai/DeepSeek-R1",
+            "name": "DeepSeek R1",
+            "description": "推理",
+            "context_length": 65536
+        },
+        {
+            "id": "Qwen/Qwen2.5-72B-Instruct-128K",
+            "name": "Qwen/Qwen2.5-72B-Instruct-128K",
+            "description": "编码",
+            "context_length": 131072
+        },
+        {
+            "id": "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
+            "name": "DeepSeek R1-Distill-Qwen-7B",
+            "description": "免费",
+            "context_length": 32768
+        }
+    ]
+}
+
+
+def merge_models(upstream: List[Dict], defaults: List[Dict]) -> List[Dict]:
+    """把上游模型列表转换为前端使用的格式
+
+    内置列表中的模型保持原有顺序排在前面并使用内置的名称和说明，其余模型按上游顺序追加。
+    上游没有返回的内置模型不再显示。
+    """
+    known = {model['id']: model for model in defaults}
+    available = {}
+    for item in upstream:
+        model_id = item.get('id')
+        if not model_id or model_id in available:
+            continue
+        entry = dict(known.get(model_id) or {"id": model_id, "name": model_id, "description": ""})
+        if item.get('context_length'):
+            entry['context_length'] = int(item['context_length'])
+        available[model_id] = entry
+
+    ordered = [available.pop(model['id']) for model in defaults if model['id'] in available]
+    return ordered + list(available.values())
+
+
+class CatalogSnapshot:
+    """某一时刻的模型目录"""
+
+    __slots__ = ('body', 'etag', 'source', 'fetched_at', 'models_by_id')
+
+    def __init__(self, models, source, fetched_at):
+        self.body = {"models": models}
+        canonical = json.dumps(self.body, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        self.etag = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+        self.source = source
+        self.fetched_at = fetched_at
+        self.models_by_id = {model['id']: model for model in models}
+
+
+class ModelCatalog:
+    """带TTL的模型目录，过期后在后台刷新，刷新期间继续返回旧快照
+
+    上游不可用时保留上一次成功的快照；从未成功时使用内置模型列表。
+    每次更新快照时同步各模型的上下文长度，供上下文裁剪使用。
+    """
+
+    def __init__(self, client_factory, defaults=None, ttl=None, retry_interval=None, refresh=None, clock=time.monotonic):
+        self._client_factory = client_factory
+        self._defaults = (defaults or DEFAULT_MODELS)["models"]
+        self.ttl = MODEL_CATALOG_CONFIG['ttl'] if ttl is None else ttl
+        self.retry_interval = MODEL_CATALOG_CONFIG['retry_interval'] if retry_interval is None else retry_interval
+        self.refresh_enabled = MODEL_CATALOG_CONFIG['refresh'] if refresh is None else refresh
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._refreshing: Optional[threading.Thread] = None
+        self._snapshot = CatalogSnapshot(list(self._defaults), 'default', None)
+        # 内置快照立即视为过期，第一次请求时开始加载上游目录
+        self._next_refresh = clock()
+        self.refreshes = 0
+        self.failures = 0
+        update_model_limits(self._defaults)
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        return self._snapshot
+
+    def get(self) -> CatalogSnapshot:
+        """返回当前快照，过期时在后台开始刷新，不等待刷新完成"""
+        if self.refresh_enabled and self._clock() >= self._next_refresh:
+            with self._lock:
+                if self._refreshing is None and self._clock() >= self._next_refresh:
+                    self._refreshing = threading.Thread(target=self.refresh, name='model-catalog-refresh', daemon=True)
+                    self._refreshing.start()
+        return self._snapshot
+
+    def wait_refresh(self, timeout=None):
+        """等待正在进行的后台刷新结束"""
+        thread = self._refreshing
+        if thread is not None:
+            thread.join(timeout)
+
+    def refresh(self) -> bool:
+        """从上游加载模型目录，成功时替换快照"""
+        try:
+            data = self._client_factory().get_models(model_type='text', sub_type='chat')
+            models = merge_models(data.get('data', []), self._defaults)
+            if not models:
+                raise ValueError("上游模型列表为空")
+            snapshot = CatalogSnapshot(models, 'upstream', time.time())
+            update_model_limits(models)
+            self._snapshot = snapshot
+            self._next_refresh = self._clock() + self.ttl
+            self.refreshes += 1
+            logger.info("模型目录已刷新，共 %d 个模型", len(models))
+            return True
+        except Exception as e:
+            self.failures += 1
+            self._next_refresh = self._clock() + self.retry_interval
+            logger.warning("刷新模型目录失败，继续使用%s模型列表: %s",
+                           "内置" if self._snapshot.source == 'default' else "上一次的", str(e))
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+    def model_info(self, model_id) -> Optional[Dict]:
+        """返回模型的元数据（名称、说明、上下文长度等），不在目录中时返回 None"""
+        return self._snapshot.models_by_id.get(model_id)
+
+    def stats(self) -> Dict:
+        snapshot = self._snapshot
+        return {
+            'source': snapshot.source,
+            'models': len(snapshot.body['models']),
+            'etag': snapshot.etag,
+            'fetched_at': snapshot.fetched_at,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+        }
@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 上游调用重试和熔断配置
+RESILIENCE_CONFIG = {
+    'max_retries': int(os.getenv('UPSTREAM_MAX_RETRIES', 2)),  # 单次调用最多重试次数
+    'retry_base_delay': float(os.getenv('UPSTREAM_RETRY_BASE_DELAY', 0.2)),  # 第一次重试的最大等待（秒），之后按指数增长
+    'retry_max_delay': float(os.getenv('UPSTREAM_RETRY_MAX_DELAY', 2)),
+    'retry_budget_ratio': float(os.getenv('UPSTREAM_RETRY_BUDGET_RATIO', 0.1)),  # 重试次数占请求数的比例上限
+    'retry_budget_min_per_second': float(os.getenv('UPSTREAM_RETRY_BUDGET_MIN', 1)),  # 请求很少时每秒至少允许的重试数
+    'breaker_failures': int(os.getenv('UPSTREAM_BREAKER_FAILURES', 5)),  # 连续失败多少次后熔断
+    'breaker_reset': float(os.getenv('UPSTREAM_BREAKER_RESET', 30)),  # 熔断后多少秒开始放行探测请求
+    'breaker_probes': int(os.getenv('UPSTREAM_BREAKER_PROBES', 1)),  # 半开状态下同时放行的探测请求数
+}
+
+# 首字节之前出现即可安全重试的上游状态码
+RETRYABLE_STATUS = (500, 502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，上游调用被直接拒绝"""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"上游服务暂时不可用（{endpoint}），请 {retry_after:.0f} 秒后重试")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base=None, cap=None) -> float:
+    """第 attempt 次重试前的等待时间（全抖动指数退避）"""
+    base = RESILIENCE_CONFIG['retry_base_delay'] if base is None else base
+    cap = RESILIENCE_CONFIG['retry_max_delay'] if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RetryBudget:
+    """进程内的全局重试预算
+
+    每个请求存入 ratio 个令牌，每次重试取出一个；另外每秒补充 min_per_second 个，保证低流量时也能重试。
+    上游整体故障时重试总量被限制在请求量的 ratio 倍左右，不会放大流量。
+    """
+
+    def __init__(self, ratio=None, min_per_second=None, capacity=10, clock=time.monotonic):
+        self.ratio = RESILIENCE_CONFIG['retry_budget_ratio'] if ratio is None else ratio
+        self.min_per_second = RESILIENCE_CONFIG['retry_budget_min_per_second'] if min_per_second is None else min_per_second
+        self.capacity = capacity
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self.exhausted = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self._clock())
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(self._clock())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(self._clock())
+            return self._tokens
+
+
+class CircuitBreaker:
+    """单个上游接口的熔断器
+
+    连续失败 failure_threshold 次后打开，打开期间直接拒绝调用；reset_timeout 秒后进入半开状态，
+    放行最多 probes 个探测请求：探测成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, endpoint, failure_threshold=None, reset_timeout=None, probes=None, clock=time.monotonic):
+        self.endpoint = endpoint
+        self.failure_threshold = RESILIENCE_CONFIG['breaker_failures'] if failure_threshold is None else failure_threshold
+        self.reset_timeout = RESILIENCE_CONFIG['breaker_reset'] if reset_timeout is None else reset_timeout
+        self.probes = RESILIENCE_CONFIG['breaker_probes'] if probes is None else probes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def before_call(self):
+        """调用前检查，熔断时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = self._clock()
+            if self.state == OPEN:
+                remaining = self.opened_at + self.reset_timeout - now
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.endpoint, remaining)
+                self.state = HALF_OPEN
+                self._probing = 0
+                logger.info("熔断器进入半开状态，放行探测请求: %s", self.endpoint)
+            if self._probing >= self.probes:
+                self.rejected += 1
+                raise CircuitOpenError(self.endpoint, self.reset_timeout)
+            self._probing += 1
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("探测请求成功，熔断器关闭: %s", self.endpoint)
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = self._clock()
+                self._probing = 0
+                self.trips += 1
+                logger.warning("上游接口 %s 连续失败 %d 次，熔断 %.0f 秒", self.endpoint, self.failures, self.reset_timeout)
+
+    def record_ignored(self):
+        """调用在到达上游之前失败（如本地排队超时），不影响熔断状态，只归还探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing > 0:
+                self._probing -= 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+
+class Resilience:
+    """上游调用的重试和熔断
+
+    只重试可以安全重发的失败：连接没有建立（连接错误、连接超时），或收到首字节之前上游返回 5xx。
+    重试前按全抖动指数退避等待，并从全局重试预算中取令牌；预算不足时直接返回失败。
+    """
+
+    def __init__(self, max_retries=None, budget: Optional[RetryBudget] = None, sleep=time.sleep, breaker_options=None):
+        self.max_retries = RESILIENCE_CONFIG['max_retries'] if max_retries is None else max_retries
+        self.budget = budget or RetryBudget()
+        self._sleep = sleep
+        self._breaker_options = breaker_options or {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def breaker(self, endpoint) -> CircuitBreaker:
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(endpoint, CircuitBreaker(endpoint, **self._breaker_options))
+        return breaker
+
+    def _should_retry(self, endpoint, attempt, reason):
+        if attempt >= self.max_retries:
+            return None
+        if not self.budget.withdraw():
+            logger.warning("重试预算不足，不再重试 %s: %s", endpoint, reason)
+            return None
+        with self._lock:
+            self.retries += 1
+        delay = backoff_delay(attempt)
+        logger.warning("上游调用 %s 失败（%s），%.2f秒后第 %d 次重试", endpoint, reason, delay, attempt + 1)
+        return delay
+
+    def call(self, endpoint, send: Callable, retryable_errors: Tuple, failure_errors: Tuple = (), discard: Callable = None):
+        """执行 send() 并返回其结果（响应对象，或第一个元素为响应对象的元组）
+
+        retryable_errors 中的异常会被重试；failure_errors 中的异常（如读取超时）不重试，但计入熔断失败次数；
+        其他异常视为没有到达上游。被放弃的 5xx 响应交给 discard() 释放；最后一次的失败原样返回或抛出。
+        """
+        breaker = self.breaker(endpoint)
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = send()
+            except retryable_errors as e:
+                breaker.record_failure()
+                delay = self._should_retry(endpoint, attempt, type(e).__name__)
+                if delay is None:
+                    raise
+            except failure_errors:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.record_ignored()
+                raise
+            else:
+                status = (result[0] if isinstance(result, tuple) else result).status_code
+                if status not in RETRYABLE_STATUS:
+                    breaker.record_success()
+                    return result
+                breaker.record_failure()
+                delay = self._should_retry(endpoint, attempt, f"HTTP {status}")
+                if delay is None:
+                    return result
+                if discard is not None:
+                    discard(result)
+            attempt += 1
+            self._sleep(delay)
+
+    async def acall(self, endpoint, send: Callable, retryable_errors: Tuple, failure_errors: Tuple = (), discard: Callable = None):
+        """call 的异步版本，send 和 discard 为协程函数"""
+        breaker = self.breaker(endpoint)
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = await send()
+            except retryable_errors as e:
+                breaker.record_failure()
+                delay = self._should_retry(endpoint, attempt, type(e).__name__)
+                if delay is None:
+                    raise
+            except failure_errors:
+                breaker.record_failure()
+                raise
+            except BaseException:
+                breaker.record_ignored()
+                raise
+            else:
+                status = (result[0] if isinstance(result, tuple) else result).status_code
+                if status not in RETRYABLE_STATUS:
+                    breaker.record_success()
+                    return result
+                breaker.record_failure()
+                delay = self._should_retry(endpoint, attempt, f"HTTP {status}")
+                if delay is None:
+                    return result
+                if discard is not None:
+                    await discard(result)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        return {
+            'retries': self.retries,
+            'budget_tokens': round(self.budget.tokens, 3),
+            'budget_exhausted': self.budget.exhausted,
+            'breakers': {endpoint: breaker.stats() for endpoint, breaker in list(self._breakers.items())},
+        }
+
+
+# 当前进程共享的重试预算和熔断器
+resilience = Resilience()
@@ -0,0 +1,453 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from abc import ABC, abstractmethod
+from threading import Event
+from collections import OrderedDict
+from typing import List, Dict
+
+from .sqlite_state import SQLiteState
+
+logger = logging.getLogger(__name__)
+
+
+def _message_bytes(message):
+    """估算一条消息占用的字节数"""
+    return len(message["role"]) + len((message["content"] or "").encode('utf-8'))
+
+
+class SessionStore(ABC):
+    """会话存储接口：聊天历史、最后活动时间和流式输出的停止信号
+
+    内存实现只在当前进程内可见；SQLite 实现可以在同一主机的多个 gunicorn worker 之间共享。
+    会话按最后活动时间排序，超过 max_sessions 个会话或历史总字节数超过 max_bytes 时
+    从最久未活动的会话开始淘汰。
+    """
+
+    def __init__(self, max_sessions=1000, max_bytes=64 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+
+    @abstractmethod
+    def get_history(self, session_id) -> List[Dict[str, str]]:
+        """返回会话的历史消息（按时间顺序），不存在时返回空列表"""
+
+    @abstractmethod
+    def append_messages(self, session_id, messages, max_length) -> int:
+        """追加消息并裁剪到最多 max_length 条，返回裁剪后的历史长度"""
+
+    @abstractmethod
+    def clear(self, session_id) -> bool:
+        """清除会话历史，会话没有历史时返回 False"""
+
+    @abstractmethod
+    def touch(self, session_id):
+        """更新会话的最后活动时间，必要时淘汰最久未活动的会话"""
+
+    @abstractmethod
+    def cleanup_expired(self, timeout) -> int:
+        """删除超过 timeout 秒未活动的会话，返回删除数量"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """返回会话数、历史总字节数和各类淘汰计数"""
+
+    @abstractmethod
+    def begin_stream(self, session_id):
+        """登记一个正在输出的流，返回带 is_set()/set() 的停止信号"""
+
+    @abstractmethod
+    def end_stream(self, session_id, signal):
+        """流结束后注销停止信号"""
+
+    @abstractmethod
+    def request_stop(self, session_id) -> bool:
+        """请求停止会话当前的流，没有正在输出的流时返回 False"""
+
+
+class _SessionEntry:
+    __slots__ = ('messages', 'last_active', 'bytes')
+
+    def __init__(self, now):
+        self.messages = []
+        self.last_active = now
+        self.bytes = 0
+
+
+class MemorySessionStore(SessionStore):
+    """进程内会话存储
+
+    会话保存在按活动时间排序的 OrderedDict 中，更新活动时间和淘汰最旧会话都是 O(1)，
+    过期清理只需要从头部弹出已过期的会话。
+    """
+
+    def __init__(self, max_sessions=1000, max_bytes=64 * 1024 * 1024):
+        super().__init__(max_sessions, max_bytes)
+        self._lock = threading.RLock()
+        self.sessions = OrderedDict()
+        self.stop_events = {}
+        self.total_bytes = 0
+        self.counters = {'evicted_lru': 0, 'evicted_bytes': 0, 'expired': 0}
+
+    def _touch(self, session_id):
+        now = time.time()
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            entry = self.sessions[session_id] = _SessionEntry(now)
+        else:
+            entry.last_active = now
+            self.sessions.move_to_end(session_id)
+        return entry
+
+    def _pop_oldest(self, counter):
+        _, entry = self.sessions.popitem(last=False)
+        self.total_bytes -= entry.bytes
+        self.counters[counter] += 1
+
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions:
+            self._pop_oldest('evicted_lru')
+        while self.total_bytes > self.max_bytes and len(self.sessions) > 1:
+            self._pop_oldest('evicted_bytes')
+
+    def get_history(self, session_id):
+        with self._lock:
+            entry = self.sessions.get(session_id)
+            return list(entry.messages) if entry else []
+
+    def append_messages(self, session_id, messages, max_length):
+        with self._lock:
+            entry = self._touch(session_id)
+            added = sum(_message_bytes(m) for m in messages)
+            entry.messages.extend(messages)
+            if len(entry.messages) > max_length:
+                # 保留最新的消息
+                removed = entry.messages[:-max_length]
+                del entry.messages[:-max_length]
+                added -= sum(_message_bytes(m) for m in removed)
+            entry.bytes += added
+            self.total_bytes += added
+            self._evict()
+            return len(entry.messages)
+
+    def clear(self, session_id):
+        with self._lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or not entry.messages:
+                return False
+            self.total_bytes -= entry.bytes
+            entry.messages = []
+            entry.bytes = 0
+            return True
+
+    def touch(self, session_id):
+        with self._lock:
+            self._touch(session_id)
+            self._evict()
+
+    def cleanup_expired(self, timeout):
+        deadline = time.time() - timeout
+        removed = 0
+        with self._lock:
+            while self.sessions:
+                entry = next(iter(self.sessions.values()))
+                if entry.last_active >= deadline:
+                    break
+                self._pop_oldest('expired')
+                removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self.sessions), 'bytes': self.total_bytes, **self.counters}
+
+    def begin_stream(self, session_id):
+        event = Event()
+        with self._lock:
+            self.stop_events[session_id] = event
+        return event
+
+    def end_stream(self, session_id, signal):
+        with self._lock:
+            if self.stop_events.get(session_id) is signal:
+                del self.stop_events[session_id]
+
+    def request_stop(self, session_id):
+        with self._lock:
+            event = self.stop_events.pop(session_id, None)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+
+class StopSignal:
+    """跨进程停止信号
+
+    本进程内的 set() 立即生效；其他进程发出的停止请求通过 SQLite 标记传递，
+    is_set() 最多每 poll_interval 秒查询一次数据库，流式循环可以在每个数据块上调用。
+    """
+
+    def __init__(self, store, session_id, token, poll_interval):
+        self._store = store
+        self.session_id = session_id
+        self.token = token
+        self._poll_interval = poll_interval
+        self._event = Event()
+        self._next_poll = time.monotonic() + poll_interval
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        if self._event.is_set():
+            return True
+        now = time.monotonic()
+        if now >= self._next_poll:
+            self._next_poll = now + self._poll_interval
+            if self._store._stop_requested(self.session_id, self.token):
+                self._event.set()
+        return self._event.is_set()
+
+
+class SQLiteSessionStore(SessionStore):
+    """基于 SQLite(WAL 模式) 的会话存储，同一主机的多个进程共享
+
+    会话数和总字节数保存在计数表中，淘汰时通过 last_active 索引取最旧的会话，
+    不需要全表扫描。每个线程使用独立连接，fork 之后自动重新连接。
+    """
+
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        last_active REAL NOT NULL,
+        bytes INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions(last_active);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        bytes INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+    CREATE TABLE IF NOT EXISTS streams (
+        session_id TEXT PRIMARY KEY,
+        token TEXT NOT NULL,
+        stop INTEGER NOT NULL DEFAULT 0,
+        started REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS store_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO store_stats (name, value) VALUES
+        ('sessions', 0), ('bytes', 0), ('evicted_lru', 0), ('evicted_bytes', 0), ('expired', 0);
+    """
+
+    def __init__(self, path, poll_interval=0.2, max_sessions=1000, max_bytes=64 * 1024 * 1024):
+        super().__init__(max_sessions, max_bytes)
+        self.path = str(path)
+        self.poll_interval = poll_interval
+        # 本进程内的停止信号，同进程停止时无需等待轮询
+        self._signals = {}
+        self._signals_lock = threading.Lock()
+        # 会话数据只是缓存，结构变化时直接重建
+        self._db = SQLiteState(self.path, self.SCHEMA, self.SCHEMA_VERSION)
+        logger.info(f"SQLite会话存储初始化完成: {self.path}")
+
+    def _conn(self):
+        return self._db.conn()
+
+    @staticmethod
+    def _add_stat(conn, name, delta):
+        conn.execute('UPDATE store_stats SET value = value + ? WHERE name = ?', (delta, name))
+
+    @staticmethod
+    def _get_stat(conn, name):
+        return conn.execute('SELECT value FROM store_stats WHERE name = ?', (name,)).fetchone()[0]
+
+    def _touch(self, conn, session_id):
+        now = time.time()
+        cursor = conn.execute('UPDATE sessions SET last_active = ? WHERE session_id = ?', (now, session_id))
+        if cursor.rowcount == 0:
+            conn.execute('INSERT INTO sessions (session_id, last_active) VALUES (?, ?)', (session_id, now))
+            self._add_stat(conn, 'sessions', 1)
+
+    def _remove(self, conn, session_id, session_bytes, counter):
+        conn.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+        conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        self._add_stat(conn, 'sessions', -1)
+        self._add_stat(conn, 'bytes', -session_bytes)
+        self._add_stat(conn, counter, 1)
+
+    def _evict(self, conn):
+        while True:
+            sessions = self._get_stat(conn, 'sessions')
+            if sessions > self.max_sessions:
+                counter = 'evicted_lru'
+            elif sessions > 1 and self._get_stat(conn, 'bytes') > self.max_bytes:
+                counter = 'evicted_bytes'
+            else:
+                return
+            session_id, session_bytes = conn.execute(
+                'SELECT session_id, bytes FROM sessions ORDER BY last_active LIMIT 1'
+            ).fetchone()
+            self._remove(conn, session_id, session_bytes, counter)
+
+    def get_history(self, session_id):
+        rows = self._conn().execute(
+            'SELECT role, content FROM messages WHERE session_id = ? ORDER BY id',
+            (session_id,)
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append_messages(self, session_id, messages, max_length):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._touch(conn, session_id)
+            rows = [(session_id, m["role"], m["content"], _message_bytes(m)) for m in messages]
+            conn.executemany(
+                'INSERT INTO messages (session_id, role, content, bytes) VALUES (?, ?, ?, ?)', rows)
+            added = sum(row[3] for row in rows)
+
+            # 只保留最新的 max_length 条消息
+            trimmed = conn.execute(
+                'SELECT id, bytes FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT -1 OFFSET ?',
+                (session_id, max_length)
+            ).fetchall()
+            if trimmed:
+                conn.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in trimmed])
+                added -= sum(row[1] for row in trimmed)
+
+            conn.execute('UPDATE sessions SET bytes = bytes + ? WHERE session_id = ?', (added, session_id))
+            self._add_stat(conn, 'bytes', added)
+            self._evict(conn)
+            return conn.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,)).fetchone()[0]
+
+    def clear(self, session_id):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+            row = conn.execute('SELECT bytes FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row:
+                conn.execute('UPDATE sessions SET bytes = 0 WHERE session_id = ?', (session_id,))
+                self._add_stat(conn, 'bytes', -row[0])
+        return cursor.rowcount > 0
+
+    def touch(self, session_id):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._touch(conn, session_id)
+            self._evict(conn)
+
+    def cleanup_expired(self, timeout):
+        conn = self._conn()
+        deadline = time.time() - timeout
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = conn.execute(
+                'SELECT session_id, bytes FROM sessions WHERE last_active < ?', (deadline,)
+            ).fetchall()
+            for session_id, session_bytes in expired:
+                self._remove(conn, session_id, session_bytes, 'expired')
+            # 清理异常退出的worker遗留的流登记
+            conn.execute('DELETE FROM streams WHERE started < ?', (deadline,))
+        return len(expired)
+
+    def stats(self):
+        rows = self._conn().execute('SELECT name, value FROM store_stats').fetchall()
+        return dict(rows)
+
+    def begin_stream(self, session_id):
+        token = uuid.uuid4().hex
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO streams (session_id, token, stop, started) VALUES (?, ?, 0, ?)',
+                (session_id, token, time.time())
+            )
+        signal = StopSignal(self, session_id, token, self.poll_interval)
+        with self._signals_lock:
+            self._signals[session_id] = signal
+        return signal
+
+    def end_stream(self, session_id, signal):
+        with self._signals_lock:
+            if self._signals.get(session_id) is signal:
+                del self._signals[session_id]
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM streams WHERE session_id = ? AND token = ?', (session_id, signal.token))
+
+    def request_stop(self, session_id):
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute('UPDATE streams SET stop = 1 WHERE session_id = ?', (session_id,))
+        with self._signals_lock:
+            signal = self._signals.get(session_id)
+        if signal is not None:
+            signal.set()
+        return cursor.rowcount > 0
+
+    def _stop_requested(self, session_id, token):
+        row = self._conn().execute(
+            'SELECT stop FROM streams WHERE session_id = ? AND token = ?',
+            (session_id, token)
+        ).fetchone()
+        return bool(row and row[0])
+
+
+class SessionSweeper:
+    """后台定期清理过期会话的线程
+
+    每个进程一个，fork 之后第一次调用 ensure_running() 时在子进程中重新启动。
+    """
+
+    def __init__(self, store, timeout, interval=60):
+        self.store = store
+        self.timeout = timeout
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = Event()
+
+    def ensure_running(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._stop = Event()
+            self._thread = threading.Thread(target=self._run, name='session-sweeper', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                removed = self.store.cleanup_expired(self.timeout)
+                if removed:
+                    logger.info(f"清理过期会话 {removed} 个，当前状态: {self.store.stats()}")
+            except Exception as e:
+                logger.error(f"清理过期会话失败: {str(e)}", exc_info=True)
+
+
+def create_session_store(backend, path=None, poll_interval=0.2, max_sessions=1000, max_bytes=64 * 1024 * 1024) -> SessionStore:
+    """根据配置创建会话存储"""
+    if backend == 'memory':
+        return MemorySessionStore(max_sessions=max_sessions, max_bytes=max_bytes)
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path, poll_interval=poll_interval, max_sessions=max_sessions, max_bytes=max_bytes)
+    raise ValueError(f"未知的会话存储类型: {backend}")
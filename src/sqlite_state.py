@@ -0,0 +1,46 @@
+import os
+import re
+import sqlite3
+import threading
+
+# 表结构中创建的表，版本变化时删除后重建
+_TABLE_PATTERN = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)')
+
+
+class SQLiteState:
+    """同一主机多个 worker 共享的 SQLite(WAL 模式) 状态文件
+
+    每个线程使用独立连接，fork 之后自动重新连接；连接为自动提交模式，写操作由调用方用 BEGIN IMMEDIATE 开启事务。
+    文件中的 PRAGMA user_version 与 version 不一致时删除 schema 中的表并重建：
+    保存的只是可以丢弃的运行状态（会话、缓存索引、任务、限流计数），不做迁移。
+    """
+
+    def __init__(self, path, schema, version):
+        self.path = str(path)
+        self.schema = schema
+        self.version = version
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._init_schema(self.conn())
+
+    def _init_schema(self, conn):
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.version:
+                for table in _TABLE_PATTERN.findall(self.schema):
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+                conn.execute(f'PRAGMA user_version = {int(self.version)}')
+            for statement in self.schema.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+
+    def conn(self) -> sqlite3.Connection:
+        """返回当前线程的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
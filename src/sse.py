@@ -0,0 +1,138 @@
+import os
+import json
+import time
+from json.decoder import scanstring
+from typing import Dict, List, Optional
+
+# SSE输出配置
+SSE_CONFIG = {
+    'flush_interval': int(os.getenv('SSE_FLUSH_INTERVAL_MS', 50)) / 1000,  # 合并窗口（秒），0 表示每个片段单独发送
+    'flush_bytes': int(os.getenv('SSE_FLUSH_BYTES', 4096)),  # 待发送内容达到该字节数时立即发送
+    'read_size': int(os.getenv('SSE_READ_SIZE', 16384)),  # 读取上游流式响应的块大小
+}
+
+# 助手回复帧的固定前后缀，与 json.dumps({'type': 'assistant', 'reply': ...}) 的输出一致
+_ASSISTANT_PREFIX = 'data: {"type": "assistant", "reply": '.encode('utf-8')
+_FRAME_SUFFIX = '}\n\n'.encode('utf-8')
+_DONE_FRAME = b"data: [DONE]\n\n"
+
+
+class SSEWriter:
+    """把连续的助手回复片段合并成较少的SSE帧
+
+    事件格式保持不变，只是多个 assistant 片段会合并到同一个 reply 中。
+    第一个片段立即发送，之后在 flush_interval 时间窗口内或累计不足 flush_bytes 字节的片段会被暂存，
+    直到窗口结束、超过字节阈值、出现其他类型事件或流结束时再一起发送。
+    由于只在收到新片段时检查时间，暂存内容最多延迟到下一个上游数据块到达。
+    """
+
+    def __init__(self, flush_interval=None, flush_bytes=None, clock=time.monotonic):
+        self.flush_interval = SSE_CONFIG['flush_interval'] if flush_interval is None else flush_interval
+        self.flush_bytes = SSE_CONFIG['flush_bytes'] if flush_bytes is None else flush_bytes
+        self._clock = clock
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = None
+        self.fragments = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def _emit(self, frame):
+        self.frames += 1
+        self.bytes += len(frame)
+        return frame
+
+    def flush(self) -> bytes:
+        """立即发送暂存的助手回复，没有暂存内容时返回空字节串"""
+        if not self._pending:
+            return b''
+        reply = self._pending[0] if len(self._pending) == 1 else ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = self._clock()
+        return self._emit(_ASSISTANT_PREFIX + json.dumps(reply, ensure_ascii=False).encode('utf-8') + _FRAME_SUFFIX)
+
+    def assistant(self, fragment) -> bytes:
+        """加入一个助手回复片段，返回需要立即发送的数据（可能为空）"""
+        if not fragment:
+            return b''
+        self.fragments += 1
+        self._pending.append(fragment)
+        self._pending_size += len(fragment)
+        if (self._last_flush is None
+                or self._pending_size >= self.flush_bytes
+                or self._clock() - self._last_flush >= self.flush_interval):
+            return self.flush()
+        return b''
+
+    def event(self, data) -> bytes:
+        """发送一个其他类型的事件，先发送暂存的助手回复以保持顺序"""
+        frame = self._emit(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8'))
+        return self.flush() + frame
+
+    def done(self) -> bytes:
+        """结束流：发送暂存内容和 [DONE] 标记"""
+        return self.flush() + self._emit(_DONE_FRAME)
+
+    def stats(self) -> Dict[str, int]:
+        return {'fragments': self.fragments, 'frames': self.frames, 'bytes': self.bytes}
+
+
+# 上游增量中只包含回复内容时的固定片段，命中时直接截取字符串，无需解析整个JSON
+_DELTA_CONTENT = '"delta":{"content":"'
+_FINISHED = b'"finish_reason":"'
+_DONE = b'[DONE]'
+
+
+class SSEParser:
+    """字节级的SSE解析器
+
+    feed() 接收任意切分的原始字节，返回其中已完整的事件数据（data 字段，bytes）；
+    跨读取边界的行暂存到下一次调用。多行 data 按规范用换行拼接，其他字段和注释行忽略。
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._data = []
+
+    def feed(self, data) -> List[bytes]:
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b'\n')
+        self._buffer = lines.pop()
+        events = []
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                if self._data:
+                    events.append(self._data[0] if len(self._data) == 1 else b'\n'.join(self._data))
+                    self._data = []
+            elif line.startswith(b'data:'):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b' ') else value)
+        return events
+
+    def close(self) -> List[bytes]:
+        """流结束时返回最后一个没有以空行结束的事件"""
+        events = self.feed(b'\n\n') if (self._buffer or self._data) else []
+        self._buffer = b''
+        return events
+
+
+def parse_chat_event(payload) -> Optional[dict]:
+    """把一条上游聊天事件解析为数据块，[DONE] 返回 None
+
+    常见的增量只包含回复文本，命中固定格式时用 scanstring 直接取出 content，
+    返回只含 choices[0].delta.content 的精简数据块；结束块和其他格式走完整的 json.loads。
+    解析失败时抛出 ValueError。
+    """
+    if payload == _DONE:
+        return None
+    text = payload.decode('utf-8')
+    if _FINISHED not in payload:
+        start = text.find(_DELTA_CONTENT)
+        if start != -1:
+            content, _ = scanstring(text, start + len(_DELTA_CONTENT))
+            return {'choices': [{'delta': {'content': content}}]}
+    return json.loads(text)
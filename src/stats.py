@@ -0,0 +1,25 @@
+import bisect
+from typing import Dict
+
+
+class Histogram:
+    """固定分桶的直方图，buckets 为各桶的上界；用于 stats 接口中的进程内统计"""
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict:
+        labels = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'buckets': dict(zip(labels, self.counts)),
+            'count': self.count,
+            'sum': round(self.sum, 3),
+        }
@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import fcntl
+import random
+import logging
+import threading
+from contextvars import ContextVar
+from pathlib import Path
+from typing import AsyncIterable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# 请求追踪配置
+TRACING_CONFIG = {
+    'sample_rate': float(os.getenv('TRACE_SAMPLE_RATE', 0.01)),  # 记录追踪的请求比例，0 表示只记录带 X-Trace: 1 的请求
+    'dir': os.getenv('TRACE_DIR', ''),  # 追踪文件目录，为空时使用日志目录下的 traces
+    'max_bytes': int(os.getenv('TRACE_MAX_BYTES', 10 * 1024 * 1024)),  # 单个追踪文件的大小上限，超过后轮转
+    'backup_count': int(os.getenv('TRACE_BACKUP_COUNT', 5)),
+    'max_events': 5000,  # 单个请求最多记录的事件数，超过的部分只计数
+}
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# 客户端传入的请求ID只接受这些字符，否则重新生成
+_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+
+def request_id_from(value) -> str:
+    """沿用客户端或nginx传入的请求ID，没有或格式不合法时生成一个"""
+    if value and _REQUEST_ID.fullmatch(value):
+        return value
+    return uuid.uuid4().hex[:16]
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTrace:
+    """未被采样的请求：只携带请求ID，所有记录操作都是空操作"""
+
+    __slots__ = ('request_id',)
+    sampled = False
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def span(self, name, **args):
+        return _NULL_SPAN
+
+    def add(self, name, start, end, **args):
+        pass
+
+    def instant(self, name, **args):
+        pass
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'args', 'start')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.perf_counter(), **self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Trace:
+    """一个被采样请求的事件，按 Chrome trace-event 格式保存
+
+    时间用 perf_counter 计量，换算为从 epoch 起的微秒，多个worker、多个文件的事件可以放在同一时间轴上。
+    每个请求使用独立的 tid，在 Perfetto 中显示为一条单独的轨道。
+    """
+
+    sampled = True
+
+    def __init__(self, request_id, name, max_events=None):
+        self.request_id = request_id
+        self.max_events = max_events or TRACING_CONFIG['max_events']
+        self.pid = os.getpid()
+        self.tid = zlib.crc32(request_id.encode('utf-8'))
+        self.dropped = 0
+        self._wall = time.time()
+        self._perf = time.perf_counter()
+        self.events: List[Dict] = [
+            {"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": f"worker {self.pid}"}},
+            {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": self.tid,
+             "args": {"name": f"{name} [{request_id}]"}},
+        ]
+
+    def _ts(self, perf) -> float:
+        return round((self._wall + perf - self._perf) * 1e6, 3)
+
+    def _append(self, event):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        self.events.append(event)
+
+    def span(self, name, **args):
+        """with 块的耗时记录为一个完整事件（ph=X）"""
+        return _Span(self, name, args)
+
+    def add(self, name, start, end, **args):
+        """按 perf_counter 的起止时间记录一个完整事件"""
+        event = {"name": name, "ph": "X", "ts": self._ts(start), "dur": round(max(0.0, end - start) * 1e6, 3),
+                 "pid": self.pid, "tid": self.tid}
+        if args:
+            event["args"] = args
+        self._append(event)
+
+    def _instant_event(self, name, args) -> Dict:
+        event = {"name": name, "ph": "i", "s": "t", "ts": self._ts(time.perf_counter()), "pid": self.pid, "tid": self.tid}
+        if args:
+            event["args"] = args
+        return event
+
+    def instant(self, name, **args):
+        self._append(self._instant_event(name, args))
+
+    def close(self):
+        """结束追踪；有事件因超出上限被丢弃时追加一条说明"""
+        if self.dropped:
+            self.events.append(self._instant_event('events_dropped', {'count': self.dropped}))
+            self.dropped = 0
+
+
+_current: ContextVar = ContextVar('trace', default=NullTrace('-'))
+
+
+def current_trace():
+    """当前请求的追踪；同步worker中按线程、ASGI模式下按任务隔离"""
+    return _current.get()
+
+
+def mark_first(trace, name, iterable: Iterable, since: float):
+    """迭代到第一个元素时记录从 since 开始的等待时间；未采样时原样返回"""
+    if not trace.sampled:
+        return iterable
+
+    def first_marked():
+        iterator = iter(iterable)
+        for item in iterator:
+            trace.add(name, since, time.perf_counter())
+            yield item
+            break
+        yield from iterator
+
+    return first_marked()
+
+
+def amark_first(trace, name, iterable: AsyncIterable, since: float):
+    """mark_first 的异步版本"""
+    if not trace.sampled:
+        return iterable
+
+    async def first_marked():
+        first = True
+        async for item in iterable:
+            if first:
+                first = False
+                trace.add(name, since, time.perf_counter())
+            yield item
+
+    return first_marked()
+
+
+class TraceWriter:
+    """把追踪事件追加到按大小轮转的 JSON 文件
+
+    文件为 Chrome trace-event 的 JSON 数组格式（以 "[" 开始，每个事件后跟 ","，省略结尾的 "]"），
+    可以直接在 Perfetto 或 chrome://tracing 中打开。所有worker写同一个文件，写入和轮转通过文件锁互斥；
+    每个请求的事件一次写入。
+    """
+
+    def __init__(self, path, max_bytes=None, backup_count=None):
+        self.path = Path(path)
+        self.max_bytes = TRACING_CONFIG['max_bytes'] if max_bytes is None else max_bytes
+        self.backup_count = TRACING_CONFIG['backup_count'] if backup_count is None else backup_count
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        for number in range(self.backup_count - 1, 0, -1):
+            source = Path(f"{self.path}.{number}")
+            if source.exists():
+                os.replace(source, f"{self.path}.{number + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            self.path.unlink(missing_ok=True)
+
+    def write(self, events: List[Dict]):
+        data = ''.join(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + ',\n' for event in events)
+        encoded = data.encode('utf-8')
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(f"{self.path}.lock", 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    size = self.path.stat().st_size
+                except FileNotFoundError:
+                    size = 0
+                if size and size + len(encoded) > self.max_bytes:
+                    self._rotate()
+                    size = 0
+                with open(self.path, 'ab') as f:
+                    f.write((b'[\n' if size == 0 else b'') + encoded)
+
+
+class Tracer:
+    """为每个请求分配请求ID并按比例采样，采样的请求结束时把事件写入追踪文件"""
+
+    def __init__(self, path, sample_rate=None, max_bytes=None, backup_count=None):
+        self.writer = TraceWriter(path, max_bytes, backup_count)
+        self.sample_rate = TRACING_CONFIG['sample_rate'] if sample_rate is None else sample_rate
+
+    @property
+    def path(self) -> Path:
+        return self.writer.path
+
+    def begin(self, name, request_id=None, force=False):
+        """开始一个请求并设为当前追踪；force 为真（请求头 X-Trace: 1）时总是采样"""
+        request_id = request_id_from(request_id)
+        if force or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            trace = Trace(request_id, name)
+        else:
+            trace = NullTrace(request_id)
+        _current.set(trace)
+        return trace
+
+    def finish(self, trace):
+        """写出采样请求的事件；写入失败只记录日志，不影响请求"""
+        if not trace.sampled:
+            return
+        trace.close()
+        try:
+            self.writer.write(trace.events)
+        except OSError as e:
+            logger.warning("写入追踪文件失败: %s", e)
@@ -0,0 +1,203 @@
+import os
+import socket
+import threading
+import logging
+from typing import Optional, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .metrics import UPSTREAM_CONNECTIONS, UPSTREAM_POOL
+
+logger = logging.getLogger(__name__)
+
+# 上游连接池配置，可通过环境变量覆盖
+TRANSPORT_CONFIG = {
+    'pool_connections': int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 4)),   # 缓存的主机连接池数量
+    'pool_maxsize': int(os.getenv('UPSTREAM_POOL_MAXSIZE', 32)),          # 每个主机保留的最大连接数
+    'async_max_connections': int(os.getenv('UPSTREAM_ASYNC_MAX_CONNECTIONS', 512)),  # ASGI模式下单个worker的最大上游连接数
+    'pool_block': os.getenv('UPSTREAM_POOL_BLOCK', 'false').lower() == 'true',  # 连接数达到上限时是否阻塞等待
+    'keepalive': os.getenv('UPSTREAM_TCP_KEEPALIVE', 'true').lower() == 'true',  # 是否开启TCP keep-alive
+    'keepalive_idle': int(os.getenv('UPSTREAM_TCP_KEEPALIVE_IDLE', 60)),  # 空闲多少秒后发送keep-alive探测
+    'keepalive_interval': int(os.getenv('UPSTREAM_TCP_KEEPALIVE_INTERVAL', 15)),
+    'keepalive_count': int(os.getenv('UPSTREAM_TCP_KEEPALIVE_COUNT', 4)),
+}
+
+
+class TransportStats:
+    """连接池统计：区分连接复用与新建握手"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0          # 从连接池取出连接的次数
+        self.new_connections = 0   # 实际发生的TCP(+TLS)握手次数
+
+    def record_checkout(self):
+        with self._lock:
+            self.requests += 1
+        UPSTREAM_CONNECTIONS.inc(event='checkout')
+
+    def record_handshake(self):
+        with self._lock:
+            self.new_connections += 1
+        UPSTREAM_CONNECTIONS.inc(event='handshake')
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            requests_count = self.requests
+            new_connections = self.new_connections
+        reused = max(0, requests_count - new_connections)
+        return {
+            'requests': requests_count,
+            'new_connections': new_connections,
+            'reused_connections': reused,
+            'reuse_ratio': round(reused / requests_count, 4) if requests_count else 0.0,
+        }
+
+
+stats = TransportStats()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        stats.record_handshake()
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        stats.record_handshake()
+        super().connect()
+
+
+class _PoolUsageMixin:
+    """取出和归还连接时更新 /metrics 中该连接池的空闲连接数"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_name = f"{self.scheme}://{self.host}:{self.port}"
+        UPSTREAM_POOL.set(self.pool.maxsize, pool=self._metrics_name, state='maxsize')
+
+    def _record_usage(self):
+        if self.pool is not None:
+            UPSTREAM_POOL.set(self.pool.qsize(), pool=self._metrics_name, state='idle')
+
+    def _get_conn(self, timeout=None):
+        stats.record_checkout()
+        conn = super()._get_conn(timeout=timeout)
+        self._record_usage()
+        return conn
+
+    def _put_conn(self, conn):
+        super()._put_conn(conn)
+        self._record_usage()
+
+
+class _CountingHTTPConnectionPool(_PoolUsageMixin, HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(_PoolUsageMixin, HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+def _socket_options():
+    """构造TCP socket选项，开启keep-alive避免空闲连接被中间设备静默断开"""
+    options = list(HTTPConnection.default_socket_options)
+    if not TRANSPORT_CONFIG['keepalive']:
+        return options
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # 以下选项并非所有平台都支持
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TRANSPORT_CONFIG['keepalive_idle']))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TRANSPORT_CONFIG['keepalive_interval']))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TRANSPORT_CONFIG['keepalive_count']))
+    return options
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """带连接计数和TCP keep-alive的HTTPAdapter"""
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', _socket_options())
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def pool_usage(self) -> Dict[str, Dict[str, int]]:
+        """返回每个主机连接池当前的空闲连接数和容量"""
+        usage = {}
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            usage[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'idle': pool.pool.qsize(),
+                'maxsize': pool.pool.maxsize,
+            }
+        return usage
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(
+        pool_connections=TRANSPORT_CONFIG['pool_connections'],
+        pool_maxsize=TRANSPORT_CONFIG['pool_maxsize'],
+        pool_block=TRANSPORT_CONFIG['pool_block'],
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    logger.info(
+        "上游连接池初始化完成 | 进程: %s | 每主机连接数: %s | 阻塞模式: %s | TCP keep-alive: %s",
+        os.getpid(), TRANSPORT_CONFIG['pool_maxsize'], TRANSPORT_CONFIG['pool_block'], TRANSPORT_CONFIG['keepalive'],
+    )
+    return session
+
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """获取当前进程共享的上游会话
+
+    gunicorn 在 fork 之后每个 worker 都会重新创建自己的会话，避免父子进程共用同一个socket。
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            _session = _build_session()
+            _session_pid = pid
+    return _session
+
+
+def close_session():
+    """关闭当前进程的上游会话（主要用于测试和进程退出）"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def transport_stats() -> Dict[str, object]:
+    """返回连接复用统计和连接池使用情况"""
+    result = dict(stats.snapshot())
+    session = _session if _session_pid == os.getpid() else None
+    if session is not None:
+        adapter = session.get_adapter('https://')
+        if isinstance(adapter, PooledHTTPAdapter):
+            result['pools'] = adapter.pool_usage()
+    return result
@@ -0,0 +1,291 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from .stats import Histogram
+
+logger = logging.getLogger(__name__)
+
+# 上游调用节流配置
+GOVERNOR_CONFIG = {
+    'enabled': os.getenv('UPSTREAM_GOVERNOR', 'true').lower() == 'true',
+    'rate': float(os.getenv('UPSTREAM_RATE', 5)),  # 每个API密钥和模型每秒发出的请求数上限（初始值）
+    'min_rate': float(os.getenv('UPSTREAM_MIN_RATE', 0.2)),  # 收到429后降低速率的下限
+    'burst': int(os.getenv('UPSTREAM_BURST', 10)),  # 令牌桶容量，允许的瞬时突发请求数
+    'recovery': float(os.getenv('UPSTREAM_RATE_RECOVERY', 0.1)),  # 每次成功调用后速率的增加量（每秒请求数）
+    'backoff': float(os.getenv('UPSTREAM_RATE_BACKOFF', 0.5)),  # 收到429后速率乘以的系数
+    'model_concurrency': int(os.getenv('UPSTREAM_MODEL_CONCURRENCY', 8)),  # 每个模型同时进行的上游请求数（每个worker），流式请求只计算到收到响应头为止
+    'queue_timeout': float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', 10)),  # 等待发送名额的最长时间（秒）
+    'default_retry_after': float(os.getenv('UPSTREAM_DEFAULT_RETRY_AFTER', 1)),  # 429/503 没有 Retry-After 时暂停的秒数
+    'max_retry_after': float(os.getenv('UPSTREAM_MAX_RETRY_AFTER', 60)),
+}
+
+THROTTLE_STATUS = (429, 503)
+
+# 当前线程（请求）等待上游发送名额的时间
+_request_timing = threading.local()
+
+
+def reset_queue_time():
+    _request_timing.seconds = 0.0
+
+
+def queue_time() -> float:
+    """返回当前线程自上次 reset_queue_time() 以来等待上游发送名额的秒数"""
+    return getattr(_request_timing, 'seconds', 0.0)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """解析 Retry-After 中的秒数，不支持的格式（如HTTP日期）返回 None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def key_id(authorization) -> str:
+    """API密钥的摘要，避免在统计中出现密钥本身"""
+    return hashlib.sha256((authorization or '').encode('utf-8')).hexdigest()[:12]
+
+
+class GovernorTimeout(Exception):
+    """在截止时间内没有拿到上游发送名额"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """一个API密钥和模型的自适应令牌桶"""
+
+    __slots__ = ('rate', 'tokens', 'updated', 'blocked_until', 'throttled')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = now
+        self.blocked_until = 0.0
+        self.throttled = 0
+
+
+class Permit:
+    """一次上游请求的发送名额，请求结束后调用 release()"""
+
+    __slots__ = ('governor', 'bucket_key', 'model', 'waited', '_released')
+
+    def __init__(self, governor, bucket_key, model, waited):
+        self.governor = governor
+        self.bucket_key = bucket_key
+        self.model = model
+        self.waited = waited
+        self._released = False
+
+    def observe(self, status_code, retry_after=None):
+        """根据上游状态码调整速率：429/503 时按 Retry-After 暂停并降低速率，成功时缓慢恢复"""
+        self.governor.observe(self.bucket_key, status_code, retry_after)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.governor.release(self.model)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class UpstreamGovernor:
+    """上游调用的节流器：每个API密钥和模型一个令牌桶，每个模型一个并发上限
+
+    拿不到名额的请求按截止时间等待，超时抛出 GovernorTimeout。
+    收到 429/503 时在 Retry-After 之前不再发送同一密钥和模型的请求，并按 backoff 降低速率；
+    每次成功调用后速率增加 recovery，直到配置的初始速率（AIMD）。
+    状态只在当前进程内有效，限制按每个worker计算。
+    """
+
+    def __init__(self, rate=None, burst=None, model_concurrency=None, queue_timeout=None,
+                 min_rate=None, recovery=None, backoff=None, enabled=None, clock=time.monotonic):
+        self.max_rate = GOVERNOR_CONFIG['rate'] if rate is None else rate
+        self.burst = GOVERNOR_CONFIG['burst'] if burst is None else burst
+        self.model_concurrency = GOVERNOR_CONFIG['model_concurrency'] if model_concurrency is None else model_concurrency
+        self.queue_timeout = GOVERNOR_CONFIG['queue_timeout'] if queue_timeout is None else queue_timeout
+        self.min_rate = GOVERNOR_CONFIG['min_rate'] if min_rate is None else min_rate
+        self.recovery = GOVERNOR_CONFIG['recovery'] if recovery is None else recovery
+        self.backoff = GOVERNOR_CONFIG['backoff'] if backoff is None else backoff
+        self.enabled = GOVERNOR_CONFIG['enabled'] if enabled is None else enabled
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self._running: Dict[str, int] = {}
+        # 异步等待者：模型 -> {(事件循环, asyncio.Event)}，release() 跨线程唤醒
+        self._async_waiters: Dict[str, set] = {}
+        self.waiting = 0
+        self.granted = 0
+        self.timeouts = 0
+        self.throttled = 0
+        self.wait_ms = Histogram([1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000])
+
+    def _bucket(self, bucket_key, now):
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = _Bucket(self.max_rate, self.burst, now)
+        return bucket
+
+    def _try_acquire(self, bucket_key, model, now) -> Optional[float]:
+        """在锁内尝试取得名额，成功返回 None，否则返回建议的等待秒数（并发已满时为 0，等待释放通知）"""
+        if self._running.get(model, 0) >= self.model_concurrency:
+            return 0.0
+        bucket = self._bucket(bucket_key, now)
+        if bucket.blocked_until > now:
+            return bucket.blocked_until - now
+        bucket.tokens = min(float(self.burst), bucket.tokens + (now - bucket.updated) * bucket.rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / bucket.rate
+        bucket.tokens -= 1
+        self._running[model] = self._running.get(model, 0) + 1
+        return None
+
+    def _grant(self, bucket_key, model, started):
+        waited = self._clock() - started
+        self.granted += 1
+        self.wait_ms.observe(waited * 1000)
+        _request_timing.seconds = queue_time() + waited
+        return Permit(self, bucket_key, model, waited)
+
+    def _timeout(self, model, started, hint):
+        self.timeouts += 1
+        self.wait_ms.observe((self._clock() - started) * 1000)
+        logger.warning("等待上游发送名额超时，模型: %s，已等待 %.2f秒", model, self._clock() - started)
+        return GovernorTimeout("上游请求排队超时，请稍后重试", retry_after=hint)
+
+    def acquire(self, authorization, model, timeout=None) -> Permit:
+        """等待并取得一个发送名额，超过 timeout 秒抛出 GovernorTimeout"""
+        if not self.enabled:
+            return Permit(self, None, None, 0.0)
+        bucket_key = (key_id(authorization), model)
+        started = self._clock()
+        deadline = started + (self.queue_timeout if timeout is None else timeout)
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = self._clock()
+                    wait = self._try_acquire(bucket_key, model, now)
+                    if wait is None:
+                        return self._grant(bucket_key, model, started)
+                    if now + wait > deadline or now >= deadline:
+                        raise self._timeout(model, started, wait or None)
+                    # 并发已满时等待 release() 通知，令牌不足时等待补充
+                    self._cond.wait(wait or deadline - now)
+            finally:
+                self.waiting -= 1
+
+    async def aacquire(self, authorization, model, timeout=None) -> Permit:
+        """acquire 的异步版本，等待期间不阻塞事件循环"""
+        if not self.enabled:
+            return Permit(self, None, None, 0.0)
+        bucket_key = (key_id(authorization), model)
+        started = self._clock()
+        deadline = started + (self.queue_timeout if timeout is None else timeout)
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    now = self._clock()
+                    wait = self._try_acquire(bucket_key, model, now)
+                    if wait is None:
+                        return self._grant(bucket_key, model, started)
+                    if now + wait > deadline or now >= deadline:
+                        raise self._timeout(model, started, wait or None)
+                    # 并发已满时等待 release() 唤醒，令牌不足时等待补充（期间有名额释放同样会被唤醒）
+                    waiter[1].clear()
+                    self._async_waiters.setdefault(model, set()).add(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), wait or deadline - now)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                waiters = self._async_waiters.get(model)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._async_waiters[model]
+
+    def release(self, model):
+        if model is None:
+            return
+        with self._cond:
+            remaining = self._running.get(model, 0) - 1
+            if remaining > 0:
+                self._running[model] = remaining
+            else:
+                self._running.pop(model, None)
+            self._cond.notify_all()
+            waiters = self._async_waiters.pop(model, ())
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+
+    def observe(self, bucket_key, status_code, retry_after=None):
+        if bucket_key is None:
+            return
+        with self._cond:
+            now = self._clock()
+            bucket = self._bucket(bucket_key, now)
+            if status_code in THROTTLE_STATUS:
+                delay = parse_retry_after(retry_after)
+                if delay is None:
+                    delay = GOVERNOR_CONFIG['default_retry_after']
+                delay = min(delay, GOVERNOR_CONFIG['max_retry_after'])
+                bucket.blocked_until = max(bucket.blocked_until, now + delay)
+                bucket.rate = max(self.min_rate, bucket.rate * self.backoff)
+                bucket.tokens = 0.0
+                bucket.updated = now
+                bucket.throttled += 1
+                self.throttled += 1
+                logger.warning("上游返回 %s，暂停 %.1f秒，速率降为 %.2f/秒，模型: %s",
+                               status_code, delay, bucket.rate, bucket_key[1])
+            elif status_code < 400 and bucket.rate < self.max_rate:
+                bucket.rate = min(self.max_rate, bucket.rate + self.recovery)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            now = self._clock()
+            return {
+                'enabled': self.enabled,
+                'waiting': self.waiting,
+                'running': dict(self._running),
+                'granted': self.granted,
+                'timeouts': self.timeouts,
+                'throttled': self.throttled,
+                'wait_ms': self.wait_ms.snapshot(),
+                'buckets': {
+                    f"{key}/{model}": {
+                        'rate': round(bucket.rate, 3),
+                        'blocked_for': round(max(0.0, bucket.blocked_until - now), 3),
+                        'throttled': bucket.throttled,
+                    }
+                    for (key, model), bucket in self._buckets.items()
+                },
+            }
+
+
+# 当前进程共享的节流器
+governor = UpstreamGovernor()
@@ -0,0 +1,10 @@
+import pytest
+
+from src import app as app_module
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    """速率限制计数保存在共享的 SQLite 中，每个测试开始前清空，避免测试之间互相影响"""
+    app_module.rate_limiter.reset()
+    yield
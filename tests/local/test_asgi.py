@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from src import api_client
+from src.asgi import AsyncChatApp
+from src.app import app as flask_app, session_store
+from src.upstream_governor import UpstreamGovernor
+
+
+class _FakeAsyncClient:
+    """模拟上游流式输出的异步客户端"""
+
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.payloads = []
+
+    async def chat_completion(self, payload):
+        self.payloads.append(payload)
+
+        async def generate():
+            for delta in self.deltas:
+                yield {"choices": [{"delta": {"content": delta}}]}
+
+        return generate()
+
+    async def generate_image(self, payload):
+        return {"images": [{"url": "https://cdn.siliconflow.com/a.png"}], "credits_used": 1}
+
+    async def aclose(self):
+        pass
+
+
+def _events(body):
+    events = []
+    for frame in body.split("\n\n"):
+        if not frame.startswith("data: "):
+            continue
+        data = frame[6:]
+        events.append(data if data == "[DONE]" else json.loads(data))
+    return events
+
+
+@pytest.mark.local
+class TestAsyncApp:
+    """ASGI 入口测试"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.asgi_app = AsyncChatApp(flask_app)
+        self.fake = _FakeAsyncClient(["你好", "，世界"])
+        self.asgi_app.client = self.fake
+
+    def _request(self, method, path, **kwargs):
+        async def run():
+            transport = httpx.ASGITransport(app=self.asgi_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.request(method, path, **kwargs)
+        return asyncio.run(run())
+
+    def test_chat_stream(self):
+        """聊天接口在事件循环上输出与同步路由相同格式的SSE"""
+        response = self._request("POST", "/api/chat", json={"session_id": "asgi-test", "user_input": "hi"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = _events(response.text)
+        assert events[0] == {"type": "user", "content": "hi"}
+        assert "".join(e["reply"] for e in events if isinstance(e, dict) and e.get("type") == "assistant") == "你好，世界"
+        assert events[-1] == "[DONE]"
+        assert session_store.get_history("asgi-test")[-1] == {"role": "assistant", "content": "你好，世界"}
+
+    def test_chat_missing_params(self):
+        response = self._request("POST", "/api/chat", json={"session_id": "asgi-test"})
+        assert response.status_code == 400
+
+    def test_generate_missing_field(self):
+        response = self._request("POST", "/api/generate", json={"prompt": "cat"})
+        assert response.status_code == 400
+        assert "width" in response.json()["error"]
+
+    def test_generate(self):
+        payload = {"prompt": "cat", "width": 512, "height": 512, "num_images": 1}
+        response = self._request("POST", "/api/generate", json=payload)
+        assert response.status_code == 200
+        assert response.json()["images"] == ["https://cdn.siliconflow.com/a.png"]
+
+    def test_other_routes_use_flask(self):
+        """其余路由交给Flask应用处理"""
+        response = self._request("GET", "/health")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ok"
+
+    def test_generate_rate_limited(self):
+        """ASGI 入口与 Flask 路由共享速率限制计数"""
+        payload = {"prompt": "cat", "width": 512, "height": 512, "num_images": 1}
+        statuses = [self._request("POST", "/api/generate", json=payload).status_code for _ in range(5)]
+        response = self._request("POST", "/api/generate", json=payload)
+        assert statuses == [200] * 5
+        assert response.status_code == 429
+        assert response.headers["x-ratelimit-remaining"] == "0"
+        assert int(response.headers["retry-after"]) >= 1
+
+    def test_request_id_header(self):
+        """ASGI 入口处理的请求同样带有请求ID"""
+        response = self._request("POST", "/api/chat", json={"session_id": "asgi-test", "user_input": "hi"},
+                                 headers={"X-Request-ID": "asgi-req-1"})
+        assert response.headers["x-request-id"] == "asgi-req-1"
+
+    def test_chat_stop_request(self):
+        """停止请求由后台任务轮询发现，上游长时间没有输出时同样立即结束并关闭上游流"""
+        closed = []
+
+        class StoppingClient(_FakeAsyncClient):
+            async def chat_completion(self, payload):
+                async def generate():
+                    try:
+                        yield {"choices": [{"delta": {"content": "第一段"}}]}
+                        assert session_store.request_stop("asgi-stop")
+                        await asyncio.sleep(30)
+                        yield {"choices": [{"delta": {"content": "第二段"}}]}
+                    finally:
+                        closed.append(True)
+
+                return generate()
+
+        self.asgi_app.client = StoppingClient([])
+        started = time.monotonic()
+        response = self._request("POST", "/api/chat", json={"session_id": "asgi-stop", "user_input": "hi"})
+        assert time.monotonic() - started < 5
+        events = _events(response.text)
+        assert "".join(e["reply"] for e in events if isinstance(e, dict) and e.get("type") == "assistant") == "第一段"
+        assert events[-1] == "[DONE]"
+        assert closed == [True]
+
+    def test_chat_disconnect_during_upstream_pause(self):
+        """客户端在上游停顿期间断开时立即关闭上游流"""
+        closed = []
+
+        class SlowClient(_FakeAsyncClient):
+            async def chat_completion(self, payload):
+                async def generate():
+                    try:
+                        yield {"choices": [{"delta": {"content": "第一段"}}]}
+                        await asyncio.sleep(30)
+                    finally:
+                        closed.append(True)
+
+                return generate()
+
+        self.asgi_app.client = SlowClient([])
+        body = json.dumps({"session_id": "asgi-disconnect", "user_input": "hi"}).encode()
+        scope = {"type": "http", "method": "POST", "path": "/api/chat", "query_string": b"", "root_path": "",
+                 "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 1234)}
+
+        async def run():
+            messages = [{"type": "http.request", "body": body, "more_body": False}]
+            sent = []
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await asyncio.sleep(0.2)
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+
+            await asyncio.wait_for(self.asgi_app(scope, receive, send), 5)
+            return sent
+
+        sent = asyncio.run(run())
+        assert sent[0]["status"] == 200
+        assert closed == [True]
+
+    def test_streams_beyond_model_concurrency(self, monkeypatch):
+        """流式请求收到响应头后就释放并发名额，同时输出的流可以超过 model_concurrency"""
+        streams = 5
+        monkeypatch.setattr(api_client, 'governor',
+                            UpstreamGovernor(rate=1000, burst=100, model_concurrency=2, queue_timeout=0.5, enabled=True))
+
+        async def run():
+            started = 0
+            all_started = asyncio.Event()
+
+            async def body():
+                yield b'data: {"choices": [{"delta": {"content": "\xe4\xbd\xa0\xe5\xa5\xbd"}}]}\n\n'
+                # 所有流都开始输出后才结束，名额一直被占用时后面的请求会排队超时
+                await asyncio.wait_for(all_started.wait(), 2)
+                yield b'data: [DONE]\n\n'
+
+            async def handler(request):
+                nonlocal started
+                started += 1
+                if started == streams:
+                    all_started.set()
+                return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, content=body())
+
+            client = api_client.AsyncSiliconFlowClient(api_key="test-key")
+            client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            self.asgi_app.client = client
+            transport = httpx.ASGITransport(app=self.asgi_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await asyncio.gather(*(
+                    http.post("/api/chat", json={"session_id": f"asgi-many-{n}", "user_input": "hi"})
+                    for n in range(streams)))
+
+        for response in asyncio.run(run()):
+            assert response.status_code == 200
+            assert "".join(e["reply"] for e in _events(response.text)
+                           if isinstance(e, dict) and e.get("type") == "assistant") == "你好"
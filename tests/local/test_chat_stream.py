@@ -0,0 +1,119 @@
+import random
+import time
+
+import pytest
+
+from src.chat_stream import ReplyFormatter
+
+REPLY = (
+    "下面是示例：\n"
+    "```python\n"
+    "def hello():\n"
+    "    print('hi')\n"
+    "```\n"
+    "以及 `行内代码` 和另一段：\n"
+    "```\n"
+    "plain\n"
+    "```"
+)
+
+
+def _run(chunks):
+    formatter = ReplyFormatter('test')
+    fragments = []
+    for chunk in chunks:
+        fragments.extend(formatter.feed(chunk))
+    fragments.extend(formatter.flush())
+    return formatter, fragments
+
+
+def _split(text, sizes):
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(text[start:start + size])
+        start += size
+    if start < len(text):
+        chunks.append(text[start:])
+    return chunks
+
+
+@pytest.mark.local
+class TestReplyFormatter:
+    """流式回复代码块识别的测试"""
+
+    def test_whole_reply(self):
+        formatter, fragments = _run([REPLY])
+        assert "".join(fragments) == REPLY
+        assert "```python\n" in fragments
+        assert fragments.count("```") == 2
+        assert formatter.text == REPLY
+        assert formatter.in_code_block is False
+
+    @pytest.mark.parametrize("size", [1, 2, 3, 5, 7])
+    def test_fences_split_across_chunks(self, size):
+        """任意切分位置下，代码块标记都作为完整片段发送"""
+        chunks = [REPLY[i:i + size] for i in range(0, len(REPLY), size)]
+        formatter, fragments = _run(chunks)
+        assert "".join(fragments) == REPLY
+        assert "```python\n" in fragments
+        assert "```\n" in fragments
+        assert fragments.count("```") == 2
+        for fragment in fragments:
+            if "`" in fragment and fragment not in ("`", "```", "```python\n", "```\n"):
+                assert "``" not in fragment
+        assert formatter.text == REPLY
+
+    def test_language_tag_split(self):
+        formatter = ReplyFormatter('test')
+        assert formatter.feed("前言``") == ["前言"]
+        assert formatter.feed("`py") == []
+        assert formatter.current_lang is None
+        assert formatter.feed("thon\nx = 1") == ["```python\n", "x = 1"]
+        assert formatter.in_code_block is True
+        assert formatter.current_lang == "python"
+        assert formatter.feed("\n`") == ["\n"]
+        assert formatter.feed("``") == ["```"]
+        assert formatter.in_code_block is False
+
+    def test_flush_unterminated_fence(self):
+        formatter = ReplyFormatter('test')
+        assert formatter.feed("结尾```js") == ["结尾"]
+        assert formatter.flush() == ["```js"]
+        assert formatter.flush() == []
+        assert formatter.text == "结尾```js"
+
+    def test_long_header_not_held(self):
+        """没有换行的超长内容不会被一直暂存"""
+        formatter = ReplyFormatter('test')
+        fragments = formatter.feed("```" + "x" * 100)
+        assert "".join(fragments) == "```" + "x" * 100
+
+    def test_random_chunking(self):
+        rng = random.Random(7)
+        for _ in range(50):
+            sizes = [rng.randint(1, 6) for _ in range(len(REPLY))]
+            formatter, fragments = _run(_split(REPLY, sizes))
+            assert "".join(fragments) == REPLY
+            assert fragments.count("```") == 2
+
+    def test_benchmark_50k_reply(self):
+        """5万字符的回复按单字符增量输入，耗时应随长度线性增长"""
+        text = (REPLY + "\n正文" * 20) * (50000 // (len(REPLY) + 60) + 1)
+        text = text[:50000]
+
+        def measure(content):
+            formatter = ReplyFormatter('bench')
+            started = time.perf_counter()
+            for char in content:
+                formatter.feed(char)
+                formatter.length
+            formatter.flush()
+            assert formatter.text == content
+            return time.perf_counter() - started
+
+        half = measure(text[:25000])
+        full = measure(text)
+        print(f"\nReplyFormatter 50k字符: {full * 1000:.1f}ms ({len(text) / full:,.0f} 字符/秒)")
+        assert full < 2.0
+        # 线性算法下长度翻倍耗时约翻倍，留出较大余量避免计时抖动
+        assert full < half * 4
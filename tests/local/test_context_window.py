@@ -0,0 +1,58 @@
+import pytest
+
+from src import context_window
+from src.context_window import build_context, estimate_tokens, token_budget, update_model_limits
+
+
+@pytest.mark.local
+class TestContextWindow:
+    """按token预算构建上下文的测试"""
+
+    @pytest.fixture(autouse=True)
+    def small_model(self, monkeypatch):
+        update_model_limits([{"id": "test/small", "context_length": 1000}])
+        monkeypatch.setitem(context_window.CONTEXT_CONFIG, 'safety_margin', 0)
+
+    def test_estimate_tokens(self):
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("a" * 400) == 101
+        assert estimate_tokens("你" * 100) == 101
+
+    def test_budget_uses_model_context_length(self):
+        assert token_budget("test/small", 200) == 800
+        assert token_budget("unknown/model", 200) == min(
+            context_window.CONTEXT_CONFIG['default_context_length'] - 200,
+            context_window.CONTEXT_CONFIG['max_context_tokens'],
+        )
+
+    def test_newest_turns_fit_budget(self):
+        """长文档被挤出预算，系统提示词和当前消息始终保留"""
+        messages = [
+            {"role": "system", "content": "你是助手"},
+            {"role": "user", "content": "x" * 8000},
+            {"role": "assistant", "content": "好的"},
+            {"role": "user", "content": "短问题"},
+            {"role": "assistant", "content": "短回答"},
+            {"role": "user", "content": "当前问题"},
+        ]
+        result = build_context(messages, "test/small", 200)
+        assert result[0] == messages[0]
+        assert result[-1] == messages[-1]
+        assert [m["content"] for m in result] == ["你是助手", "短问题", "短回答", "当前问题"]
+
+    def test_everything_fits(self):
+        messages = [
+            {"role": "user", "content": "a"},
+            {"role": "assistant", "content": "b"},
+            {"role": "user", "content": "c"},
+        ]
+        assert build_context(messages, "test/small", 200) == messages
+
+    def test_estimates_are_cached(self):
+        content = "缓存测试" * 50
+        estimate_tokens.cache_clear()
+        for _ in range(5):
+            build_context([{"role": "user", "content": content}, {"role": "user", "content": "q"}], "test/small", 10)
+        info = estimate_tokens.cache_info()
+        assert info.misses == 2
+        assert info.hits >= 8
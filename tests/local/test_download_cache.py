@@ -0,0 +1,170 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import app as app_module
+from src import transport
+from src.download_cache import DownloadCache
+
+IMAGE = b"\x89PNG\r\n" + bytes(range(256)) * 8
+EXPIRES = int(time.time()) + 3600
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(IMAGE)))
+        self.end_headers()
+        self.wfile.write(IMAGE)
+
+
+@pytest.mark.local
+class TestDownloadCache:
+    """下载缓存的测试"""
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return DownloadCache(tmp_path / 'downloads', max_bytes=10 * 1024 * 1024)
+
+    @pytest.fixture
+    def upstream(self):
+        _ImageHandler.requests = 0
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        transport.close_session()
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        transport.close_session()
+
+    def test_fetch_once_then_hit(self, cache, upstream):
+        first = cache.fetch(f"{upstream}/img/a.png?Expires={EXPIRES}&Signature=x")
+        second = cache.fetch(f"{upstream}/img/a.png?Expires={EXPIRES + 1}&Signature=y")
+        assert _ImageHandler.requests == 1
+        assert first.digest == second.digest
+        assert first.path.read_bytes() == IMAGE
+        assert first.content_type == 'image/png'
+        stats = cache.stats()
+        assert (stats['misses'], stats['hits'], stats['files'], stats['bytes']) == (1, 1, 1, len(IMAGE))
+
+    def test_expired_signature_is_not_served(self, cache, upstream):
+        """签名过期后不再从缓存发送，需要新的签名URL重新从上游获取"""
+        cache.store(f"{upstream}/img/a.png?Expires={EXPIRES}", [IMAGE], 'image/png')
+        assert cache.lookup(f"{upstream}/img/a.png?Expires={EXPIRES + 1}") is not None
+        # 请求的URL本身已过期
+        assert cache.lookup(f"{upstream}/img/a.png?Expires=1") is None
+        # 缓存时使用的签名已过期，即使请求的URL仍然有效
+        cache.store(f"{upstream}/img/a.png?Expires={int(time.time()) - 1}", [IMAGE], 'image/png')
+        assert cache.lookup(f"{upstream}/img/a.png?Expires={EXPIRES}") is None
+        cache.fetch(f"{upstream}/img/a.png?Expires={EXPIRES}&Signature=y")
+        assert _ImageHandler.requests == 1
+        assert cache.lookup(f"{upstream}/img/a.png?Expires={EXPIRES}") is not None
+        assert cache.stats()['files'] == 1
+
+    def test_same_content_stored_once(self, cache):
+        a = cache.store("https://cdn.siliconflow.com/a.png", [IMAGE], 'image/png')
+        b = cache.store("https://cdn.siliconflow.com/b.png", [IMAGE[:10], IMAGE[10:]], 'image/png')
+        assert a.digest == b.digest
+        assert cache.stats()['bytes'] == len(IMAGE)
+        assert cache.lookup("https://cdn.siliconflow.com/b.png").digest == a.digest
+
+    def test_lru_eviction_by_bytes(self, tmp_path):
+        cache = DownloadCache(tmp_path / 'downloads', max_bytes=250, evict_grace=0)
+        a = cache.store("https://cdn.siliconflow.com/a.png", [b"a" * 100], 'image/png')
+        cache.store("https://cdn.siliconflow.com/b.png", [b"b" * 100], 'image/png')
+        assert cache.lookup("https://cdn.siliconflow.com/a.png") is not None
+        cache.store("https://cdn.siliconflow.com/c.png", [b"c" * 100], 'image/png')
+        assert cache.lookup("https://cdn.siliconflow.com/b.png") is None
+        assert cache.lookup("https://cdn.siliconflow.com/a.png") is not None
+        stats = cache.stats()
+        assert stats['bytes'] == 200
+        assert stats['evicted'] == 1
+        assert a.path.exists()
+
+    def test_recently_accessed_files_are_kept(self, tmp_path):
+        """刚被访问的文件可能正在发送，即使超过上限也不淘汰"""
+        cache = DownloadCache(tmp_path / 'downloads', max_bytes=150, evict_grace=60)
+        a = cache.store("https://cdn.siliconflow.com/a.png", [b"a" * 100], 'image/png')
+        b = cache.store("https://cdn.siliconflow.com/b.png", [b"b" * 100], 'image/png')
+        assert a.path.exists() and b.path.exists()
+        assert cache.stats()['evicted'] == 0
+
+    def test_missing_file_is_refetched(self, cache):
+        cached = cache.store("https://cdn.siliconflow.com/a.png", [IMAGE], 'image/png')
+        cached.path.unlink()
+        assert cache.lookup("https://cdn.siliconflow.com/a.png") is None
+        assert cache.stats()['bytes'] == 0
+
+
+@pytest.mark.local
+class TestDownloadRoute:
+    """/api/download 的缓存发送测试"""
+
+    URL = f"https://cdn.siliconflow.com/img/a.png?Expires={EXPIRES}"
+
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        cache = DownloadCache(tmp_path / 'downloads')
+        self.cached = cache.store(self.URL, [IMAGE], 'image/png')
+        monkeypatch.setattr(app_module, 'download_cache', cache)
+        self.client = app_module.app.test_client()
+
+    def test_sendfile_with_etag_and_range(self):
+        response = self.client.get('/api/download', query_string={'url': self.URL})
+        assert response.status_code == 200
+        assert response.data == IMAGE
+        assert response.headers['ETag'] == f'"{self.cached.digest}"'
+        assert 'attachment; filename=a.png' in response.headers['Content-Disposition']
+
+        not_modified = self.client.get('/api/download', query_string={'url': self.URL},
+                                       headers={'If-None-Match': f'"{self.cached.digest}"'})
+        assert not_modified.status_code == 304
+        assert not_modified.data == b""
+
+        partial = self.client.get('/api/download', query_string={'url': self.URL}, headers={'Range': 'bytes=0-9'})
+        assert partial.status_code == 206
+        assert partial.data == IMAGE[:10]
+
+    def test_x_accel_redirect_behind_nginx(self):
+        response = self.client.get('/api/download', query_string={'url': self.URL},
+                                   headers={'X-Sendfile-Type': 'X-Accel-Redirect'})
+        assert response.status_code == 200
+        assert response.data == b""
+        assert response.headers['X-Accel-Redirect'] == f"/_download_cache/{self.cached.relative_path}"
+        assert response.headers['Content-Type'] == 'image/png'
+
+    def test_rejects_other_hosts(self):
+        response = self.client.get('/api/download', query_string={'url': "http://127.0.0.1/cdn.siliconflow.com/a.png"})
+        assert response.status_code == 403
+
+    def test_file_evicted_before_send_is_refetched(self, monkeypatch):
+        """查找之后文件被其他worker淘汰时重新获取"""
+        cache = app_module.download_cache
+        original = cache.fetch
+        calls = []
+
+        def fetch(url):
+            calls.append(url)
+            if len(calls) == 2:
+                # 代替重新下载
+                cache.store(url, [IMAGE], 'image/png')
+            cached = original(url)
+            if len(calls) == 1:
+                cached.path.unlink()
+            return cached
+
+        monkeypatch.setattr(cache, 'fetch', fetch)
+        response = self.client.get('/api/download', query_string={'url': self.URL})
+        assert response.status_code == 200
+        assert response.data == IMAGE
+        assert len(calls) == 2
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+
+import pytest
+
+from src import app as app_module
+from src.image_batch import BatchRunner
+
+
+@pytest.mark.local
+class TestImageBatch:
+    """批量图像生成的测试"""
+
+    def test_results_in_completion_order(self):
+        runner = BatchRunner(workers=4, model_concurrency=4)
+        delays = {0: 0.2, 1: 0.0, 2: 0.1}
+        order = [index for index, _ in runner.run([('m', i) for i in range(3)], lambda i: time.sleep(delays[i]) or i)]
+        assert order == [1, 2, 0]
+
+    def test_model_concurrency_is_bounded(self):
+        runner = BatchRunner(workers=8, model_concurrency=2)
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+
+        def handler(model):
+            with lock:
+                running[model] = running.get(model, 0) + 1
+                peak[model] = max(peak.get(model, 0), running[model])
+            time.sleep(0.05)
+            with lock:
+                running[model] -= 1
+            return model
+
+        items = [('a', 'a')] * 6 + [('b', 'b')] * 2
+        results = list(runner.run(items, handler))
+        assert sorted(index for index, _ in results) == list(range(8))
+        assert peak == {'a': 2, 'b': 2}
+        assert runner.stats()['running'] == {}
+
+    def test_errors_are_returned_inline(self):
+        runner = BatchRunner(workers=2)
+
+        def handler(value):
+            if value == 1:
+                raise RuntimeError("boom")
+            return value
+
+        results = dict(runner.run([('m', 0), ('m', 1), ('m', 2)], handler))
+        assert isinstance(results[1], RuntimeError)
+        assert (results[0], results[2]) == (0, 2)
+        assert runner.stats()['failed'] == 1
+
+    def test_slot_released_when_handler_is_interrupted(self):
+        """handler 抛出非 Exception 的异常时名额仍被归还，同一模型的其余条目继续执行"""
+        class Interrupted(BaseException):
+            pass
+
+        runner = BatchRunner(workers=2, model_concurrency=1)
+
+        def handler(value):
+            if value == 0:
+                raise Interrupted()
+            return value
+
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(runner.run([('m', 0), ('m', 1)], handler)))
+        thread.start()
+        thread.join(2)
+        assert not thread.is_alive()
+        assert isinstance(results[0], RuntimeError) and results[1] == 1
+        assert runner.stats()['running'] == {}
+
+    def test_batch_route_streams_ndjson(self, monkeypatch):
+        class FakeClient:
+            def generate_image(self, payload):
+                if payload['prompt'] == 'fail':
+                    return {"error": "upstream", "images": []}
+                return {"images": [{"url": f"https://cdn.siliconflow.com/{payload['prompt']}.png"}], "credits_used": 1}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        client = app_module.app.test_client()
+        response = client.post('/api/generate/batch', json={
+            "width": 512, "height": 512, "num_images": 1,
+            "items": [{"prompt": "cat"}, {"prompt": "fail"}, {"prompt": "dog", "width": "wide"}],
+        })
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        by_index = {line['index']: line for line in lines[:-1]}
+        assert by_index[0]['status'] == 200 and by_index[0]['images'] == ["https://cdn.siliconflow.com/cat.png"]
+        assert by_index[1]['status'] == 500 and by_index[1]['error'] == "upstream"
+        assert by_index[2]['status'] == 400
+        assert lines[-1] == {"done": True, "total": 3, "succeeded": 1, "failed": 2}
+
+        sse = client.post('/api/generate/batch?format=sse', json=[{"prompt": "cat", "width": 512, "height": 512, "num_images": 1}])
+        assert sse.mimetype == 'text/event-stream'
+        assert sse.get_data(as_text=True).endswith('data: [DONE]\n\n')
+
+        assert client.post('/api/generate/batch', json={"items": []}).status_code == 400
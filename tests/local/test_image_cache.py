@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src import app as app_module
+from src.app import build_image_payload
+from src.image_cache import ImageResultCache, cache_key
+
+REQUEST = {"prompt": " 一只猫 ", "width": "1024", "height": 1024, "num_images": 1, "deterministic": True}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _body(url="https://cdn.siliconflow.com/a.png"):
+    return {"images": [url], "usage": {"duration": 0, "credits_used": 1}}
+
+
+@pytest.mark.local
+class TestImageCache:
+    """图像结果缓存的测试"""
+
+    def test_deterministic_payload(self):
+        first = build_image_payload(REQUEST)
+        second = build_image_payload({**REQUEST, "prompt": "一只猫", "width": 1024})
+        assert first == second
+        assert cache_key(first) == cache_key(second)
+        assert build_image_payload({**REQUEST, "prompt": "一只狗"})["variation_seed"] != first["variation_seed"]
+        assert build_image_payload({**REQUEST, "deterministic": False, "seed": 42})["variation_seed"] == 42
+        with pytest.raises(ValueError):
+            build_image_payload({**REQUEST, "width": "large"})
+
+    def test_hit_and_miss(self):
+        cache = ImageResultCache()
+        calls = []
+
+        def generate():
+            calls.append(1)
+            return _body(), 200
+
+        assert cache.get_or_generate({"p": 1}, generate)[2] == 'MISS'
+        assert cache.get_or_generate({"p": 1}, generate) == (_body(), 200, 'HIT')
+        assert len(calls) == 1
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+    def test_errors_are_not_cached(self):
+        cache = ImageResultCache()
+        assert cache.get_or_generate({"p": 1}, lambda: ({"error": "x"}, 500))[1:] == (500, 'MISS')
+        assert cache.get_or_generate({"p": 1}, lambda: (_body(), 200))[2] == 'MISS'
+
+    def test_ttl_follows_url_expiry(self):
+        clock = FakeClock()
+        cache = ImageResultCache(ttl=3600, expiry_margin=60, clock=clock)
+        cache.put('a', _body())
+        cache.put('b', _body(f"https://sc-maas.oss-cn-shanghai.aliyuncs.com/x.png?Expires={int(clock.now) + 600}&Signature=s"))
+        clock.now += 600 - 60
+        assert cache.get('a') is not None
+        assert cache.get('b') is None
+        clock.now += 3000
+        assert cache.get('a') is None
+        assert cache.stats()['expired'] == 2
+
+    def test_entry_and_byte_bounds(self):
+        cache = ImageResultCache(max_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, _body())
+        assert cache.get('a') is None
+        assert cache.stats()['evicted'] == 1
+
+        size = cache.stats()['bytes'] // 2
+        cache = ImageResultCache(max_bytes=size * 2)
+        cache.put('a', _body())
+        cache.put('b', _body())
+        cache.get('a')
+        cache.put('c', _body())
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.stats()['bytes'] <= size * 2
+
+    def test_concurrent_requests_share_one_call(self):
+        cache = ImageResultCache()
+        calls = []
+        results = []
+
+        def generate():
+            calls.append(1)
+            time.sleep(0.1)
+            return _body(), 200
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_generate({"p": 1}, generate)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert sorted(r[2] for r in results) == ['MISS', 'SHARED', 'SHARED', 'SHARED', 'SHARED']
+        assert cache.stats()['coalesced'] == 4
+
+    def test_async_requests_share_one_call(self):
+        cache = ImageResultCache()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return _body(), 200
+
+        async def run():
+            return await asyncio.gather(*(cache.aget_or_generate({"p": 1}, generate) for _ in range(3)))
+
+        results = asyncio.run(run())
+        assert len(calls) == 1
+        assert [r[2] for r in results] == ['MISS', 'SHARED', 'SHARED']
+
+    def test_generate_route_uses_cache(self, monkeypatch):
+        calls = []
+
+        class FakeClient:
+            def generate_image(self, payload):
+                calls.append(payload)
+                return {"images": [{"url": "https://cdn.siliconflow.com/a.png"}], "credits_used": 1}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        monkeypatch.setattr(app_module, 'image_cache', ImageResultCache())
+        client = app_module.app.test_client()
+        first = client.post('/api/generate', json=REQUEST)
+        second = client.post('/api/generate', json=REQUEST)
+        third = client.post('/api/generate', json={**REQUEST, "deterministic": False})
+        assert first.headers['X-Cache'] == 'MISS'
+        assert second.headers['X-Cache'] == 'HIT'
+        assert third.headers['X-Cache'] == 'BYPASS'
+        assert second.get_json() == first.get_json()
+        assert len(calls) == 2
+        assert client.get('/api/generate/cache').get_json()['hits'] == 1
@@ -0,0 +1,194 @@
+import threading
+import time
+
+import pytest
+
+import requests
+
+from src import api_client
+from src import app as app_module
+from src.image_jobs import IMAGE_JOB_CONFIG, ImageJobExecutor, ImageJobStore, JobQueueFull
+from src.log_tail import TailSlots
+from src.upstream_governor import UpstreamGovernor
+
+REQUEST = {"prompt": "一只猫", "width": 512, "height": 512, "num_images": 1}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _wait_finished(store, job_id, timeout=2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = store.get(job_id)
+        if job['status'] in ('succeeded', 'failed', 'expired'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("任务没有结束")
+
+
+@pytest.mark.local
+class TestImageJobs:
+    """异步图像任务的测试"""
+
+    def test_lifecycle_is_shared_between_stores(self, tmp_path):
+        clock = FakeClock()
+        store = ImageJobStore(tmp_path / 'jobs.db', clock=clock)
+        other = ImageJobStore(tmp_path / 'jobs.db', clock=clock)
+        first = store.create(REQUEST)
+        clock.now += 1
+        second = store.create(REQUEST)
+        assert other.get(second)['position'] == 1
+        assert store.start(first)
+        assert other.get(first)['status'] == 'running'
+        assert store.finish(first, {"images": ["a"]}) == 'succeeded'
+        job = other.get(first)
+        assert (job['status'], job['result']) == ('succeeded', {"images": ["a"]})
+        assert other.get(second)['position'] == 0
+        assert store.finish(second, None, 500, "失败") == 'failed'
+        assert other.get('missing') is None
+
+    def test_queue_depth_is_bounded(self, tmp_path):
+        store = ImageJobStore(tmp_path / 'jobs.db', max_pending=2)
+        job_id = store.create(REQUEST)
+        store.create(REQUEST)
+        with pytest.raises(JobQueueFull):
+            store.create(REQUEST)
+        store.start(job_id)
+        store.finish(job_id, {"images": []})
+        store.create(REQUEST)
+        stats = store.stats()
+        assert (stats['submitted'], stats['rejected'], stats['queued']) == (3, 1, 2)
+
+    def test_deadline_and_retention(self, tmp_path):
+        clock = FakeClock()
+        store = ImageJobStore(tmp_path / 'jobs.db', deadline=10, retention=60, clock=clock)
+        late = store.create(REQUEST)
+        running = store.create(REQUEST)
+        assert store.start(running)
+        clock.now += 11
+        assert not store.start(late)
+        assert store.get(late)['status'] == 'expired'
+        assert store.finish(running, {"images": []}) == 'expired'
+        clock.now += 61
+        assert store.purge() == 2
+        assert store.get(late) is None
+
+    def test_executor_runs_jobs_in_background(self, tmp_path):
+        store = ImageJobStore(tmp_path / 'jobs.db')
+        executor = ImageJobExecutor(store, workers=1)
+        gate = threading.Event()
+
+        def run(remaining):
+            gate.wait(2)
+            return {"images": ["a"]}, 200
+
+        job_id = executor.submit(REQUEST, run)
+        assert store.get(job_id)['status'] in ('queued', 'running')
+        gate.set()
+        assert _wait_finished(store, job_id)['result'] == {"images": ["a"]}
+
+        failed = executor.submit(REQUEST, lambda remaining: ({"error": "上游错误"}, 500))
+        job = _wait_finished(store, failed)
+        assert (job['status'], job['error'], job['http_status']) == ('failed', "上游错误", 500)
+
+    def test_jobs_expired_in_queue_are_skipped(self, tmp_path):
+        """排队期间超过截止时间的任务不执行，执行中的任务收到剩余的截止时间"""
+        store = ImageJobStore(tmp_path / 'jobs.db')
+        executor = ImageJobExecutor(store, workers=1)
+        gate = threading.Event()
+        calls = []
+
+        def run(remaining):
+            calls.append(remaining)
+            gate.wait(2)
+            return {"images": ["a"]}, 200
+
+        first = executor.submit(REQUEST, run, deadline=5)
+        queued = executor.submit(REQUEST, run, deadline=0.1)
+        time.sleep(0.2)
+        gate.set()
+        assert _wait_finished(store, first)['status'] == 'succeeded'
+        assert _wait_finished(store, queued)['status'] == 'expired'
+        assert len(calls) == 1 and 4 < calls[0] <= 5
+
+    def test_job_deadline_bounds_upstream_call(self, tmp_path, monkeypatch):
+        """上游调用以任务剩余的截止时间为时限，到期后任务记为 expired"""
+        timeouts = []
+
+        class SlowSession:
+            def post(self, url, timeout=None, **kwargs):
+                timeouts.append(timeout)
+                time.sleep(timeout)
+                raise requests.exceptions.ReadTimeout("read timed out")
+
+        def make_client():
+            client = api_client.LoggingSiliconFlowClient()
+            monkeypatch.setattr(client, 'headers', {**client.headers, "Authorization": "Bearer test-key"})
+            return client
+
+        store = ImageJobStore(tmp_path / 'jobs.db')
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', make_client)
+        monkeypatch.setattr(api_client, 'get_session', lambda: SlowSession())
+        monkeypatch.setattr(api_client, 'governor', UpstreamGovernor(enabled=False))
+        monkeypatch.setattr(app_module, 'image_job_store', store)
+        monkeypatch.setattr(app_module, 'image_job_executor', ImageJobExecutor(store, workers=1))
+        breaker = api_client.resilience.breaker('images')
+        failures = breaker.failures
+        client = app_module.app.test_client()
+
+        response = client.post('/api/jobs/images', json={**REQUEST, "deadline": 1})
+        job = _wait_finished(store, response.get_json()['job_id'], timeout=5)
+        assert job['status'] == 'expired'
+        assert len(timeouts) == 1 and 0.5 < timeouts[0] <= 1
+        # 调用方时限到期不计入熔断
+        assert breaker.failures == failures
+
+    def test_job_routes(self, tmp_path, monkeypatch):
+        class FakeClient:
+            def generate_image(self, payload, timeout=None):
+                return {"images": [{"url": "https://cdn.siliconflow.com/a.png"}], "credits_used": 1}
+
+        store = ImageJobStore(tmp_path / 'jobs.db')
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        monkeypatch.setattr(app_module, 'image_job_store', store)
+        monkeypatch.setattr(app_module, 'image_job_executor', ImageJobExecutor(store, workers=1))
+        client = app_module.app.test_client()
+
+        response = client.post('/api/jobs/images', json=REQUEST)
+        assert response.status_code == 202
+        job_id = response.get_json()['job_id']
+        assert response.headers['Location'] == f"/api/jobs/{job_id}"
+        _wait_finished(store, job_id)
+        job = client.get(f'/api/jobs/{job_id}').get_json()
+        assert job['result']['images'] == ["https://cdn.siliconflow.com/a.png"]
+
+        events = client.get(f'/api/jobs/{job_id}/events').get_data(as_text=True)
+        assert '"status": "succeeded"' in events and events.endswith('data: [DONE]\n\n')
+
+        assert client.get('/api/jobs/missing').status_code == 404
+        assert client.post('/api/jobs/images', json={"prompt": "x"}).status_code == 400
+        assert client.get('/api/jobs/stats').get_json()['succeeded'] == 1
+
+    def test_events_stream_is_capped(self, tmp_path, monkeypatch):
+        """进度流超过连接数上限时返回429，超过最长时间后发送 reconnect 并关闭"""
+        store = ImageJobStore(tmp_path / 'jobs.db')
+        job_id = store.create(REQUEST)
+        monkeypatch.setattr(app_module, 'image_job_store', store)
+        monkeypatch.setattr(app_module, 'image_job_event_slots', TailSlots(tmp_path / 'slots', count=1))
+        monkeypatch.setitem(IMAGE_JOB_CONFIG, 'events_max_duration', 0)
+        client = app_module.app.test_client()
+
+        first = client.get(f'/api/jobs/{job_id}/events')
+        busy = client.get(f'/api/jobs/{job_id}/events')
+        assert busy.status_code == 429 and busy.headers['Retry-After'] == '5'
+        events = first.get_data(as_text=True)
+        assert '"status": "queued"' in events and '"type": "reconnect"' in events
+        assert '[DONE]' not in events
+        first.close()
+        assert client.get(f'/api/jobs/{job_id}/events').status_code == 200
@@ -0,0 +1,93 @@
+import pytest
+from flask import Flask, Response, send_file
+
+from src.instrumentation import InstrumentedBody, ResponseMetrics, instrument_response
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.01
+        return self.now
+
+
+@pytest.mark.local
+class TestInstrumentation:
+    """响应埋点的测试"""
+
+    def test_counts_bytes_and_times_as_chunks_go_out(self):
+        produced = []
+
+        def body():
+            for chunk in ("data: 一\n\n", b"data: two\n\n", "", b"x" * 100):
+                produced.append(chunk)
+                yield chunk
+
+        closed = []
+        metrics = ResponseMetrics(0.0, preview_limit=16)
+        wrapped = InstrumentedBody(body(), metrics, closed.append, clock=FakeClock())
+        iterator = iter(wrapped)
+        assert next(iterator) == "data: 一\n\n".encode('utf-8')
+        assert len(produced) == 1
+        assert metrics.ttfb_ms == pytest.approx(10)
+
+        rest = list(iterator)
+        assert len(rest) == 2
+        assert metrics.bytes == len("data: 一\n\n".encode('utf-8')) + 11 + 100
+        assert metrics.chunks == 3
+        assert metrics.ttlb_ms == pytest.approx(30)
+        assert len(metrics.preview) == 16
+        assert metrics.preview_text().startswith("data: 一")
+
+        wrapped.close()
+        wrapped.close()
+        assert closed == [metrics]
+
+    def test_flask_streaming_response_is_not_buffered(self):
+        app = Flask(__name__)
+        logged = []
+        state = {'yielded': 0}
+
+        @app.route('/stream')
+        def stream():
+            def generate():
+                for i in range(3):
+                    state['yielded'] += 1
+                    yield f"data: {i}\n\n"
+            return Response(generate(), mimetype='text/event-stream')
+
+        @app.after_request
+        def instrument(response):
+            return instrument_response(response, 0.0, logged.append)
+
+        response = app.test_client().get('/stream', buffered=False)
+        # 测试客户端会预先取出第一个数据块以获得响应头，其余数据块仍按需生成
+        assert state['yielded'] <= 1
+        assert logged == []
+        assert response.get_data() == b"data: 0\n\ndata: 1\n\ndata: 2\n\n"
+        response.close()
+        assert len(logged) == 1
+        assert logged[0].bytes == 27
+        assert logged[0].chunks == 3
+
+    def test_file_responses_pass_through(self, tmp_path):
+        path = tmp_path / 'image.png'
+        path.write_bytes(b"\x89PNG" + b"0" * 60)
+        app = Flask(__name__)
+        logged = []
+
+        @app.route('/file')
+        def file():
+            return send_file(path)
+
+        @app.after_request
+        def instrument(response):
+            return instrument_response(response, 0.0, logged.append)
+
+        response = app.test_client().get('/file')
+        assert response.data.startswith(b"\x89PNG")
+        assert len(logged) == 1
+        assert logged[0].passthrough is True
+        assert logged[0].bytes == 64
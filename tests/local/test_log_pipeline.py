@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from src import log_pipeline
+from src.log_pipeline import install_queue_logging, log_payload, log_time, reset_log_time, stop_queue_logging
+
+
+class SlowHandler(logging.Handler):
+    """模拟磁盘I/O卡顿的处理器"""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.threads.add(threading.get_ident())
+        self.messages.append(record.getMessage())
+
+
+class CountingPayload:
+    def __init__(self):
+        self.calls = 0
+        self.threads = set()
+
+    def __str__(self):
+        self.calls += 1
+        self.threads.add(threading.get_ident())
+        return "payload"
+
+
+@pytest.mark.local
+class TestLogPipeline:
+    """非阻塞日志管道的测试"""
+
+    @pytest.fixture
+    def slow_logger(self, request):
+        name = f"test.pipeline.{request.node.name}"
+        target = logging.getLogger(name)
+        target.propagate = False
+        target.setLevel(logging.DEBUG)
+        handler = SlowHandler(0.02)
+        target.addHandler(handler)
+        yield name, target, handler
+        stop_queue_logging([name])
+        target.removeHandler(handler)
+
+    def test_logging_does_not_block_on_slow_handler(self, slow_logger):
+        name, target, handler = slow_logger
+        install_queue_logging([name], queue_size=1000)
+        reset_log_time()
+        started = time.perf_counter()
+        for i in range(20):
+            target.info("消息 %d", i)
+        elapsed = time.perf_counter() - started
+        assert elapsed < 0.2
+        assert log_time() <= elapsed
+        stop_queue_logging([name])
+        assert handler.messages == [f"消息 {i}" for i in range(20)]
+        assert threading.get_ident() not in handler.threads
+
+    def test_formatting_happens_in_listener(self, slow_logger):
+        name, target, handler = slow_logger
+        install_queue_logging([name])
+        payload = CountingPayload()
+        target.info("内容: %s", payload)
+        assert payload.calls == 0
+        stop_queue_logging([name])
+        assert payload.calls == 1
+        assert threading.get_ident() not in payload.threads
+
+    def test_full_queue_drops_and_reports(self, slow_logger):
+        name, target, handler = slow_logger
+        install_queue_logging([name], queue_size=2)
+        for i in range(50):
+            target.info("消息 %d", i)
+        queue_stats = log_pipeline.stats()[name]
+        assert queue_stats['dropped'] > 0
+        assert queue_stats['enqueued'] + queue_stats['dropped'] == 50
+        stop_queue_logging([name])
+        assert any(m.startswith("日志队列已满，丢弃了") for m in handler.messages)
+
+    def test_log_payload_sampling_and_truncation(self, monkeypatch, caplog):
+        target = logging.getLogger("test.pipeline.payload")
+        monkeypatch.setitem(log_pipeline.LOG_CONFIG, 'payload_max_chars', 10)
+        with caplog.at_level(logging.INFO, logger=target.name):
+            assert log_payload(target, logging.INFO, "历史", [{"content": "x" * 50}], sample_rate=0) is False
+            assert log_payload(target, logging.DEBUG, "历史", "ignored", sample_rate=1) is False
+            assert log_payload(target, logging.INFO, "历史", [{"content": "x" * 50}], sample_rate=1) is True
+        assert len(caplog.records) == 1
+        message = caplog.records[0].getMessage()
+        assert message == '历史: [{"content...(共 67 字符)'
+
+    def test_log_payload_snapshots_mutable_payload(self, slow_logger):
+        """消息列表在记录之后被修改，写出的仍是调用时的内容"""
+        name, target, handler = slow_logger
+        install_queue_logging([name])
+        messages = [{"role": "user", "content": "你好"}]
+        assert log_payload(target, logging.INFO, "消息历史", messages, sample_rate=1) is True
+        messages.append({"role": "assistant", "content": "回复"})
+        messages[0]["content"] = "已修改"
+        stop_queue_logging([name])
+        assert handler.messages == ['消息历史: [{"role": "user", "content": "你好"}]']
+
+    def test_server_timing_header(self):
+        from src.app import app
+        response = app.test_client().get('/health')
+        assert response.headers['Server-Timing'].startswith('log;dur=')
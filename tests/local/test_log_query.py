@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from src import app as app_module
+from src.log_query import LogQuery, LogSearcher, Record, TimeIndex, log_timestamp
+from src.log_reader import LineIndex, LogReader
+
+
+def _record(minute, level, name, message, extra=()):
+    lines = [f"2024-05-01 10:{minute:02d}:00,000 [{level}] [{name}:12] {message}\n"]
+    lines.extend(f"{line}\n" for line in extra)
+    return ''.join(lines)
+
+
+def _write(path, records):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(''.join(records))
+
+
+@pytest.mark.local
+class TestLogQuery:
+    """日志查询接口的测试"""
+
+    def test_filters(self):
+        query = LogQuery(level='warning', logger_name='src', since='2024-05-01T10:05:00', session_id='abc', text='失败')
+        record = Record('2024-05-01 10:06:00,000', 'ERROR', 'src.app', '会话ID: abc 生成失败\n', 0)
+        assert query.matches(record)
+        assert not query.matches(record._replace(level='INFO'))
+        assert not query.matches(record._replace(logger='srcx'))
+        assert not query.matches(record._replace(timestamp='2024-05-01 10:04:59,999'))
+        with pytest.raises(ValueError):
+            LogQuery(level='LOUD')
+        with pytest.raises(ValueError):
+            log_timestamp('yesterday')
+
+    def test_time_index_narrows_scan(self, tmp_path):
+        path = tmp_path / 'app.log'
+        _write(path, [_record(minute, 'INFO', 'src.app', f"第{minute}条", extra=['  续行']) for minute in range(60)])
+        index = LineIndex(path, tmp_path / 'app.idx')
+        index.refresh(path.stat().st_size)
+        time_index = TimeIndex(every=10)
+        time_index.extend(index)
+        assert time_index.lines == list(range(0, 120, 10))
+        start = time_index.start_line(log_timestamp('2024-05-01 10:30:00'))
+        end = time_index.end_line(log_timestamp('2024-05-01 10:40:00'), len(index))
+        assert start <= 60 and start >= 50
+        assert end >= 82 and end <= 90
+
+    def test_search_across_backups_with_cursor(self, tmp_path):
+        reader = LogReader(tmp_path, index_dir=tmp_path / 'idx')
+        _write(tmp_path / 'app.log.1', [_record(m, 'ERROR' if m % 3 == 0 else 'INFO', 'src.app', f"第{m}条 会话ID: s{m % 2}")
+                                        for m in range(30)])
+        _write(tmp_path / 'app.log', [_record(m, 'ERROR', 'src.api_client', f"第{m}条 失败",
+                                              extra=['Traceback (most recent call last):', '  boom'])
+                                      for m in range(30, 40)])
+        searcher = LogSearcher(reader, max_results=4)
+
+        query = LogQuery(level='ERROR', since='2024-05-01 10:20:00', until='2024-05-01 10:33:00')
+        page = searcher.search('app', query)
+        assert [m['timestamp'][14:16] for m in page['matches']] == ['21', '24', '27', '30']
+        page = searcher.search('app', query, cursor=page['next_cursor'])
+        assert [m['timestamp'][14:16] for m in page['matches']] == ['31', '32', '33']
+        assert page['next_cursor'] is None
+        assert page['matches'][0]['message'].endswith('  boom')
+        assert page['matches'][0]['file'] == 'app.log'
+
+        page = searcher.search('app', LogQuery(session_id='s1', logger_name='src.app'), limit=100)
+        assert page['count'] == 4
+        assert page['next_cursor'] is not None
+
+    def test_scan_budget_returns_cursor(self, tmp_path):
+        reader = LogReader(tmp_path, index_dir=tmp_path / 'idx')
+        _write(tmp_path / 'app.log', [_record(m % 60, 'INFO', 'src.app', f"第{m}条") for m in range(50)])
+        searcher = LogSearcher(reader, max_scan_lines=20)
+        page = searcher.search('app', LogQuery(text='不存在'))
+        assert page['count'] == 0 and page['next_cursor'] == f"{os.stat(tmp_path / 'app.log').st_ino}:20"
+
+    def test_query_route(self, tmp_path, monkeypatch):
+        reader = LogReader(tmp_path, index_dir=tmp_path / 'idx')
+        monkeypatch.setattr(app_module, 'log_searcher', LogSearcher(reader))
+        _write(tmp_path / 'chat.log', [_record(m, 'INFO', 'chat', f"会话ID: abc 第{m}条") for m in range(5)])
+        client = app_module.app.test_client()
+        data = client.get('/api/logs/chat/query?session_id=abc&q=第3条').get_json()
+        assert data['count'] == 1 and data['matches'][0]['line'] == 3
+        assert client.get('/api/logs/chat/query?since=soon').status_code == 400
+        assert client.get('/api/logs/nope/query').status_code == 400
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from src import app as app_module
+from src.log_reader import LineIndex, LogReader
+
+
+def _write(path, first, count):
+    with open(path, 'a', encoding='utf-8') as f:
+        for n in range(first, first + count):
+            f.write(f"2024-01-01 00:00:00,000 [INFO] [app:1] 第{n}行\n")
+
+
+def _rotate(directory, backup_count=5):
+    """与 RotatingFileHandler.doRollover 相同的重命名顺序"""
+    base = directory / 'app.log'
+    for n in range(backup_count - 1, 0, -1):
+        if os.path.exists(f"{base}.{n}"):
+            os.replace(f"{base}.{n}", f"{base}.{n + 1}")
+    os.replace(base, f"{base}.1")
+    base.touch()
+
+
+def _numbers(page):
+    return [int(line.rsplit('第', 1)[1][:-2]) for line in page['content'].splitlines(keepends=True)]
+
+
+@pytest.mark.local
+class TestLogReader:
+    """按行偏移索引读取日志的测试"""
+
+    def test_index_grows_incrementally(self, tmp_path):
+        path = tmp_path / 'app.log'
+        _write(path, 0, 3)
+        with open(path, 'a') as f:
+            f.write('未写完的一行')
+        index = LineIndex(path, tmp_path / 'app.idx', chunk_size=16)
+        index.refresh(path.stat().st_size)
+        assert len(index) == 3
+        assert index.read_lines(1, 3)[0].endswith('第1行\n')
+        with open(path, 'a') as f:
+            f.write('\n')
+        _write(path, 4, 2)
+        index.refresh(path.stat().st_size)
+        assert len(index) == 6
+        # 另一个worker直接使用已保存的索引，不需要重新扫描
+        other = LineIndex(path, tmp_path / 'app.idx')
+        other.refresh(path.stat().st_size)
+        assert list(other.ends) == list(index.ends)
+
+    def test_truncated_file_is_reindexed(self, tmp_path):
+        path = tmp_path / 'app.log'
+        _write(path, 0, 5)
+        index = LineIndex(path, tmp_path / 'app.idx')
+        index.refresh(path.stat().st_size)
+        path.write_text('x\n')
+        index.refresh(path.stat().st_size)
+        assert list(index.ends) == [2]
+
+    def test_continuous_view_across_backups(self, tmp_path):
+        reader = LogReader(tmp_path, index_dir=tmp_path / 'idx')
+        _write(tmp_path / 'app.log', 0, 10)
+        _rotate(tmp_path)
+        _write(tmp_path / 'app.log', 10, 10)
+        _rotate(tmp_path)
+        _write(tmp_path / 'app.log', 20, 5)
+
+        page = reader.read('app', start=8, lines=15)
+        assert _numbers(page) == list(range(8, 23))
+        assert page['total_lines'] == 25 and page['next_start_line'] == 23
+        assert [f['name'] for f in page['files']] == ['app.log.2', 'app.log.1', 'app.log']
+
+        tail = reader.read('app', lines=4)
+        assert _numbers(tail) == [21, 22, 23, 24]
+        previous = reader.read('app', lines=4, cursor=tail['cursor'], backward=True)
+        assert _numbers(previous) == [17, 18, 19, 20]
+
+    def test_cursor_survives_rotation(self, tmp_path):
+        reader = LogReader(tmp_path, index_dir=tmp_path / 'idx', backup_count=2)
+        _write(tmp_path / 'app.log', 0, 10)
+        page = reader.read('app', start=0, lines=6)
+        _rotate(tmp_path, backup_count=2)
+        _write(tmp_path / 'app.log', 10, 3)
+        assert _numbers(reader.read('app', lines=6, cursor=page['next_cursor'])) == [6, 7, 8, 9, 10, 11]
+        # 追到末尾后游标指向当前文件末尾，之后只返回新追加的行
+        end = reader.read('app', lines=100, cursor=page['next_cursor'])
+        _write(tmp_path / 'app.log', 13, 1)
+        assert _numbers(reader.read('app', lines=100, cursor=end['next_cursor'])) == [13]
+        # 最旧的备份被删除后，对应的索引也被清理
+        _rotate(tmp_path, backup_count=2)
+        _rotate(tmp_path, backup_count=2)
+        reader.read('app', lines=10)
+        assert len(list((tmp_path / 'idx').glob('*.idx'))) == 3
+
+    def test_get_logs_route(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(app_module, 'log_reader', LogReader(tmp_path, index_dir=tmp_path / 'idx'))
+        client = app_module.app.test_client()
+        assert client.get('/api/logs/chat').status_code == 404
+        _write(tmp_path / 'chat.log', 0, 30)
+        data = client.get('/api/logs/chat?lines=10&start_line=5').get_json()
+        assert _numbers(data) == list(range(5, 15))
+        assert data['next_start_line'] == 15 and data['log_type'] == 'chat'
+        data = client.get('/api/logs/chat?lines=10&direction=backward').get_json()
+        assert _numbers(data) == list(range(20, 30))
+        assert client.get('/api/logs/chat?cursor=abc').status_code == 400
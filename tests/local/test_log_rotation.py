@@ -0,0 +1,121 @@
+import gzip
+import io
+import logging
+import tarfile
+
+import pytest
+
+from src import app as app_module
+from src.log_reader import LogReader
+from src.log_rotation import BlockGzipFile, CompressingRotatingFileHandler, blocks_path, compress_log
+
+
+def _lines(first, count):
+    return ''.join(f"2024-05-01 10:00:00,000 [INFO] [app:1] 第{n}行\n" for n in range(first, first + count))
+
+
+@pytest.mark.local
+class TestLogRotation:
+    """日志备份压缩和下载的测试"""
+
+    def test_block_compressed_file_is_seekable(self, tmp_path):
+        source = tmp_path / 'app.log.1'
+        content = _lines(0, 500).encode('utf-8')
+        source.write_bytes(content)
+        dest = tmp_path / 'app.log.1.gz'
+        compress_log(source, dest, tmp_path / 'idx', block_size=1000)
+        assert not source.exists()
+        # 多个 gzip 成员组成的文件仍然可以整体解压
+        assert gzip.decompress(dest.read_bytes()) == content
+        with BlockGzipFile(dest, blocks_path(tmp_path / 'idx', dest.stat())) as f:
+            assert f.size == len(content)
+            f.seek(12345)
+            assert f.read(3000) == content[12345:15345]
+        # 没有块表时整体解压
+        with BlockGzipFile(dest) as f:
+            f.seek(len(content) - 10)
+            assert f.read() == content[-10:]
+
+    def test_handler_compresses_backups_in_background(self, tmp_path):
+        handler = CompressingRotatingFileHandler(tmp_path / 'app.log', maxBytes=4000, backupCount=3,
+                                                 encoding='utf8', compress=True)
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] [%(name)s:%(lineno)d] %(message)s'))
+        log = logging.getLogger('test_log_rotation')
+        log.propagate = False
+        log.addHandler(handler)
+        try:
+            for n in range(300):
+                log.warning("第%d条", n)
+            handler.wait()
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+        names = sorted(p.name for p in tmp_path.iterdir() if p.name.startswith('app.log'))
+        assert names == ['app.log', 'app.log.1.gz', 'app.log.2.gz', 'app.log.3.gz']
+
+        reader = LogReader(tmp_path)
+        page = reader.read('app', lines=1000, start=0)
+        numbers = [int(line.rsplit('第', 1)[1][:-1]) for line in page['content'].splitlines()]
+        assert numbers == list(range(300 - len(numbers), 300))
+        assert [f['name'] for f in page['files']][-2:] == ['app.log.1.gz', 'app.log']
+
+    def test_two_handlers_share_rotation(self, tmp_path):
+        """两个处理器（相当于两个worker）写同一个文件：每次只轮转一次，备份都被压缩，没有丢失或重复的记录"""
+        formatter = logging.Formatter('%(message)s')
+        loggers = []
+        for name in ('first', 'second'):
+            handler = CompressingRotatingFileHandler(tmp_path / 'app.log', maxBytes=2000, backupCount=50,
+                                                     encoding='utf8', compress=True)
+            handler.setFormatter(formatter)
+            log = logging.getLogger(f'test_log_rotation.{name}')
+            log.propagate = False
+            log.addHandler(handler)
+            loggers.append((log, handler))
+        try:
+            for n in range(600):
+                loggers[n % 2][0].warning("第%d条", n)
+        finally:
+            for log, handler in loggers:
+                handler.wait()
+                log.removeHandler(handler)
+                handler.close()
+
+        names = [p.name for p in tmp_path.iterdir() if p.name.startswith('app.log')]
+        backups = [name for name in names if name != 'app.log']
+        assert backups and all(name.endswith('.gz') for name in backups)
+        records = (tmp_path / 'app.log').read_text(encoding='utf-8').splitlines()
+        for name in backups:
+            records.extend(gzip.decompress((tmp_path / name).read_bytes()).decode('utf-8').splitlines())
+        assert sorted(int(record[1:-1]) for record in records) == list(range(600))
+
+    def test_compress_checks_inode(self, tmp_path):
+        """文件已经被换成其他文件时不压缩也不删除"""
+        source = tmp_path / 'app.log.1'
+        source.write_text('新文件\n', encoding='utf-8')
+        compress_log(source, tmp_path / 'app.log.1.gz', tmp_path / 'idx', inode=source.stat().st_ino + 1)
+        assert source.exists()
+        assert not (tmp_path / 'app.log.1.gz').exists()
+
+    def test_downloads(self, tmp_path, monkeypatch):
+        content = _lines(0, 200)
+        (tmp_path / 'chat.log').write_text(content, encoding='utf-8')
+        (tmp_path / 'chat.log.1').write_text(_lines(-50, 50), encoding='utf-8')
+        compress_log(tmp_path / 'chat.log.1', tmp_path / 'chat.log.1.gz', tmp_path / '.index', block_size=512)
+        monkeypatch.setattr(app_module, 'log_reader', LogReader(tmp_path))
+        client = app_module.app.test_client()
+
+        response = client.get('/api/logs/chat/download', headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.data == content.encode('utf-8')[10:20]
+
+        response = client.get('/api/logs/chat/download?compress=gzip')
+        assert response.mimetype == 'application/gzip'
+        assert gzip.decompress(response.data).decode('utf-8') == content
+
+        response = client.get('/api/logs/chat/download?bundle=true')
+        with tarfile.open(fileobj=io.BytesIO(response.data), mode='r:gz') as tar:
+            assert tar.getnames() == ['chat.log.1', 'chat.log']
+            assert tar.extractfile('chat.log.1').read().decode('utf-8') == _lines(-50, 50)
+            assert tar.extractfile('chat.log').read().decode('utf-8') == content
+
+        assert client.get('/api/logs/chat/download?compress=zip').status_code == 400
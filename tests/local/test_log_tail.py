@@ -0,0 +1,136 @@
+import json
+import os
+
+import pytest
+
+from src import app as app_module
+from src.log_reader import LogReader
+from src.log_tail import LogFollower, TailSlots, tail_events
+
+
+def _events(frames):
+    events = []
+    for frame in frames:
+        for block in frame.decode('utf-8').split('\n\n'):
+            data = [line[6:] for line in block.split('\n') if line.startswith('data: ')]
+            if data:
+                event_id = [line[4:] for line in block.split('\n') if line.startswith('id: ')]
+                events.append((event_id[0] if event_id else None, json.loads(data[0])))
+    return events
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.mark.local
+class TestLogTail:
+    """日志实时跟踪的测试"""
+
+    def test_follower_reads_complete_lines(self, tmp_path):
+        path = tmp_path / 'app.log'
+        path.write_text('旧内容\n')
+        follower = LogFollower(path)
+        assert follower.poll() == []
+        with open(path, 'a') as f:
+            f.write('第一行\n第二')
+        assert follower.poll() == ['第一行\n']
+        with open(path, 'a') as f:
+            f.write('行\n')
+        assert follower.poll() == ['第二行\n']
+        # 截断后从头读取
+        path.write_text('新\n')
+        assert follower.poll() == ['新\n']
+
+    def test_follower_handles_rotation_and_resume(self, tmp_path):
+        path = tmp_path / 'app.log'
+        path.write_text('')
+        follower = LogFollower(path)
+        with open(path, 'a') as f:
+            f.write('a\n')
+        assert follower.poll() == ['a\n']
+        position = follower.position
+        with open(path, 'a') as f:
+            f.write('b\n')
+        os.replace(path, tmp_path / 'app.log.1')
+        path.write_text('c\n')
+        assert follower.poll() == ['b\n']
+        assert follower.rotations == 1
+        assert follower.poll() == ['c\n']
+
+        # 断开前的文件已经成为备份，从中继续读取
+        inode, offset = (int(part) for part in position.split(':'))
+        resumed = LogFollower(path, inode, offset, backups=[tmp_path / 'app.log.1'])
+        assert resumed.poll() == ['b\n']
+        assert resumed.poll() == ['c\n']
+
+    def test_events_are_batched(self, tmp_path):
+        path = tmp_path / 'app.log'
+        path.write_text('')
+        follower = LogFollower(path)
+        clock = FakeClock()
+
+        def sleep(seconds):
+            clock.sleep(seconds)
+            with open(path, 'a') as f:
+                f.write(f"{clock.now}\n{clock.now}\n")
+
+        frames = list(tail_events(follower, ['历史\n'], flush_interval=1, heartbeat=2.5, max_duration=3,
+                                  sleep=sleep, clock=clock))
+        events = _events(frames)
+        assert [e['type'] for _, e in events] == ['lines', 'lines', 'lines', 'lines', 'reconnect']
+        assert events[0][1]['lines'] == ['历史\n']
+        assert events[1][1]['lines'] == ['1.0\n', '1.0\n']
+        assert events[-1][0] == follower.position
+        assert frames[0].startswith(b'retry: ')
+
+    def test_event_ids_match_their_lines(self, tmp_path):
+        """一次写入超过 read_size 时分多个事件发送，每个事件的 id 都是其最后一行之后的位置"""
+        path = tmp_path / 'app.log'
+        path.write_text('')
+        follower = LogFollower(path, read_size=16)
+        with open(path, 'a') as f:
+            f.write(''.join(f"第{number}行\n" for number in range(10)))
+        clock = FakeClock()
+        events = _events(tail_events(follower, flush_interval=1, heartbeat=100, max_duration=8,
+                                     sleep=clock.sleep, clock=clock))
+        content = path.read_bytes()
+        batches = [(event_id, data['lines']) for event_id, data in events if data['type'] == 'lines']
+        assert len(batches) > 1
+        for event_id, lines in batches:
+            offset = int(event_id.split(':')[1])
+            assert content[:offset].decode('utf-8').endswith(''.join(lines))
+
+    def test_subscriber_slots(self, tmp_path):
+        slots = TailSlots(tmp_path, count=2)
+        first, second = slots.acquire(), slots.acquire()
+        assert first and second and slots.acquire() is None
+        assert slots.in_use() == 2
+        first.close()
+        assert slots.acquire() is not None
+
+    def test_stream_route(self, tmp_path, monkeypatch):
+        (tmp_path / 'api.log').write_text('一\n二\n三\n')
+        monkeypatch.setattr(app_module, 'log_reader', LogReader(tmp_path, index_dir=tmp_path / 'idx'))
+        monkeypatch.setattr(app_module, 'log_tail_slots', TailSlots(tmp_path / 'slots', count=1))
+        monkeypatch.setitem(app_module.LOG_TAIL_CONFIG, 'max_duration', 0)
+        client = app_module.app.test_client()
+
+        response = client.get('/api/logs/api/stream?backlog=2')
+        assert response.mimetype == 'text/event-stream'
+        busy = client.get('/api/logs/api/stream')
+        assert busy.status_code == 429 and busy.headers['Retry-After'] == '5'
+        events = _events([response.get_data()])
+        assert events[0][1] == {"type": "lines", "lines": ['二\n', '三\n']}
+        response.close()
+        # 连接关闭后名额被释放
+        assert client.get('/api/logs/api/stream', headers={'Last-Event-ID': events[-1][0]}).status_code == 200
+        assert client.get('/api/logs/app/stream').status_code == 404
+        assert client.get('/api/logs/api/stream?position=x').status_code == 400
@@ -0,0 +1,115 @@
+import re
+
+import pytest
+
+from src import app as app_module
+from src.metrics import MetricsRegistry, MmapValues, UpstreamTimer, read_values, registry
+
+
+def _samples(text):
+    """把 Prometheus 文本解析为 {样本名{标签}: 值}"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+class _FakeChatClient:
+    def chat_completion(self, payload):
+        return iter([{"choices": [{"delta": {"content": part}}]} for part in ("你好", "，", "世界")])
+
+
+@pytest.mark.local
+class TestMetrics:
+    """多进程指标和 /metrics 接口的测试"""
+
+    def test_mmap_values_persist_and_grow(self, tmp_path):
+        path = tmp_path / 'counter_1.db'
+        values = MmapValues(path, initial_size=64)
+        for number in range(20):
+            values.add(f'["key", ["{number}"]]', number)
+        values.add('["key", ["3"]]', 0.5)
+        values.close()
+        stored = dict(read_values(path))
+        assert len(stored) == 20
+        assert stored['["key", ["3"]]'] == 3.5
+        # 重新打开时继续累加
+        values = MmapValues(path)
+        values.add('["key", ["3"]]', 1)
+        assert dict(read_values(path))['["key", ["3"]]'] == 4.5
+
+    def test_aggregates_worker_files(self, tmp_path):
+        """计数器汇总所有文件；已退出进程的仪表不计入，文件被删除"""
+        metrics = MetricsRegistry(tmp_path, enabled=True)
+        requests = metrics.counter('test_requests_total', '请求数', ('route',))
+        active = metrics.gauge('test_active', '活动数')
+        requests.inc(route='/a')
+        active.inc(2)
+
+        dead_pid = 99999999
+        other = MmapValues(tmp_path / f'counter_{dead_pid}.db')
+        other.add('["test_requests_total", ["/a"]]', 4)
+        other.close()
+        dead_gauge = MmapValues(tmp_path / f'gauge_{dead_pid}.db')
+        dead_gauge.add('["test_active", []]', 10)
+        dead_gauge.close()
+
+        samples = _samples(metrics.render())
+        assert samples['test_requests_total{route="/a"}'] == 5
+        assert samples['test_active'] == 2
+        assert not (tmp_path / f'gauge_{dead_pid}.db').exists()
+
+    def test_histogram_buckets_are_cumulative(self, tmp_path):
+        metrics = MetricsRegistry(tmp_path, enabled=True)
+        duration = metrics.histogram('test_seconds', '耗时', ('op',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            duration.observe(value, op='x')
+        text = metrics.render()
+        assert '# TYPE test_seconds histogram' in text
+        samples = _samples(text)
+        assert samples['test_seconds_bucket{op="x",le="0.1"}'] == 1
+        assert samples['test_seconds_bucket{op="x",le="1"}'] == 3
+        assert samples['test_seconds_bucket{op="x",le="+Inf"}'] == 4
+        assert samples['test_seconds_count{op="x"}'] == 4
+        assert samples['test_seconds_sum{op="x"}'] == pytest.approx(4.25)
+
+    def test_upstream_timer_outcome(self):
+        before = _samples(registry.render())
+        with UpstreamTimer('get_models') as timer:
+            timer.status = 429
+        with pytest.raises(RuntimeError):
+            with UpstreamTimer('get_models'):
+                raise RuntimeError("连接失败")
+        after = _samples(registry.render())
+        for outcome in ('throttled', 'error'):
+            key = f'aiapp_upstream_request_duration_seconds_count{{operation="get_models",outcome="{outcome}"}}'
+            assert after[key] - before.get(key, 0) == 1
+
+    def test_metrics_endpoint_after_chat(self, monkeypatch):
+        """聊天流结束后 /metrics 中有路由耗时、首个增量时间和结束方式"""
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', _FakeChatClient)
+        client = app_module.app.test_client()
+        before = _samples(client.get('/metrics').get_data(as_text=True))
+
+        response = client.post('/api/chat', json={"session_id": "metrics-test", "user_input": "hi"})
+        assert '世界' in response.get_data(as_text=True)
+        response.close()
+
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        after = _samples(response.get_data(as_text=True))
+
+        def delta(key):
+            return after.get(key, 0) - before.get(key, 0)
+
+        assert delta('aiapp_http_request_duration_seconds_count{route="/api/chat",method="POST",status="200"}') == 1
+        assert delta('aiapp_chat_streams_total{outcome="completed"}') == 1
+        assert delta('aiapp_chat_time_to_first_token_seconds_count') == 1
+        assert delta('aiapp_chat_chunks_per_reply_sum') == 3
+        assert after['aiapp_chat_active_streams'] == 0
+        # 下载缓存的命中数和派生的命中率由抓取时的收集函数补充
+        assert 'aiapp_cache_requests_total{cache="download",result="hit"}' in after
+        assert re.search(r'^aiapp_cache_hit_ratio\{cache="download"\} ', response.get_data(as_text=True), re.M)
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from src import app as app_module
+from src.micro_batch import MicroBatcher, split_images
+from src.stats import Histogram
+
+PAYLOAD = {"model": "m", "prompt": "猫", "width": 512, "height": 512, "num_inference_steps": 4,
+           "guidance_scale": 4.0, "variation_strength": 0.7, "variation_seed": 1, "batch_size": 1}
+
+
+def _run_concurrently(batcher, payloads, generate):
+    results = [None] * len(payloads)
+
+    def submit(index, payload):
+        results[index] = batcher.submit(payload, generate)
+
+    threads = [threading.Thread(target=submit, args=item) for item in enumerate(payloads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.mark.local
+class TestMicroBatch:
+    """图像请求微批处理的测试"""
+
+    def test_compatible_requests_share_one_call(self):
+        batcher = MicroBatcher(window_ms=200, max_batch_size=4, enabled=True)
+        calls = []
+
+        def generate(payload):
+            calls.append(payload['batch_size'])
+            return {"images": [f"u{i}" for i in range(payload['batch_size'])], "usage": {}}, 200
+
+        payloads = [PAYLOAD, {**PAYLOAD, "variation_seed": 2, "batch_size": 2}, {**PAYLOAD, "variation_seed": 3}]
+        results = _run_concurrently(batcher, payloads, generate)
+        assert calls == [4]
+        assert sorted(len(body['images']) for body, _ in results) == [1, 1, 2]
+        assert sorted(url for body, _ in results for url in body['images']) == ['u0', 'u1', 'u2', 'u3']
+        stats = batcher.stats()
+        assert (stats['requests'], stats['calls']) == (3, 1)
+        assert stats['batch_size']['buckets']['4'] == 1
+        assert stats['wait_ms']['count'] == 3
+
+    def test_incompatible_requests_are_not_merged(self):
+        batcher = MicroBatcher(window_ms=20, max_batch_size=4, enabled=True)
+        calls = []
+
+        def generate(payload):
+            calls.append(payload['prompt'])
+            return {"images": ["u"]}, 200
+
+        _run_concurrently(batcher, [PAYLOAD, {**PAYLOAD, "prompt": "狗"}, {**PAYLOAD, "batch_size": 4}], generate)
+        assert sorted(calls) == ['狗', '猫', '猫']
+
+    def test_errors_reach_every_waiter(self):
+        batcher = MicroBatcher(window_ms=100, max_batch_size=2, enabled=True)
+        results = _run_concurrently(batcher, [PAYLOAD, PAYLOAD], lambda payload: ({"error": "上游错误"}, 500))
+        assert results == [({"error": "上游错误"}, 500)] * 2
+
+    def test_split_and_histogram(self):
+        assert split_images({"images": ["a", "b"], "usage": {}}, [1, 1, 1]) == [
+            ({"images": ["a"], "usage": {}}, 200),
+            ({"images": ["b"], "usage": {}}, 200),
+            ({"error": "生成图像失败，未返回图像URL"}, 500),
+        ]
+        histogram = Histogram([1, 10])
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        assert histogram.snapshot() == {'buckets': {'1': 2, '10': 1, '+Inf': 1}, 'count': 4, 'sum': 56.5}
+
+    def test_only_batch_callers_use_batcher(self, monkeypatch):
+        """/api/generate 不经过微批处理，批量接口中参数相同的条目合并调用"""
+        class FakeClient:
+            def generate_image(self, payload):
+                return {"images": [{"url": "https://cdn.siliconflow.com/a.png"}] * payload['batch_size']}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        monkeypatch.setattr(app_module, 'micro_batcher', MicroBatcher(window_ms=1, enabled=True))
+        client = app_module.app.test_client()
+        response = client.post('/api/generate', json={"prompt": "猫", "width": 512, "height": 512, "num_images": 2})
+        assert len(response.get_json()['images']) == 2
+        assert client.get('/api/generate/batching').get_json()['calls'] == 0
+
+        response = client.post('/api/generate/batch', json={"width": 512, "height": 512, "num_images": 1,
+                                                            "items": [{"prompt": "猫"}]})
+        assert response.get_data(as_text=True).count('"status": 200') == 1
+        assert client.get('/api/generate/batching').get_json()['calls'] == 1
@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from src import app as app_module
+from src.context_window import context_length_for
+from src.model_catalog import DEFAULT_MODELS, ModelCatalog, merge_models
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeClient:
+    """模拟上游 /models 接口"""
+
+    def __init__(self, models, error=None, gate=None):
+        self.models = models
+        self.error = error
+        self.gate = gate
+        self.calls = 0
+
+    def get_models(self, model_type=None, sub_type=None):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error:
+            raise RuntimeError(self.error)
+        return {"object": "list", "data": [{"id": m, "object": "model"} for m in self.models]}
+
+
+@pytest.mark.local
+class TestModelCatalog:
+    """模型目录的测试"""
+
+    def _catalog(self, client, clock, **kwargs):
+        return ModelCatalog(lambda: client, ttl=60, retry_interval=10, refresh=True, clock=clock, **kwargs)
+
+    def test_merge_keeps_known_metadata(self):
+        upstream = [{"id": "new/model", "context_length": 8192}, {"id": "deepseek-ai/DeepSeek-V3"}]
+        merged = merge_models(upstream, DEFAULT_MODELS["models"])
+        assert [m["id"] for m in merged] == ["deepseek-ai/DeepSeek-V3", "new/model"]
+        assert merged[0]["description"] == "综合"
+        assert merged[1] == {"id": "new/model", "name": "new/model", "description": "", "context_length": 8192}
+
+    def test_serves_stale_while_refreshing(self):
+        clock = FakeClock()
+        gate = threading.Event()
+        client = FakeClient(["deepseek-ai/DeepSeek-V3", "test/fresh"], gate=gate)
+        catalog = self._catalog(client, clock)
+
+        first = catalog.get()
+        assert first.source == 'default'
+        assert catalog.get() is first
+        gate.set()
+        catalog.wait_refresh(5)
+        assert client.calls == 1
+
+        fresh = catalog.get()
+        assert fresh.source == 'upstream'
+        assert fresh.etag != first.etag
+        assert catalog.model_info("test/fresh")["name"] == "test/fresh"
+
+        clock.now += 30
+        assert catalog.get() is fresh
+        assert client.calls == 1
+
+        clock.now += 31
+        client.models = ["test/other"]
+        gate.clear()
+        assert catalog.get() is fresh
+        gate.set()
+        catalog.wait_refresh(5)
+        assert catalog.model_info("test/other") is not None
+        assert client.calls == 2
+
+    def test_falls_back_when_upstream_down(self):
+        clock = FakeClock()
+        client = FakeClient([], error="upstream down")
+        catalog = self._catalog(client, clock)
+        assert catalog.refresh() is False
+        assert catalog.get().source == 'default'
+        assert catalog.get().body == {"models": DEFAULT_MODELS["models"]}
+        assert catalog.stats()['failures'] == 1
+
+        client.error = None
+        client.models = ["test/a"]
+        clock.now += 10
+        catalog.get()
+        catalog.wait_refresh(5)
+        good = catalog.snapshot
+        assert good.source == 'upstream'
+
+        client.error = "upstream down"
+        assert catalog.refresh() is False
+        assert catalog.snapshot is good
+
+    def test_updates_context_limits(self):
+        client = FakeClient([])
+        client.get_models = lambda **kwargs: {"data": [{"id": "test/ctx", "context_length": 4096}]}
+        catalog = self._catalog(client, FakeClock())
+        assert catalog.refresh() is True
+        assert context_length_for("test/ctx") == 4096
+
+    def test_models_route_etag(self, monkeypatch):
+        catalog = ModelCatalog(lambda: FakeClient([]), refresh=False)
+        monkeypatch.setattr(app_module, 'model_catalog', catalog)
+        client = app_module.app.test_client()
+        response = client.get('/api/models')
+        assert response.status_code == 200
+        assert response.get_json() == DEFAULT_MODELS
+        etag = response.headers['ETag']
+        assert etag == f'"{catalog.snapshot.etag}"'
+
+        cached = client.get('/api/models', headers={'If-None-Match': etag})
+        assert cached.status_code == 304
+        assert cached.data == b""
@@ -0,0 +1,92 @@
+import multiprocessing
+
+import pytest
+
+from src import app as app_module
+from src.middleware.rate_limit import Limit, RateLimiter, build_checks, client_ip, parse_limits
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _hit_many(path, count, results):
+    limiter = RateLimiter(path)
+    allowed = sum(limiter.hit([('k', Limit(20, 60))]).allowed for _ in range(count))
+    results.put(allowed)
+
+
+@pytest.mark.local
+class TestRateLimit:
+    """多进程共享的 GCRA 速率限制器的测试"""
+
+    def test_parse_limits(self):
+        assert parse_limits("5 per minute; 100/hour") == [Limit(5, 60), Limit(100, 3600)]
+        assert parse_limits("10 per 2 seconds") == [Limit(10, 2)]
+        assert parse_limits("") == []
+        with pytest.raises(ValueError):
+            parse_limits("five per minute")
+
+    def test_gcra_burst_and_refill(self, tmp_path):
+        clock = FakeClock()
+        limiter = RateLimiter(tmp_path / 'rl.db', clock=clock)
+        limit = Limit(3, 60)
+        decisions = [limiter.hit([('k', limit)]) for _ in range(4)]
+        assert [d.allowed for d in decisions] == [True, True, True, False]
+        assert [d.remaining for d in decisions[:3]] == [2, 1, 0]
+        assert decisions[3].retry_after == pytest.approx(20)
+        assert decisions[3].headers()['Retry-After'] == '20'
+        # 每20秒恢复一个请求
+        clock.now += 20
+        assert limiter.hit([('k', limit)]).allowed
+        assert not limiter.hit([('k', limit)]).allowed
+        assert limiter.stats()['rejected'] == 2
+
+    def test_rejection_does_not_consume_other_keys(self, tmp_path):
+        limiter = RateLimiter(tmp_path / 'rl.db', clock=FakeClock())
+        limit = Limit(2, 60)
+        checks = build_checks('/api/chat', [limit], '1.2.3.4', 'session-a')
+        assert limiter.hit(checks).allowed and limiter.hit(checks).allowed
+        assert not limiter.hit(build_checks('/api/chat', [limit], '5.6.7.8', 'session-a')).allowed
+        # 被拒绝的请求没有计入新IP的额度
+        assert limiter.hit(build_checks('/api/chat', [limit], '5.6.7.8')).remaining == 1
+
+    def test_counters_shared_across_processes(self, tmp_path):
+        path = tmp_path / 'rl.db'
+        RateLimiter(path)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_hit_many, args=(path, 10, results)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        assert sum(results.get(timeout=5) for _ in workers) == 20
+
+    def test_client_ip_prefers_proxy_header(self):
+        assert client_ip({'X-Real-IP': '9.9.9.9'}, '127.0.0.1', trust_proxy=True) == '9.9.9.9'
+        assert client_ip({'X-Real-IP': '9.9.9.9'}, '127.0.0.1', trust_proxy=False) == '127.0.0.1'
+
+    def test_route_headers_and_429(self, monkeypatch):
+        class FakeClient:
+            def generate_image(self, payload):
+                return {"images": [{"url": "https://cdn.siliconflow.com/a.png"}]}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        client = app_module.app.test_client()
+        payload = {"prompt": "猫", "width": 512, "height": 512, "num_images": 1}
+        statuses = []
+        for _ in range(6):
+            response = client.post('/api/generate', json=payload, headers={'X-Real-IP': '10.0.0.1'})
+            statuses.append(response.status_code)
+        assert statuses == [200] * 5 + [429]
+        assert response.headers['X-RateLimit-Limit'] == '5'
+        assert response.headers['X-RateLimit-Remaining'] == '0'
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.get_json()['retry_after'] >= 1
+        # 其他IP不受影响，未配置限制的路由没有限流响应头
+        assert client.post('/api/generate', json=payload, headers={'X-Real-IP': '10.0.0.2'}).status_code == 200
+        assert 'X-RateLimit-Limit' not in client.get('/api/rate_limits').headers
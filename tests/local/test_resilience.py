@@ -0,0 +1,161 @@
+import pytest
+import requests
+
+from src import api_client
+from src import app as app_module
+from src.api_client import LoggingSiliconFlowClient
+from src.resilience import CircuitBreaker, CircuitOpenError, Resilience, RetryBudget, backoff_delay
+from src.upstream_governor import UpstreamGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, status_code, body='{"data": [{"url": "https://cdn.siliconflow.com/a.png"}]}'):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = body
+        self.closed = False
+
+    def json(self):
+        import json
+        return json.loads(self.text)
+
+    def close(self):
+        self.closed = True
+
+
+def _sequence(*outcomes):
+    outcomes = list(outcomes)
+    calls = []
+
+    def send():
+        calls.append(1)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send, calls
+
+
+def _resilience(**kwargs):
+    sleeps = []
+    options = {'failure_threshold': 3, 'reset_timeout': 10}
+    options.update(kwargs.pop('breaker_options', {}))
+    return Resilience(sleep=sleeps.append, breaker_options=options, **kwargs), sleeps
+
+
+RETRYABLE = (requests.exceptions.ConnectionError,)
+FAILURES = (requests.exceptions.RequestException,)
+
+
+@pytest.mark.local
+class TestResilience:
+    """上游调用重试和熔断的测试"""
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [backoff_delay(attempt, base=0.1, cap=0.5) for attempt in range(10) for _ in range(20)]
+        assert all(0 <= delay <= 0.5 for delay in delays)
+        assert len(set(delays)) > 1
+
+    def test_retry_budget(self):
+        clock = FakeClock()
+        budget = RetryBudget(ratio=0.5, min_per_second=1, capacity=2, clock=clock)
+        assert budget.withdraw() and budget.withdraw()
+        assert not budget.withdraw()
+        budget.deposit()
+        budget.deposit()
+        assert budget.withdraw()
+        clock.now += 1
+        assert budget.withdraw()
+        assert budget.exhausted == 1
+
+    def test_breaker_opens_and_probes(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('images', failure_threshold=2, reset_timeout=10, probes=1, clock=clock)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with pytest.raises(CircuitOpenError) as info:
+            breaker.before_call()
+        assert info.value.retry_after == 10
+        clock.now += 10
+        breaker.before_call()
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_failure()
+        assert breaker.state == 'open'
+        clock.now += 10
+        breaker.before_call()
+        breaker.record_success()
+        assert breaker.stats() == {'state': 'closed', 'failures': 0, 'trips': 2, 'rejected': 2}
+
+    def test_connect_errors_and_5xx_are_retried(self):
+        resilience, sleeps = _resilience(max_retries=2)
+        send, calls = _sequence(requests.exceptions.ConnectionError(), FakeResponse(502), FakeResponse(200))
+        discarded = []
+        assert resilience.call('images', send, RETRYABLE, FAILURES, discard=discarded.append).status_code == 200
+        assert len(calls) == 3 and len(sleeps) == 2
+        assert [r.status_code for r in discarded] == [502]
+        assert resilience.stats()['breakers']['images']['failures'] == 0
+
+    def test_read_timeouts_and_client_errors_are_not_retried(self):
+        resilience, _ = _resilience(max_retries=2)
+        send, calls = _sequence(requests.exceptions.ReadTimeout())
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            resilience.call('images', send, RETRYABLE, FAILURES)
+        send, calls = _sequence(FakeResponse(400))
+        assert resilience.call('images', send, RETRYABLE, FAILURES).status_code == 400
+        assert len(calls) == 1
+
+    def test_budget_limits_retries_and_breaker_fails_fast(self):
+        resilience, sleeps = _resilience(max_retries=5, budget=RetryBudget(ratio=0, min_per_second=0, capacity=1))
+        send, calls = _sequence(*[FakeResponse(503)] * 3)
+        assert resilience.call('chat', send, RETRYABLE, FAILURES).status_code == 503
+        assert len(calls) == 2 and resilience.stats()['budget_exhausted'] == 1
+        resilience.call('chat', send, RETRYABLE, FAILURES)
+        with pytest.raises(CircuitOpenError):
+            resilience.call('chat', send, RETRYABLE, FAILURES)
+        assert resilience.stats()['breakers']['chat']['state'] == 'open'
+
+    def test_client_retries_and_reports_open_circuit(self, monkeypatch):
+        resilience, _ = _resilience(max_retries=1, breaker_options={'failure_threshold': 2})
+        outcomes = [requests.exceptions.ConnectionError(), FakeResponse(200)]
+
+        class FakeSession:
+            def post(self, *args, **kwargs):
+                outcome = outcomes.pop(0)
+                if isinstance(outcome, Exception):
+                    raise outcome
+                return outcome
+
+        monkeypatch.setattr(api_client, 'resilience', resilience)
+        monkeypatch.setattr(api_client, 'governor', UpstreamGovernor(enabled=False))
+        monkeypatch.setattr(api_client, 'get_session', lambda: FakeSession())
+        client = LoggingSiliconFlowClient()
+        client.headers = {**client.headers, "Authorization": "Bearer test-key"}
+
+        assert client.generate_image({"prompt": "猫"})['images'] == [{"url": "https://cdn.siliconflow.com/a.png"}]
+        outcomes.extend([requests.exceptions.ConnectionError()] * 2)
+        assert 'images' in client.generate_image({"prompt": "猫"})
+        result = client.generate_image({"prompt": "猫"})
+        assert result['status'] == 503 and result['retry_after'] > 0
+
+    def test_generate_route_returns_503_when_open(self, monkeypatch):
+        class FakeClient:
+            def generate_image(self, payload):
+                return {"error": "上游服务暂时不可用", "images": [], "retry_after": 9.2, "status": 503}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        client = app_module.app.test_client()
+        response = client.post('/api/generate', json={"prompt": "猫", "width": 512, "height": 512, "num_images": 1})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '10'
+        assert 'breakers' in client.get('/api/upstream/resilience').get_json()
@@ -0,0 +1,108 @@
+import multiprocessing
+import time
+
+import pytest
+
+from src.session_store import MemorySessionStore, SQLiteSessionStore
+
+
+def _request_stop(path, session_id, result):
+    """在另一个进程中发出停止请求"""
+    result.value = SQLiteSessionStore(path).request_stop(session_id)
+
+
+@pytest.mark.local
+class TestSessionStore:
+    """会话存储测试"""
+
+    @pytest.fixture(params=['memory', 'sqlite'])
+    def store(self, request, tmp_path):
+        if request.param == 'memory':
+            return MemorySessionStore()
+        return SQLiteSessionStore(tmp_path / 'sessions.db', poll_interval=0.01)
+
+    def test_append_and_trim(self, store):
+        """追加消息后只保留最新的 max_length 条"""
+        for i in range(5):
+            length = store.append_messages('s1', [
+                {"role": "user", "content": f"q{i}"},
+                {"role": "assistant", "content": f"a{i}"},
+            ], max_length=4)
+        assert length == 4
+        assert [m["content"] for m in store.get_history('s1')] == ["q3", "a3", "q4", "a4"]
+        assert store.get_history('missing') == []
+
+    def test_clear(self, store):
+        store.append_messages('s1', [{"role": "user", "content": "hi"}], max_length=10)
+        assert store.clear('s1') is True
+        assert store.get_history('s1') == []
+        assert store.clear('s1') is False
+
+    def test_touch_evicts_least_recently_active(self, store):
+        """超过会话数上限时淘汰最久未活动的会话"""
+        store.max_sessions = 3
+        for sid in ('a', 'b', 'c'):
+            store.append_messages(sid, [{"role": "user", "content": sid}], max_length=10)
+        store.touch('a')
+        store.touch('d')
+        assert store.get_history('b') == []
+        assert store.get_history('a') != []
+        stats = store.stats()
+        assert stats['sessions'] == 3
+        assert stats['evicted_lru'] == 1
+
+    def test_byte_budget(self, store):
+        """历史总字节数超过预算时从最旧的会话开始淘汰"""
+        store.max_bytes = 250
+        for sid in ('a', 'b', 'c'):
+            store.append_messages(sid, [{"role": "user", "content": "x" * 96}], max_length=10)
+        assert store.get_history('a') == []
+        assert store.get_history('c') != []
+        stats = store.stats()
+        assert stats['bytes'] == 200
+        assert stats['evicted_bytes'] == 1
+
+    def test_trim_updates_bytes(self, store):
+        for i in range(3):
+            store.append_messages('s1', [{"role": "user", "content": "x" * 10}], max_length=2)
+        assert store.stats()['bytes'] == 2 * (len("user") + 10)
+        store.clear('s1')
+        assert store.stats()['bytes'] == 0
+
+    def test_cleanup_expired(self, store):
+        store.touch('old')
+        time.sleep(0.05)
+        store.touch('new')
+        assert store.cleanup_expired(0.03) == 1
+        assert store.stats()['sessions'] == 1
+        assert store.stats()['expired'] == 1
+
+    def test_stop_signal(self, store):
+        """停止请求只作用于正在输出的流"""
+        assert store.request_stop('s1') is False
+        signal = store.begin_stream('s1')
+        assert not signal.is_set()
+        assert store.request_stop('s1') is True
+        assert signal.is_set()
+        store.end_stream('s1', signal)
+        assert store.request_stop('s1') is False
+
+
+@pytest.mark.local
+def test_sqlite_stop_across_processes(tmp_path):
+    """其他进程发出的停止请求能被流式循环观察到"""
+    path = tmp_path / 'sessions.db'
+    store = SQLiteSessionStore(path, poll_interval=0.01)
+    signal = store.begin_stream('shared')
+
+    ctx = multiprocessing.get_context('fork')
+    result = ctx.Value('b', 0)
+    process = ctx.Process(target=_request_stop, args=(str(path), 'shared', result))
+    process.start()
+    process.join(10)
+
+    assert result.value == 1
+    deadline = time.monotonic() + 1
+    while not signal.is_set() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert signal.is_set()
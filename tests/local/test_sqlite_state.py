@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from src.sqlite_state import SQLiteState
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS item_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO item_stats (name, value) VALUES ('count', 0);
+"""
+
+
+@pytest.mark.local
+class TestSQLiteState:
+    """共享 SQLite 状态文件的测试"""
+
+    def test_schema_version_change_rebuilds_tables(self, tmp_path):
+        path = tmp_path / 'state' / 'items.db'
+        state = SQLiteState(path, SCHEMA, 1)
+        state.conn().execute("INSERT INTO items (key, value) VALUES ('a', 1)")
+        assert state.conn().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+        # 版本相同时保留数据
+        assert SQLiteState(path, SCHEMA, 1).conn().execute('SELECT COUNT(*) FROM items').fetchone()[0] == 1
+        # 版本变化时删除表并重建
+        rebuilt = SQLiteState(path, SCHEMA, 2).conn()
+        assert rebuilt.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+        assert rebuilt.execute('SELECT value FROM item_stats').fetchall() == [(0,)]
+        assert rebuilt.execute('PRAGMA user_version').fetchone()[0] == 2
+
+    def test_connection_per_thread_and_process(self, tmp_path):
+        state = SQLiteState(tmp_path / 'items.db', SCHEMA, 1)
+        conn = state.conn()
+        assert state.conn() is conn
+        other = []
+        thread = threading.Thread(target=lambda: other.append(state.conn()))
+        thread.start()
+        thread.join()
+        assert other[0] is not conn
+        # fork 之后的子进程重新连接
+        state._local.pid = -1
+        assert state.conn() is not conn
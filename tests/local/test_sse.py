@@ -0,0 +1,200 @@
+import io
+import json
+import logging
+import time
+
+import pytest
+import requests
+from urllib3.response import HTTPResponse
+
+from src.api_client import iter_chat_chunks
+from src.sse import SSEParser, SSEWriter, parse_chat_event
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _events(data: bytes):
+    """把SSE字节流解析为事件列表"""
+    events = []
+    for block in data.decode('utf-8').split('\n\n'):
+        if not block:
+            continue
+        assert block.startswith('data: ')
+        payload = block[len('data: '):]
+        events.append(payload if payload == '[DONE]' else json.loads(payload))
+    return events
+
+
+@pytest.mark.local
+class TestSSEWriter:
+    """SSE合并输出的测试"""
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    def test_frame_matches_json_dumps(self):
+        """缓存的前后缀拼出的帧与逐个序列化的结果一致"""
+        writer = SSEWriter(flush_interval=0)
+        reply = '中文 "引号" \\ 换行\n'
+        expected = f"data: {json.dumps({'type': 'assistant', 'reply': reply}, ensure_ascii=False)}\n\n"
+        assert writer.assistant(reply) == expected.encode('utf-8')
+
+    def test_fragments_coalesce_within_window(self, clock):
+        writer = SSEWriter(flush_interval=0.05, flush_bytes=4096, clock=clock)
+        output = writer.assistant('你')
+        assert _events(output) == [{'type': 'assistant', 'reply': '你'}]
+
+        for fragment in ('好', '，', '世界'):
+            clock.now += 0.01
+            assert writer.assistant(fragment) == b''
+        clock.now += 0.03
+        output = writer.assistant('！')
+        assert _events(output) == [{'type': 'assistant', 'reply': '好，世界！'}]
+        assert writer.stats() == {'fragments': 5, 'frames': 2, 'bytes': writer.bytes}
+
+    def test_byte_threshold_flushes(self, clock):
+        writer = SSEWriter(flush_interval=10, flush_bytes=8, clock=clock)
+        writer.assistant('a')
+        assert writer.assistant('bbbb') == b''
+        assert _events(writer.assistant('cccc')) == [{'type': 'assistant', 'reply': 'bbbbcccc'}]
+
+    def test_event_and_done_preserve_order(self, clock):
+        writer = SSEWriter(flush_interval=10, clock=clock)
+        output = writer.event({'type': 'user', 'content': 'q'})
+        output += writer.assistant('a')
+        output += writer.assistant('b')
+        output += writer.event({'error': 'boom'})
+        output += writer.assistant('c')
+        output += writer.done()
+        assert _events(output) == [
+            {'type': 'user', 'content': 'q'},
+            {'type': 'assistant', 'reply': 'a'},
+            {'type': 'assistant', 'reply': 'b'},
+            {'error': 'boom'},
+            {'type': 'assistant', 'reply': 'c'},
+            '[DONE]',
+        ]
+        stats = writer.stats()
+        assert stats['frames'] == 6
+        assert stats['bytes'] == len(output)
+
+    def test_empty_fragments_ignored(self):
+        writer = SSEWriter(flush_interval=0)
+        assert writer.assistant('') == b''
+        assert writer.flush() == b''
+        assert writer.stats()['fragments'] == 0
+
+
+def _chunk(content, finish_reason=None):
+    """与上游格式一致的流式数据块"""
+    return {
+        "id": "0194f3c2a8b7", "object": "chat.completion.chunk", "created": 1739000000,
+        "model": "deepseek-ai/DeepSeek-V3",
+        "choices": [{"index": 0, "delta": {"content": content, "reasoning_content": None, "role": "assistant"},
+                     "finish_reason": finish_reason}],
+        "system_fingerprint": "",
+        "usage": {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15},
+    }
+
+
+def _recorded_stream(count):
+    contents = [f"第{i}段 \"text\" \\ `code`\n" if i % 7 == 0 else f"token{i} " for i in range(count)]
+    events = [_chunk(c) for c in contents] + [_chunk("", "stop")]
+    body = "".join(f"data: {json.dumps(e, separators=(',', ':'), ensure_ascii=False)}\n\n" for e in events)
+    return (body + "data: [DONE]\n\n").encode('utf-8'), contents
+
+
+def _response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+    return response
+
+
+@pytest.mark.local
+class TestSSEParser:
+    """上游SSE解析的测试"""
+
+    def test_events_split_at_every_boundary(self):
+        body, contents = _recorded_stream(20)
+        for size in (1, 3, 17, 64):
+            parser = SSEParser()
+            payloads = []
+            for i in range(0, len(body), size):
+                payloads.extend(parser.feed(body[i:i + size]))
+            payloads.extend(parser.close())
+            assert len(payloads) == len(contents) + 2
+            assert payloads[-1] == b"[DONE]"
+            assert [json.loads(p)["choices"][0]["delta"]["content"] for p in payloads[:len(contents)]] == contents
+
+    def test_line_endings_comments_and_multiline(self):
+        parser = SSEParser()
+        events = parser.feed(b": keep-alive\r\n\r\ndata:a\r\ndata: b\r\n\r\nevent: x\ndata: c")
+        assert events == [b"a\nb"]
+        assert parser.close() == [b"c"]
+        assert parser.close() == []
+
+    def test_fast_path_matches_json(self):
+        for content in ("你好", 'say "hi"\\n\n', "\u2028emoji 😀", ""):
+            payload = json.dumps(_chunk(content), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+            assert parse_chat_event(payload) == {'choices': [{'delta': {'content': content}}]}
+
+    def test_full_parse_fallback(self):
+        finished = _chunk("", "stop")
+        assert parse_chat_event(json.dumps(finished).encode('utf-8')) == finished
+        reasoning = json.dumps({"choices": [{"delta": {"content": None, "reasoning_content": "想"}}]}).encode('utf-8')
+        assert parse_chat_event(reasoning)["choices"][0]["delta"]["reasoning_content"] == "想"
+        assert parse_chat_event(b"[DONE]") is None
+        with pytest.raises(ValueError):
+            parse_chat_event(b"{broken")
+
+    def test_iter_chat_chunks_stops_at_done(self):
+        body, contents = _recorded_stream(5)
+        chunks = list(iter_chat_chunks([body + b"data: {\"late\": 1}\n\n"]))
+        assert [c["choices"][0]["delta"]["content"] for c in chunks] == contents + [""]
+        assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+    def test_benchmark_recorded_stream(self):
+        """关闭DEBUG日志时，对比逐行 json.loads + 调试序列化的旧路径与新解析器的吞吐"""
+        body, contents = _recorded_stream(5000)
+        logger = logging.getLogger('src.api_client')
+        level = logger.level
+        logger.setLevel(logging.INFO)
+
+        def legacy(response):
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                line = line.decode('utf-8')
+                if line.startswith('data: '):
+                    line = line[6:]
+                    if line == '[DONE]':
+                        break
+                    data = json.loads(line)
+                    logger.debug(f"收到数据: {json.dumps(data, ensure_ascii=False)}")
+                    yield data
+
+        def measure(parse):
+            best = None
+            for _ in range(3):
+                started = time.perf_counter()
+                chunks = list(parse(_response(body)))
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            assert [c["choices"][0]["delta"]["content"] for c in chunks[:len(contents)]] == contents
+            return len(chunks) / best
+
+        try:
+            before = measure(legacy)
+            after = measure(lambda response: iter_chat_chunks(response.iter_content(chunk_size=16384)))
+        finally:
+            logger.setLevel(level)
+        print(f"\n上游SSE解析: 旧路径 {before:,.0f} 块/秒, 新解析器 {after:,.0f} 块/秒 ({after / before:.1f}x)")
+        assert after > before
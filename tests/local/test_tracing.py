@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from src import app as app_module
+from src.tracing import NullTrace, Trace, Tracer, TraceWriter, mark_first, request_id_from
+
+
+def _load(path):
+    """追踪文件省略了结尾的 "]"，补上后按 JSON 解析"""
+    return json.loads(path.read_text(encoding='utf-8').rstrip().rstrip(',') + ']')
+
+
+class _FakeChatClient:
+    def chat_completion(self, payload):
+        return iter([{"choices": [{"delta": {"content": part}}]} for part in ("```py", "thon\nx\n", "```")])
+
+
+@pytest.mark.local
+class TestTracing:
+    """请求追踪的测试"""
+
+    def test_request_id(self):
+        assert request_id_from('abc-123') == 'abc-123'
+        generated = request_id_from('带空格 的ID')
+        assert len(generated) == 16 and generated != request_id_from(None)
+
+    def test_sampling(self, tmp_path):
+        tracer = Tracer(tmp_path / 'trace.json', sample_rate=0)
+        assert isinstance(tracer.begin('GET /'), NullTrace)
+        assert isinstance(tracer.begin('GET /', force=True), Trace)
+        assert isinstance(Tracer(tmp_path / 'trace.json', sample_rate=1).begin('GET /'), Trace)
+
+    def test_writer_rotates_valid_files(self, tmp_path):
+        path = tmp_path / 'trace.json'
+        writer = TraceWriter(path, max_bytes=300, backup_count=2)
+        for number in range(6):
+            trace = Trace(f'req-{number}', 'GET /')
+            trace.add('handler', 0.0, 0.001)
+            writer.write(trace.events)
+        assert (tmp_path / 'trace.json.1').exists()
+        assert not (tmp_path / 'trace.json.3').exists()
+        for candidate in (path, tmp_path / 'trace.json.1'):
+            events = _load(candidate)
+            assert events[0]['ph'] == 'M'
+            assert any(event['name'] == 'handler' and event['ph'] == 'X' for event in events)
+
+    def test_mark_first(self):
+        trace = Trace('req', 'GET /')
+        assert list(mark_first(trace, 'first_upstream_byte', iter([b'a', b'b']), 0.0)) == [b'a', b'b']
+        assert [event['name'] for event in trace.events if event['ph'] == 'X'] == ['first_upstream_byte']
+        blocks = iter([b'a'])
+        assert mark_first(NullTrace('req'), 'first_upstream_byte', blocks, 0.0) is blocks
+
+    def test_event_limit(self):
+        trace = Trace('req', 'GET /', max_events=3)
+        for _ in range(5):
+            trace.instant('tick')
+        trace.close()
+        assert trace.events[-1]['name'] == 'events_dropped'
+        assert trace.events[-1]['args'] == {'count': 4}
+
+    def test_chat_trace(self, tmp_path, monkeypatch):
+        """强制采样的聊天请求写出各阶段的 span，响应带有请求ID"""
+        monkeypatch.setattr(app_module, 'tracer', Tracer(tmp_path / 'trace.json', sample_rate=0))
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', _FakeChatClient)
+        client = app_module.app.test_client()
+
+        response = client.post('/api/chat', json={"session_id": "trace-test", "user_input": "hi"},
+                               headers={'X-Request-ID': 'trace-req-1', 'X-Trace': '1'})
+        assert response.headers['X-Request-ID'] == 'trace-req-1'
+        response.get_data()
+        response.close()
+
+        events = _load(tmp_path / 'trace.json')
+        names = {event['name'] for event in events if event['ph'] == 'X'}
+        assert {'parse_request', 'build_messages', 'client_init', 'first_delta', 'fence',
+                'client_flush', 'handler', 'request'} <= names
+        request_span = next(event for event in events if event['name'] == 'request')
+        assert request_span['args']['status'] == 200
+        assert all(event['tid'] == request_span['tid'] for event in events if event['ph'] == 'X')
+
+    def test_unsampled_request_has_id(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(app_module, 'tracer', Tracer(tmp_path / 'trace.json', sample_rate=0))
+        response = app_module.app.test_client().get('/health')
+        assert len(response.headers['X-Request-ID']) == 16
+        assert not (tmp_path / 'trace.json').exists()
@@ -0,0 +1,62 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import transport
+from src.api_client import LoggingSiliconFlowClient
+
+
+class _FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        chunk = {"choices": [{"delta": {"content": "你好"}}]}
+        body = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.mark.local
+class TestPooledTransport:
+    """上游连接池复用测试"""
+
+    @pytest.fixture(autouse=True)
+    def upstream(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeUpstreamHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        transport.close_session()
+        self.client = LoggingSiliconFlowClient()
+        self.client.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        self.client.headers = {"Authorization": "Bearer test", "Content-Type": "application/json"}
+        yield
+        server.shutdown()
+        transport.close_session()
+
+    def test_session_is_shared_per_process(self):
+        """同一进程内所有客户端共享同一个会话"""
+        assert LoggingSiliconFlowClient().session is self.client.session
+        assert transport.get_session() is self.client.session
+
+    def test_stream_connections_are_reused(self):
+        """流式响应结束后连接应回到连接池并被后续请求复用"""
+        before = transport.transport_stats()
+        payload = {"model": "test-model", "messages": [{"role": "user", "content": "hi"}]}
+        for _ in range(3):
+            chunks = list(self.client.chat_completion(payload))
+            assert chunks[0]['choices'][0]['delta']['content'] == "你好"
+
+        after = transport.transport_stats()
+        assert after['requests'] - before['requests'] == 3
+        assert after['new_connections'] - before['new_connections'] == 1
+        assert after['reused_connections'] - before['reused_connections'] == 2
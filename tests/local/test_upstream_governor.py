@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src import api_client
+from src import app as app_module
+from src.api_client import LoggingSiliconFlowClient
+from src.upstream_governor import GovernorTimeout, UpstreamGovernor, queue_time, reset_queue_time
+
+KEY = "Bearer test-key"
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, body='{"data": [{"url": "https://cdn.siliconflow.com/a.png"}]}'):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = body
+
+    def json(self):
+        import json
+        return json.loads(self.text)
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+@pytest.mark.local
+class TestUpstreamGovernor:
+    """上游调用节流器的测试"""
+
+    def test_token_bucket_spaces_requests(self):
+        governor = UpstreamGovernor(rate=20, burst=1, model_concurrency=10, enabled=True)
+        reset_queue_time()
+        governor.acquire(KEY, 'm').release()
+        started = time.monotonic()
+        permit = governor.acquire(KEY, 'm')
+        permit.release()
+        assert time.monotonic() - started >= 0.03
+        assert permit.waited >= 0.03
+        assert queue_time() >= 0.03
+        # 不同模型使用各自的令牌桶
+        assert governor.acquire(KEY, 'other').waited < 0.03
+
+    def test_model_concurrency_and_deadline(self):
+        governor = UpstreamGovernor(rate=100, burst=10, model_concurrency=1, enabled=True)
+        first = governor.acquire(KEY, 'm')
+        with pytest.raises(GovernorTimeout):
+            governor.acquire(KEY, 'm', timeout=0.05)
+        threading.Timer(0.05, first.release).start()
+        with governor.acquire(KEY, 'm', timeout=1) as second:
+            assert second.waited >= 0.03
+        stats = governor.stats()
+        assert (stats['granted'], stats['timeouts'], stats['running']) == (2, 1, {})
+
+    def test_throttle_honours_retry_after_and_adapts_rate(self):
+        governor = UpstreamGovernor(rate=10, burst=5, min_rate=1, recovery=1, backoff=0.5, enabled=True)
+        with governor.acquire(KEY, 'm') as permit:
+            permit.observe(429, '0.2')
+        bucket = governor.stats()['buckets']
+        (name, state), = bucket.items()
+        assert state['rate'] == 5 and state['blocked_for'] > 0.1
+        with pytest.raises(GovernorTimeout) as info:
+            governor.acquire(KEY, 'm', timeout=0.05)
+        assert info.value.retry_after > 0.1
+        with governor.acquire(KEY, 'm', timeout=1) as permit:
+            assert permit.waited >= 0.1
+            permit.observe(200)
+        assert governor.stats()['buckets'][name]['rate'] == 6
+
+    def test_disabled_governor_does_not_wait(self):
+        governor = UpstreamGovernor(rate=1, burst=1, model_concurrency=1, enabled=False)
+        for _ in range(3):
+            governor.acquire(KEY, 'm')
+        assert governor.stats()['granted'] == 0
+
+    def test_async_waiter_woken_by_release(self, monkeypatch):
+        """并发已满时异步等待者由其他线程的 release() 唤醒，等待期间不轮询"""
+        governor = UpstreamGovernor(rate=1000, burst=10, model_concurrency=1, queue_timeout=5, enabled=True)
+        attempts = []
+        original = governor._try_acquire
+        monkeypatch.setattr(governor, '_try_acquire', lambda *args: attempts.append(args) or original(*args))
+        held = governor.acquire(KEY, 'm')
+
+        async def run():
+            timer = threading.Timer(0.3, held.release)
+            timer.start()
+            started = time.monotonic()
+            with await governor.aacquire(KEY, 'm'):
+                return time.monotonic() - started
+
+        waited = asyncio.run(run())
+        assert 0.25 < waited < 1
+        # 第一次尝试失败后只在被唤醒时再尝试一次
+        assert len(attempts) == 3
+        assert governor.stats()['running'] == {} and governor._async_waiters == {}
+
+    def test_client_reports_throttling(self, monkeypatch):
+        governor = UpstreamGovernor(rate=100, burst=10, enabled=True)
+        session = FakeSession([FakeResponse(429, {'Retry-After': '2'}, '{"message": "rate limited"}')])
+        monkeypatch.setattr(api_client, 'governor', governor)
+        monkeypatch.setattr(api_client, 'get_session', lambda: session)
+        client = LoggingSiliconFlowClient()
+        client.headers = {**client.headers, "Authorization": KEY}
+
+        result = client.generate_image({"prompt": "猫", "model": "m"})
+        assert result['retry_after'] == 2 and result['status'] == 429
+        # Retry-After 期间不再请求上游，排队超时直接返回
+        monkeypatch.setattr(governor, 'queue_timeout', 0.05)
+        result = client.generate_image({"prompt": "猫", "model": "m"})
+        assert result['retry_after'] > 1 and session.calls == 1
+        assert governor.stats()['running'] == {}
+
+    def test_generate_route_returns_429(self, monkeypatch):
+        class FakeClient:
+            def generate_image(self, payload):
+                return {"error": "上游请求排队超时，请稍后重试", "images": [], "retry_after": 2.5, "status": 429}
+
+        monkeypatch.setattr(app_module, 'LoggingSiliconFlowClient', FakeClient)
+        client = app_module.app.test_client()
+        response = client.post('/api/generate', json={"prompt": "猫", "width": 512, "height": 512, "num_images": 1})
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '3'
+        assert 'upstream-queue;dur=' in response.headers['Server-Timing']
+        assert 'buckets' in client.get('/api/upstream/governor').get_json()